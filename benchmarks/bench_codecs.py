@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Measure encode/decode cost of every JSON codec registered in
+fastjsonrpc.jsonrpc on payloads shaped like real JSON-RPC traffic.
+
+Usage: python bench_codecs.py [number_of_iterations]
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+import timeit
+
+from fastjsonrpc import jsonrpc
+
+
+def _record(i):
+    return {'id': i,
+            'name': 'user-%d' % i,
+            'email': 'user%d@example.com' % i,
+            'active': i % 2 == 0,
+            'score': i * 1.5,
+            'tags': ['alpha', 'beta', 'gamma'],
+            'address': {'street': 'Main Street %d' % i,
+                        'city': 'Prague',
+                        'zip': '110 00'}}
+
+
+PAYLOADS = [
+    ('echo request',
+     {'jsonrpc': '2.0', 'method': 'echo', 'params': ['some data'], 'id': 1}),
+    ('small result',
+     {'jsonrpc': '2.0', 'id': 1, 'result': _record(1)}),
+    ('100 records',
+     {'jsonrpc': '2.0', 'id': 1, 'result': [_record(i) for i in range(100)]}),
+    ('10k numbers',
+     {'jsonrpc': '2.0', 'id': 1, 'result': [i * 0.5 for i in range(10000)]}),
+    ('unicode text',
+     {'jsonrpc': '2.0', 'id': 1,
+      'result': u'Příliš žluťoučký ' * 500}),
+    ('batch of 50',
+     [{'jsonrpc': '2.0', 'method': 'get', 'params': [i], 'id': i}
+      for i in range(50)]),
+]
+
+
+def bench(codec, payload, number):
+    """
+    @rtype: tuple
+    @return: Microseconds per encode and per decode of payload
+    """
+
+    encoded = codec.dumps(payload)
+    encode = timeit.Timer(lambda: codec.dumps(payload)).timeit(number)
+    decode = timeit.Timer(lambda: codec.loads(encoded)).timeit(number)
+    return encode / number * 1e6, decode / number * 1e6
+
+
+def main(number):
+    codecs = [jsonrpc.getCodec(name) for name in jsonrpc.availableCodecs()]
+
+    print 'default codec: %s, %d iterations' % (jsonrpc.getCodec().name,
+                                                number)
+    print '%-14s %-12s %14s %14s' % ('payload', 'codec', 'encode [us]',
+                                     'decode [us]')
+    for name, payload in PAYLOADS:
+        for codec in codecs:
+            try:
+                encode, decode = bench(codec, payload, number)
+            except (ValueError, TypeError) as e:
+                print '%-14s %-12s %s' % (name, codec.name, e)
+                continue
+            print '%-14s %-12s %14.2f %14.2f' % (name, codec.name, encode,
+                                                 decode)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(1000)
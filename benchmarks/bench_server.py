@@ -0,0 +1,151 @@
+"""
+Measure the per-request overhead of the HTTP and netstring JSON-RPC servers
+for trivial methods, i.e. everything except the method itself.
+
+Also compares decoding a large "store this document" request with and
+without rawParams, for every available JSON codec.
+
+Usage: python bench_server.py [number_of_requests]
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+import base64
+import timeit
+
+from StringIO import StringIO
+from twisted.internet.defer import succeed
+from twisted.test import proto_helpers
+from twisted.web.test.test_web import DummyRequest
+
+from fastjsonrpc import server
+from fastjsonrpc import netstringserver
+from fastjsonrpc import jsonrpc
+from fastjsonrpc.dispatch import rawParams
+
+
+class HTTPServer(server.JSONRPCServer):
+
+    def jsonrpc_echo(self, data):
+        return data
+
+    def jsonrpc_deferredEcho(self, data):
+        return succeed(data)
+
+
+class NetstringServer(netstringserver.JSONRPCServer):
+
+    def jsonrpc_echo(self, data):
+        return data
+
+    def jsonrpc_deferredEcho(self, data):
+        return succeed(data)
+
+
+class StoreServer(server.JSONRPCServer):
+
+    def jsonrpc_store(self, document):
+        return len(document)
+
+
+class RawStoreServer(server.JSONRPCServer):
+
+    @rawParams
+    def jsonrpc_store(self, params):
+        return len(params.json)
+
+
+def _batch(method, length):
+    calls = ['{"jsonrpc": "2.0", "method": "%s", "params": [%d], "id": %d}' %
+             (method, i, i) for i in range(length)]
+    return '[' + ', '.join(calls) + ']'
+
+
+REQUESTS = [
+    ('single call',
+     '{"jsonrpc": "2.0", "method": "echo", "params": ["abc"], "id": 1}'),
+    ('single deferred',
+     '{"jsonrpc": "2.0", "method": "deferredEcho", "params": ["abc"], '
+     '"id": 1}'),
+    ('batch of 100', _batch('echo', 100)),
+    ('deferred batch', _batch('deferredEcho', 100)),
+]
+
+
+def _document(records):
+    return {'records': [{'id': i,
+                         'name': 'record %d' % i,
+                         'tags': ['alpha', 'beta', 'gamma'],
+                         'score': i * 1.5,
+                         'text': 'lorem ipsum dolor sit amet ' * 3,
+                         'active': i % 2 == 0}
+                        for i in range(records)]}
+
+
+def _store(document):
+    return jsonrpc.jdumps({'jsonrpc': '2.0', 'method': 'store',
+                           'params': [document], 'id': 1})
+
+
+DOCUMENTS = [
+    ('records', _store(_document(20000))),
+    ('base64', _store(base64.b64encode('\x00\xff' * 1500000))),
+]
+
+
+def benchHTTP(body, number):
+    resource = HTTPServer()
+
+    def render():
+        request = DummyRequest([''])
+        request.content = StringIO(body)
+        resource.render(request)
+
+    return timeit.Timer(render).timeit(number) / number * 1e6
+
+
+def benchNetstring(body, number):
+    netstring = '%d:%s,' % (len(body), body)
+
+    def receive():
+        protocol = NetstringServer()
+        protocol.makeConnection(proto_helpers.StringTransport())
+        protocol.dataReceived(netstring)
+
+    return timeit.Timer(receive).timeit(number) / number * 1e6
+
+
+def benchDecode(resource, codec, body, number):
+    resource.codec = codec
+    decode = lambda: resource._decodeRequest(body)
+    return timeit.Timer(decode).timeit(number) / number * 1e3
+
+
+def main(number):
+    print '%d requests each' % number
+    print '%-16s %16s %16s' % ('request', 'HTTP [us]', 'netstring [us]')
+    for name, body in REQUESTS:
+        print '%-16s %16.2f %16.2f' % (name, benchHTTP(body, number),
+                                       benchNetstring(body, number))
+
+    number = max(number / 100, 1)
+    print
+    print 'store requests, %d decodes each' % number
+    print '%-16s %-12s %16s %16s' % ('document', 'codec', 'decoded [ms]',
+                                     'rawParams [ms]')
+    for name, body in DOCUMENTS:
+        name = '%s %dkB' % (name, len(body) / 1024)
+        for codec in jsonrpc.availableCodecs():
+            print '%-16s %-12s %16.2f %16.2f' % (
+                name, codec, benchDecode(StoreServer(), codec, body, number),
+                benchDecode(RawStoreServer(), codec, body, number))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(1000)
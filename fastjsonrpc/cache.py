@@ -0,0 +1,129 @@
+"""
+Copyright 2012 Tadeas Moravec
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+============
+Result cache
+============
+
+Provides ResultCache, a bounded LRU cache with expiring entries, used to
+memoize results of jsonrpc_ methods decorated with dispatch.cached.
+"""
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+
+class ResultCache(object):
+    """
+    LRU cache with a time to live. When full, the least recently used entry
+    is evicted. Keeps count of hits, misses, evictions and expirations.
+    """
+
+    def __init__(self, ttl=None, maxSize=1000, clock=None):
+        """
+        @type ttl: float
+        @param ttl: Seconds an entry stays valid. If None, entries don't
+            expire and get only evicted.
+
+        @type maxSize: int
+        @param maxSize: Maximum number of entries
+
+        @type clock: t.i.interfaces.IReactorTime
+        @param clock: Source of time, the reactor by default
+        """
+
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.clock = clock or reactor
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """
+        @type key: hashable
+        @param key: Key of the entry
+
+        @rtype: mixed
+        @return: Cached value, or None if there's no valid entry for key
+        """
+
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        if expires is not None and expires <= self.clock.seconds():
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        # re-insert, so it's the most recently used one
+        self._entries[key] = (expires, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Store a value, evicting the least recently used entries if we're
+        full.
+
+        @type key: hashable
+        @param key: Key of the entry
+
+        @type value: mixed
+        @param value: Value to store. Must not be None.
+        """
+
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = self.clock.seconds() + self.ttl
+
+        self._entries.pop(key, None)
+        self._entries[key] = (expires, value)
+
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Drop all entries. The counters are kept.
+        """
+
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        @rtype: dict
+        @return: Counters and current number of entries
+        """
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'size': len(self._entries)}
@@ -32,10 +32,15 @@ from twisted.cred.credentials import Anonymous, UsernamePassword
 from twisted.internet import reactor
 from twisted.internet.protocol import Protocol
 from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IProtocol
+from twisted.python.components import proxyForInterface
+from twisted.python.failure import Failure
 from twisted.web.client import (Agent, ContentDecoderAgent, GzipDecoder,
-                                HTTPConnectionPool)
+                                HTTPConnectionPool, ResponseFailed)
 from twisted.web.http_headers import Headers
+from twisted.web.iweb import IResponse
 
+import compression
 import jsonrpc
 
 
@@ -103,6 +108,99 @@ class StringProducer(object):
         pass
 
 
+class DecodingProtocol(proxyForInterface(IProtocol)):
+    """
+    Protocol wrapper decompressing the response body, before it's passed
+    to the wrapped protocol.
+    """
+
+    def __init__(self, protocol, response, encoding):
+        """
+        @type protocol: t.i.p.Protocol
+        @param protocol: Protocol to pass the decompressed body to
+
+        @type response: t.w.c.Response
+        @param response: The compressed response, in case of errors
+
+        @type encoding: compression.ContentEncoding
+        @param encoding: Content coding of the response
+        """
+
+        self.original = protocol
+        self._response = response
+        self._decompressor = encoding.decompressor()
+
+    def dataReceived(self, data):
+        """
+        Decompress data and pass on what we've got.
+
+        @type data: str
+        @param data: Part of the compressed body
+        """
+
+        try:
+            data = self._decompressor.decompress(data)
+        except compression.DecompressionError:
+            raise ResponseFailed([Failure()], self._response)
+        if data:
+            self.original.dataReceived(data)
+
+    def connectionLost(self, reason):
+        """
+        Pass on the rest of the decompressed body and the end of it.
+
+        @type reason: t.p.f.Failure
+        @param reason: Why the body ended
+        """
+
+        try:
+            data = self._decompressor.finish()
+        except compression.DecompressionError:
+            raise ResponseFailed([reason, Failure()], self._response)
+        if data:
+            self.original.dataReceived(data)
+        self.original.connectionLost(reason)
+
+
+class DecodingResponse(proxyForInterface(IResponse)):
+    """
+    Response with a compressed body, decompressed as it's delivered. Used
+    by ContentDecoderAgent for the codings Twisted has no decoder for.
+    """
+
+    def __init__(self, response, encoding):
+        """
+        @type response: t.w.c.Response
+        @param response: The compressed response
+
+        @type encoding: compression.ContentEncoding
+        @param encoding: Content coding of the response
+        """
+
+        self.original = response
+        self.encoding = encoding
+
+    def deliverBody(self, protocol):
+        self.original.deliverBody(DecodingProtocol(protocol, self.original,
+                                                   self.encoding))
+
+
+def _getDecoder(name):
+    """
+    @type name: str
+    @param name: Name of a registered content coding
+
+    @rtype: callable
+    @return: Decoder for ContentDecoderAgent, wrapping the response
+    """
+
+    if name == 'gzip':
+        return GzipDecoder
+
+    encoding = compression.getEncoding(name)
+    return lambda response: DecodingResponse(response, encoding)
+
+
 class ProxyFactory(object):
     """
     A factory to create Proxy objects. Passed parameters are used to create
@@ -146,13 +244,30 @@ class ProxyFactory(object):
         @param retryAutomatically: Boolean indicating whether idempotent
             requests should be retried once if no response was received.
 
-        @type compressedHTTP: bool
+        @type compressedHTTP: bool or list
         @param compressedHTTP: Boolean indicating whether proxies can support
-            HTTP compression (actually gzip).
+            HTTP compression, using all available content codings (see
+            compression.availableEncodings). Or a list of names of the
+            codings to accept, the preferred ones first.
 
         @type sharedPool: bool
         @type sharedPool: Share one connection pool between all created proxies.
             The default is False.
+
+        @type requestEncoding: str
+        @param requestEncoding: Content coding to compress requests with,
+            see Proxy.
+
+        @type requestMinSize: int
+        @param requestMinSize: Requests shorter than this are sent
+            uncompressed. The default is 1024.
+
+        @type compressionLevel: int
+        @param compressionLevel: Compression level of the requests.
+
+        @type codec: jsonrpc.JSONCodec or str
+        @param codec: JSON codec the proxies will use, see jsonrpc.getCodec.
+            If None then the default codec is used.
         """
         self._version = kwargs.get('version') or jsonrpc.VERSION_1
         self._connectTimeout = kwargs.get('connectTimeout')
@@ -170,6 +285,12 @@ class ProxyFactory(object):
             self._retryAutomatically = HTTPConnectionPool.retryAutomatically
         self._compressedHTTP = kwargs.get('compressedHTTP') or False
         self._sharedPool = kwargs.get('sharedPool') or False
+        self._codec = kwargs.get('codec')
+        self._requestEncoding = kwargs.get('requestEncoding')
+        self._requestMinSize = kwargs.get('requestMinSize')
+        if self._requestMinSize is None:
+            self._requestMinSize = 1024
+        self._compressionLevel = kwargs.get('compressionLevel')
 
         self._pool = None
 
@@ -194,11 +315,15 @@ class ProxyFactory(object):
             pool = self._getConnectionPool()
 
 
-        kwargs = {'version':        self._version,
-                  'connectTimeout': self._connectTimeout,
-                  'credentials':    self._credentials,
-                  'contextFactory': self._contextFactory,
-                  'pool':           pool}
+        kwargs = {'version':          self._version,
+                  'connectTimeout':   self._connectTimeout,
+                  'credentials':      self._credentials,
+                  'contextFactory':   self._contextFactory,
+                  'pool':             pool,
+                  'codec':            self._codec,
+                  'requestEncoding':  self._requestEncoding,
+                  'requestMinSize':   self._requestMinSize,
+                  'compressionLevel': self._compressionLevel}
 
         proxy = Proxy(url, **kwargs)
 
@@ -218,7 +343,14 @@ class ProxyFactory(object):
         return pool
 
     def _setContentDecoder(self, proxy):
-        proxy.agent = ContentDecoderAgent(proxy.agent, [('gzip', GzipDecoder)])
+        if self._compressedHTTP is True:
+            names = compression.availableEncodings()
+        else:
+            names = self._compressedHTTP
+
+        # ContentDecoderAgent advertises them in Accept-Encoding
+        decoders = [(name, _getDecoder(name)) for name in names]
+        proxy.agent = ContentDecoderAgent(proxy.agent, decoders)
 
 
 class Proxy(object):
@@ -229,7 +361,9 @@ class Proxy(object):
     """
 
     def __init__(self, url, version=jsonrpc.VERSION_1, connectTimeout=None,
-                 credentials=None, contextFactory=None, pool=None):
+                 credentials=None, contextFactory=None, pool=None,
+                 codec=None, requestEncoding=None, requestMinSize=1024,
+                 compressionLevel=None):
         """
         @type url: str
         @param url: URL of the RPC server. Supports HTTP and HTTPS for now,
@@ -255,10 +389,36 @@ class Proxy(object):
         @type pool: twisted.web.client.HTTPConnectionPool
         @param pool: Connection pool used to manage HTTP connections.
             If None then Agent's default is used.
+
+        @type codec: jsonrpc.JSONCodec or str
+        @param codec: JSON codec to encode requests and decode responses
+            with, see jsonrpc.getCodec. If None then the default codec is used.
+
+        @type requestEncoding: str
+        @param requestEncoding: Name of the content coding (e.g. 'gzip') to
+            compress requests with, see compression.availableEncodings. The
+            server must support compressed requests. If None then requests
+            are sent uncompressed.
+
+        @type requestMinSize: int
+        @param requestMinSize: Requests shorter than this are sent
+            uncompressed.
+
+        @type compressionLevel: int
+        @param compressionLevel: Compression level of the requests, None for
+            the library's default.
         """
 
         self.url = url
         self.version = version
+        self.codec = jsonrpc.getCodec(codec)
+        self._ids = jsonrpc.IdAllocator()
+
+        self.requestEncoding = None
+        if requestEncoding is not None:
+            self.requestEncoding = compression.getEncoding(requestEncoding)
+        self.requestMinSize = requestMinSize
+        self.compressionLevel = compressionLevel
 
         if not credentials:
             credentials = Anonymous()
@@ -318,8 +478,8 @@ class Proxy(object):
     def callRemote(self, method, *args, **kwargs):
         """
         Remotely calls the method, with args. Given that we keep reference to
-        the call via the Deferred, there's no need for id. It will coin some
-        random anyway, just to satisfy the spec.
+        the call via the Deferred, there's no need for id. We coin one
+        anyway, just to satisfy the spec, and check the response carries it.
 
         @type method: str
         @param method: Method name
@@ -332,16 +492,26 @@ class Proxy(object):
         @TODO support batch requests
         """
 
+        id_ = self._ids.allocate()
         if kwargs:
-            json_request = jsonrpc.encodeRequest(method, kwargs,
-                                                 version=self.version)
+            json_request = jsonrpc.encodeRequest(method, kwargs, id_=id_,
+                                                 version=self.version,
+                                                 codec=self.codec)
         else:
-            json_request = jsonrpc.encodeRequest(method, args,
-                                                 version=self.version)
+            json_request = jsonrpc.encodeRequest(method, args, id_=id_,
+                                                 version=self.version,
+                                                 codec=self.codec)
+
+        headers_dict = {'Content-Type': ['application/json']}
+
+        if (self.requestEncoding is not None and
+                len(json_request) >= self.requestMinSize):
+            json_request = self.requestEncoding.compress(
+                json_request, self.compressionLevel)
+            headers_dict['Content-Encoding'] = [self.requestEncoding.name]
 
         body = StringProducer(json_request)
 
-        headers_dict = {'Content-Type': ['application/json']}
         if not isinstance(self.credentials, Anonymous):
             headers_dict.update(self._getBasicHTTPAuthHeaders())
         headers = Headers(headers_dict)
@@ -349,9 +519,18 @@ class Proxy(object):
         d = self.agent.request('POST', self.url, headers, body)
         d.addCallback(self.checkAuthError)
         d.addCallback(self.bodyFromResponse)
-        d.addCallback(jsonrpc.decodeResponse)
+        d.addCallback(jsonrpc.decodeResponse, self.codec, id_)
+        d.addBoth(self._callDone, id_)
         return d
 
+    def _callDone(self, result, id_):
+        """
+        Free the id of a finished call, passing the result through.
+        """
+
+        self._ids.release(id_)
+        return result
+
     def _getBasicHTTPAuthHeaders(self):
         """
         @rtype dict
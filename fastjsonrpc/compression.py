@@ -0,0 +1,347 @@
+"""
+Copyright 2012 Tadeas Moravec
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+================
+HTTP compression
+================
+
+Provides the content codings (gzip, deflate, and zstd and br when their
+libraries are installed) used to compress HTTP bodies, a registry of them
+and negotiation of the coding via the Accept-Encoding header.
+"""
+
+import zlib
+
+
+class DecompressionError(ValueError):
+    """
+    The compressed data is corrupt.
+    """
+
+
+class ContentEncoding(object):
+    """
+    An HTTP content coding, e.g. gzip. Wraps a compression library into
+    compressor and decompressor objects with the same interface.
+
+    A compressor has methods compress(data) returning the compressed data
+    it can already give away, flush() returning everything it has been
+    given so far (so the other side can decompress it) and finish()
+    returning the rest. A decompressor has methods decompress(data) and
+    finish(), both raising DecompressionError on corrupt data.
+    """
+
+    def __init__(self, name, compressor, decompressor):
+        """
+        @type name: str
+        @param name: Name of the coding used in the Content-Encoding and
+            Accept-Encoding headers
+
+        @type compressor: callable
+        @param compressor: Takes the compression level (None for the
+            library's default) and returns a new compressor
+
+        @type decompressor: callable
+        @param decompressor: Returns a new decompressor
+        """
+
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+    def compress(self, data, level=None):
+        """
+        @type data: str
+        @param data: Data to compress
+
+        @type level: int
+        @param level: Compression level, None for the library's default
+
+        @rtype: str
+        @return: Compressed data
+        """
+
+        compressor = self.compressor(level)
+        return compressor.compress(data) + compressor.finish()
+
+    def decompress(self, data):
+        """
+        @type data: str
+        @param data: Compressed data
+
+        @rtype: str
+        @return: Decompressed data
+
+        @raise DecompressionError: If the data is corrupt.
+        """
+
+        decompressor = self.decompressor()
+        return decompressor.decompress(data) + decompressor.finish()
+
+    def __repr__(self):
+        return '<ContentEncoding %s>' % self.name
+
+
+class _ZlibCompressor(object):
+
+    def __init__(self, wbits, level):
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _ZlibDecompressor(object):
+
+    def __init__(self, wbits):
+        self._decompressor = zlib.decompressobj(wbits)
+
+    def decompress(self, data):
+        try:
+            return self._decompressor.decompress(data)
+        except zlib.error as e:
+            raise DecompressionError(str(e))
+
+    def finish(self):
+        try:
+            return self._decompressor.flush()
+        except zlib.error as e:
+            raise DecompressionError(str(e))
+
+
+def _zlibEncoding(name, wbits):
+    """
+    @type wbits: int
+    @param wbits: zlib's window bits, selecting the container format too
+    """
+
+    return ContentEncoding(name,
+                           lambda level: _ZlibCompressor(wbits, level),
+                           lambda: _ZlibDecompressor(wbits))
+
+
+class _ZstdCompressor(object):
+
+    def __init__(self, zstandard, level):
+        self._zstandard = zstandard
+        if level is None:
+            compressor = zstandard.ZstdCompressor()
+        else:
+            compressor = zstandard.ZstdCompressor(level=level)
+        self._compressor = compressor.compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        flush = self._zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        return self._compressor.flush(flush)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _ZstdDecompressor(object):
+
+    def __init__(self, zstandard):
+        self._zstandard = zstandard
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        try:
+            return self._decompressor.decompress(data)
+        except self._zstandard.ZstdError as e:
+            raise DecompressionError(str(e))
+
+    def finish(self):
+        return ''
+
+
+class _BrotliCompressor(object):
+
+    def __init__(self, brotli, level):
+        if level is None:
+            self._compressor = brotli.Compressor()
+        else:
+            self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class _BrotliDecompressor(object):
+
+    def __init__(self, brotli):
+        self._brotli = brotli
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data):
+        try:
+            return self._decompressor.process(data)
+        except self._brotli.error as e:
+            raise DecompressionError(str(e))
+
+    def finish(self):
+        if not self._decompressor.is_finished():
+            raise DecompressionError('Truncated brotli stream')
+        return ''
+
+
+_encodings = {}
+_preference = []
+
+
+def registerEncoding(encoding):
+    """
+    Make a content coding available to servers and proxies by its name.
+    Codings registered earlier are preferred.
+
+    @type encoding: ContentEncoding
+    @param encoding: The coding to register. Replaces any coding registered
+        under the same name, keeping its preference.
+    """
+
+    if encoding.name not in _encodings:
+        _preference.append(encoding.name)
+    _encodings[encoding.name] = encoding
+
+
+def getEncoding(name):
+    """
+    @type name: str
+    @param name: Name of a registered coding, e.g. 'gzip'
+
+    @rtype: ContentEncoding
+    @return: The coding
+
+    @raise ValueError: If there's no coding registered under given name.
+    """
+
+    try:
+        return _encodings[name]
+    except KeyError:
+        raise ValueError('Unknown content encoding: %s' % name)
+
+
+def availableEncodings():
+    """
+    @rtype: list
+    @return: Names of all registered codings, the preferred ones first
+    """
+
+    return list(_preference)
+
+
+def negotiateEncoding(acceptEncoding, names=None):
+    """
+    Pick the content coding of a response, honouring the q-values of the
+    client's Accept-Encoding header.
+
+    @type acceptEncoding: str
+    @param acceptEncoding: Value of the Accept-Encoding header, or None if
+        there's none
+
+    @type names: list
+    @param names: Names of the codings we're willing to use, the preferred
+        ones first. Names that aren't registered are skipped. Defaults to
+        all registered codings.
+
+    @rtype: ContentEncoding
+    @return: The coding to use, or None to send the response uncompressed
+    """
+
+    if not acceptEncoding:
+        return None
+
+    accepted = {}
+    for coding in acceptEncoding.split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        if not name:
+            continue
+
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+
+    if names is None:
+        names = _preference
+
+    best = None
+    bestQ = 0.0
+    for name in names:
+        if name not in _encodings:
+            continue
+        q = accepted.get(name, accepted.get('*', 0.0))
+        if q > bestQ:
+            best = _encodings[name]
+            bestQ = q
+
+    return best
+
+
+def _registerAvailableEncodings():
+    """
+    Register a coding for every compression library we can import. zstd
+    and br compress better and faster than gzip, so they're preferred.
+    """
+
+    try:
+        import zstandard
+    except ImportError:
+        pass
+    else:
+        registerEncoding(ContentEncoding(
+            'zstd',
+            lambda level: _ZstdCompressor(zstandard, level),
+            lambda: _ZstdDecompressor(zstandard)))
+
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        registerEncoding(ContentEncoding(
+            'br',
+            lambda level: _BrotliCompressor(brotli, level),
+            lambda: _BrotliDecompressor(brotli)))
+
+    registerEncoding(_zlibEncoding('gzip', 16 + zlib.MAX_WBITS))
+    # HTTP's deflate is the zlib format, not raw deflate
+    registerEncoding(_zlibEncoding('deflate', zlib.MAX_WBITS))
+
+
+_registerAvailableEncodings()
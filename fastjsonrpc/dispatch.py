@@ -0,0 +1,1516 @@
+"""
+Copyright 2012 Tadeas Moravec
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+===================
+JSON-RPC dispatcher
+===================
+
+Provides JSONRPCDispatcher, the part of both JSON-RPC servers (HTTP and
+netstring) that decodes requests and finds and calls the exposed methods.
+Also provides decorators changing how an exposed method gets called.
+"""
+
+import inspect
+import json
+import types
+from cStringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import failure, log
+from twisted.python.threadpool import ThreadPool
+
+import jsonrpc
+from cache import ResultCache
+from limiter import ConcurrencyLimiter, OverloadedError
+from metrics import RequestTiming, ServerMetrics
+from processpool import ProcessPool
+
+DEFAULT_THREAD_POOL = 'default'
+DEFAULT_THREAD_POOL_SIZE = 10
+DEFAULT_PROCESS_POOL = 'default'
+CODEC_THREAD_POOL = 'codec'
+
+
+def rawParams(function):
+    """
+    Decorator for jsonrpc_ methods that want their params undecoded. The
+    method gets a single argument, jsonrpc.RawParams, and it's up to the
+    method if (and when) it decodes them. Useful for methods that only store
+    or forward the params.
+
+    The request is still scanned (in Python) for where the params end. On
+    a 4 MB request that's a single base64 string, that's faster than any
+    codec decodes it. On 4 MB of small records, it's about as fast as the
+    json module and half as fast as simplejson or ujson, so then it only
+    saves memory. See benchmarks/bench_server.py.
+
+    The params are left undecoded only for single (non-batch) calls. In
+    a batch, the whole request has to be decoded anyway, and the method gets
+    RawParams wrapping the decoded params.
+    """
+
+    function.jsonrpc_rawParams = True
+    return function
+
+
+def inThread(pool=DEFAULT_THREAD_POOL):
+    """
+    Decorator for jsonrpc_ methods that block, e.g. call a blocking library.
+    The method runs in a thread pool instead of the reactor thread, so it
+    doesn't stall the other requests. Its result is serialized as usual.
+
+    Use either as @inThread (the default pool) or @inThread('name') to run
+    the method in a pool of its own. See setThreadPoolSize.
+
+    @type pool: str
+    @param pool: Name of the thread pool
+    """
+
+    if callable(pool):
+        pool.jsonrpc_threadPool = DEFAULT_THREAD_POOL
+        return pool
+
+    def decorator(function):
+        function.jsonrpc_threadPool = pool
+        return function
+
+    return decorator
+
+
+_threadPools = {}
+_threadPoolSizes = {}
+_processPools = {}
+_stopPoolsTrigger = None
+
+
+def _stopPoolsOnShutdown():
+    """
+    Make sure stopPools gets called when the reactor shuts down.
+    """
+
+    global _stopPoolsTrigger
+
+    if _stopPoolsTrigger is None:
+        _stopPoolsTrigger = reactor.addSystemEventTrigger('before', 'shutdown',
+                                                          stopPools)
+
+
+def setThreadPoolSize(name, size):
+    """
+    Set the maximum number of threads of a named thread pool. Pools we
+    don't set a size for get DEFAULT_THREAD_POOL_SIZE threads.
+
+    @type name: str
+    @param name: Name of the pool, as given to inThread
+
+    @type size: int
+    @param size: Maximum number of threads
+    """
+
+    _threadPoolSizes[name] = size
+    if name in _threadPools:
+        _threadPools[name].adjustPoolsize(maxthreads=size)
+
+
+def getThreadPool(name=DEFAULT_THREAD_POOL):
+    """
+    Get a named thread pool. It's created and started on first use, and
+    stopped when the reactor shuts down.
+
+    @type name: str
+    @param name: Name of the pool, as given to inThread
+
+    @rtype: t.p.threadpool.ThreadPool
+    @return: The pool
+    """
+
+    try:
+        return _threadPools[name]
+    except KeyError:
+        _stopPoolsOnShutdown()
+        size = _threadPoolSizes.get(name, DEFAULT_THREAD_POOL_SIZE)
+        pool = ThreadPool(0, size, 'fastjsonrpc-%s' % name)
+        pool.start()
+        _threadPools[name] = pool
+        return pool
+
+
+def inProcess(pool=DEFAULT_PROCESS_POOL):
+    """
+    Decorator for CPU-bound jsonrpc_ methods. The method runs in a pool of
+    worker processes (see processpool.ProcessPool), so it's not limited by
+    the GIL and a crash takes down only the worker.
+
+    The method gets a bare instance of the server class (its __init__ is not
+    called), must return a plain value (not a Deferred) and the class must be
+    importable. Use either as @inProcess (the default pool) or
+    @inProcess('name'). See setProcessPool.
+
+    @type pool: str
+    @param pool: Name of the process pool
+    """
+
+    if callable(pool):
+        pool.jsonrpc_processPool = DEFAULT_PROCESS_POOL
+        return pool
+
+    def decorator(function):
+        function.jsonrpc_processPool = pool
+        return function
+
+    return decorator
+
+
+def setProcessPool(name, pool):
+    """
+    Use a configured pool for methods decorated with inProcess(name). Pools
+    we don't set are created with ProcessPool's defaults.
+
+    @type name: str
+    @param name: Name of the pool, as given to inProcess
+
+    @type pool: processpool.ProcessPool
+    @param pool: The pool
+    """
+
+    _stopPoolsOnShutdown()
+    _processPools[name] = pool
+
+
+def getProcessPool(name=DEFAULT_PROCESS_POOL):
+    """
+    Get a named process pool. It's created on first use, unless it was set
+    by setProcessPool, and stopped when the reactor shuts down.
+
+    @type name: str
+    @param name: Name of the pool, as given to inProcess
+
+    @rtype: processpool.ProcessPool
+    @return: The pool
+    """
+
+    try:
+        return _processPools[name]
+    except KeyError:
+        setProcessPool(name, ProcessPool())
+        return _processPools[name]
+
+
+def stopPools():
+    """
+    Stop all thread and process pools. They get started again on demand,
+    keeping their configuration (see setThreadPoolSize and setProcessPool).
+
+    @rtype: Deferred
+    @return: Deferred firing when all worker processes have exited
+    """
+
+    while _threadPools:
+        _, pool = _threadPools.popitem()
+        pool.stop()
+
+    return DeferredList([pool.stop() for pool in _processPools.values()])
+
+
+def cached(ttl=None, maxSize=1000):
+    """
+    Decorator for jsonrpc_ methods whose results can be reused. Results are
+    cached per method and params, already serialized, so a cache hit skips
+    both calling the method and serializing the result. Errors are not
+    cached.
+
+    The cache is shared by all instances of the server class, see
+    JSONRPCDispatcher.cacheStats and clearCache. Concurrent identical calls
+    are coalesced, see coalesced.
+
+    @type ttl: float
+    @param ttl: Seconds a result stays valid. If None, it's valid until it
+        gets evicted.
+
+    @type maxSize: int
+    @param maxSize: Maximum number of cached results (of this method). The
+        least recently used ones get evicted.
+    """
+
+    def decorator(function):
+        function.jsonrpc_cache = (ttl, maxSize)
+        return function
+
+    return decorator
+
+
+def coalesced(function):
+    """
+    Decorator for jsonrpc_ methods that may be called just once for
+    concurrent calls with the same params (single-flight). While a call
+    returning a Deferred is in flight, identical calls don't call the method
+    again, but wait for the result of the first one. Any call made after
+    the result arrived calls the method again.
+
+    Coalescing is shared by all instances of the server class, so it works
+    across HTTP requests, netstring connections and within batches.
+    Decorate only methods without side effects, whose callers are happy
+    with a result that was computed for someone else.
+    """
+
+    function.jsonrpc_coalesce = True
+    return function
+
+
+def limited(maxConcurrent, maxQueued=0):
+    """
+    Decorator for jsonrpc_ methods that may run only so many times at once,
+    e.g. because they use a scarce resource. Calls beyond maxConcurrent
+    wait in a queue of at most maxQueued calls, calls beyond that fail right
+    away with SERVER_OVERLOADED (see limiter.OverloadedError).
+
+    The limit is shared by all instances of the server class and applies on
+    top of JSONRPCDispatcher.maxConcurrentCalls. A call is in flight until
+    the Deferred the method returned fires. See
+    JSONRPCDispatcher.limiterStats.
+
+    @type maxConcurrent: int
+    @param maxConcurrent: Maximum number of calls in flight
+
+    @type maxQueued: int
+    @param maxQueued: Maximum number of calls waiting, None for unbounded
+    """
+
+    def decorator(function):
+        function.jsonrpc_limit = (maxConcurrent, maxQueued)
+        return function
+
+    return decorator
+
+
+def _cacheKey(params):
+    """
+    Canonical serialization of params, so the same params given in
+    a different order (of keyword arguments) or formatting are the same
+    key. RawParams are decoded for it, whether they came in a batch or not.
+
+    @type params: list, dict, RawParams or None
+    @param params: Params of the call
+
+    @rtype: str
+    @return: The cache key
+
+    @raise JSONRPCError: If RawParams are not valid JSON.
+    """
+
+    if isinstance(params, jsonrpc.RawParams):
+        params = params.decode()
+    return json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+
+class ExposedMethod(object):
+    """
+    A jsonrpc_ method of a server class, inspected once: the function to
+    call, the arguments it accepts and how it wants to be called. Lets us
+    check the params of a call before calling it, so a TypeError raised
+    inside the method is not mistaken for invalid params.
+    """
+
+    def __init__(self, name, function):
+        """
+        @type name: str
+        @param name: Name of the method, without the 'jsonrpc_' prefix
+
+        @type function: callable
+        @param function: The method as found on the class (i.e. unbound)
+        """
+
+        self.name = name
+        self.rawParams = getattr(function, 'jsonrpc_rawParams', False)
+        self.threadPool = getattr(function, 'jsonrpc_threadPool', None)
+        self.processPool = getattr(function, 'jsonrpc_processPool', None)
+
+        if hasattr(function, 'jsonrpc_cache'):
+            ttl, maxSize = function.jsonrpc_cache
+            self.cache = ResultCache(ttl, maxSize)
+        else:
+            self.cache = None
+
+        if hasattr(function, 'jsonrpc_limit'):
+            maxConcurrent, maxQueued = function.jsonrpc_limit
+            self.limiter = ConcurrencyLimiter(maxConcurrent, maxQueued)
+        else:
+            self.limiter = None
+
+        self.coalesce = (self.cache is not None or
+                         getattr(function, 'jsonrpc_coalesce', False))
+        # Cache key -> Deferreds waiting for the call in flight
+        self.inFlight = {}
+
+        # Plain methods are called as function(instance, *args). Anything
+        # else (static, class methods...) is looked up on the instance.
+        if (isinstance(function, types.MethodType) and
+                function.im_self is None):
+            self.function = function.im_func
+        else:
+            self.function = None
+
+        try:
+            args, varargs, keywords, defaults = inspect.getargspec(
+                self.function or function)
+        except TypeError:
+            # Not something we can inspect, don't check its arguments.
+            self.checked = False
+            return
+
+        if isinstance(function, types.MethodType):
+            # self (or cls)
+            args = args[1:]
+
+        self.checked = True
+        self.args = frozenset(args)
+        self.minArgs = len(args) - len(defaults or ())
+        self.maxArgs = None if varargs else len(args)
+        self.required = frozenset(args[:self.minArgs])
+        self.anyKeywords = keywords is not None
+
+    def acceptsArgs(self, args):
+        """
+        @type args: list
+        @param args: Positional arguments of the call
+
+        @rtype: bool
+        @return: Whether the method can be called with args
+        """
+
+        if not self.checked:
+            return True
+
+        return (self.minArgs <= len(args) and
+                (self.maxArgs is None or len(args) <= self.maxArgs))
+
+    def acceptsKeywords(self, kwargs):
+        """
+        @type kwargs: dict
+        @param kwargs: Keyword arguments of the call
+
+        @rtype: bool
+        @return: Whether the method can be called with kwargs
+        """
+
+        if not self.checked:
+            return True
+
+        for name in self.required:
+            if name not in kwargs:
+                return False
+
+        if not self.anyKeywords:
+            for name in kwargs:
+                if name not in self.args:
+                    return False
+
+        return True
+
+
+_methodTables = {}
+
+
+def getMethodTable(cls):
+    """
+    @type cls: class
+    @param cls: Server class
+
+    @rtype: dict
+    @return: Method name -> ExposedMethod for all jsonrpc_ methods of cls.
+        Built only once per class.
+    """
+
+    try:
+        return _methodTables[cls]
+    except KeyError:
+        table = {}
+        for attr in dir(cls):
+            if attr.startswith('jsonrpc_'):
+                function = getattr(cls, attr)
+                if callable(function):
+                    name = attr[len('jsonrpc_'):]
+                    table[name] = ExposedMethod(name, function)
+
+        _methodTables[cls] = table
+        return table
+
+
+_rawParamsMethods = {}
+
+
+def _getRawParamsMethods(cls):
+    """
+    @rtype: frozenset
+    @return: Names of cls's methods decorated with rawParams. Computed only
+        once per class.
+    """
+
+    try:
+        return _rawParamsMethods[cls]
+    except KeyError:
+        names = frozenset(name for name, method
+                          in getMethodTable(cls).iteritems()
+                          if method.rawParams)
+        _rawParamsMethods[cls] = names
+        return names
+
+
+class _WindowedBatch(object):
+    """
+    Dispatches calls of a batch so that at most window of them are in flight
+    at once, see JSONRPCDispatcher.batchWindow. Responses are either kept in
+    the order of the calls, or passed on one by one as they are ready.
+
+    Calls are taken from request_content only when there's room for them,
+    so an incrementally decoded batch (see jsonrpc.BatchParser) is decoded
+    only as fast as it's dispatched.
+    """
+
+    def __init__(self, dispatcher, request_content, window, write=None,
+                 timing=None):
+        """
+        @type dispatcher: JSONRPCDispatcher
+        @param dispatcher: Dispatcher to call the methods with
+
+        @type request_content: iterable
+        @param request_content: Decoded method calls
+
+        @type window: int
+        @param window: Maximum number of calls in flight, None for no limit
+
+        @type write: callable
+        @param write: If given, it's called with every serialized response
+            (not None, i.e. not with notifications) as soon as it's ready,
+            and responses are not kept.
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+        """
+
+        self.dispatcher = dispatcher
+        self.calls = iter(request_content)
+        self.window = window
+        self.write = write
+        self.timing = timing
+
+        self.responses = [] if write is None else None
+        self.count = 0
+        self.inFlight = 0
+        self.exhausted = False
+        self.error = None
+        self.starting = False
+        self.done = False
+        self.finished = None
+
+    def start(self):
+        """
+        Start calls until the window is full or there are no more calls. Once
+        all calls are done, set done and fire finished (if someone's waiting
+        for it) with the responses (if we keep them), or with the error that
+        stopped decoding of the batch.
+        """
+
+        if self.starting:
+            # A call finished right away, the loop below goes on.
+            return
+
+        self.starting = True
+        while (not self.exhausted and
+               (self.window is None or self.inFlight < self.window)):
+            try:
+                request_dict = next(self.calls)
+            except StopIteration:
+                self.exhausted = True
+                break
+            except Exception as e:
+                # Usually a JSONRPCError of a malformed request. We may be in
+                # a callback of a finished call, so nothing may escape.
+                self.exhausted = True
+                self.error = e
+                break
+
+            index = self.count
+            self.count += 1
+            if self.responses is not None:
+                self.responses.append(None)
+
+            try:
+                response = self.dispatcher._dispatchCall(request_dict,
+                                                         timing=self.timing)
+            except Exception as e:
+                self.exhausted = True
+                self.error = e
+                break
+            if isinstance(response, Deferred):
+                self.inFlight += 1
+                response.addBoth(self._callFinished, index)
+            else:
+                self._store(response, index)
+        self.starting = False
+
+        if self.exhausted and not self.inFlight and not self.done:
+            self.done = True
+            if self.finished is not None and self.error is not None:
+                self.finished.errback(self.error)
+            elif self.finished is not None:
+                self.finished.callback(self.responses)
+
+    def wait(self):
+        """
+        @rtype: Deferred
+        @return: Deferred firing when all calls are done, see start
+        """
+
+        self.finished = Deferred()
+        return self.finished
+
+    def _store(self, response, index):
+        """
+        Keep the response of a call, or pass it on.
+        """
+
+        if self.write is None:
+            self.responses[index] = response
+        elif response is not None:
+            self.write(response)
+
+    def _callFinished(self, response, index):
+        """
+        Store response of a call and start the next one.
+        """
+
+        if isinstance(response, failure.Failure):
+            log.err(response)
+            response = None
+
+        self.inFlight -= 1
+        self._store(response, index)
+        self.start()
+
+
+_globalLimiters = {}
+_serverMetrics = {}
+
+
+class JSONRPCDispatcher(object):
+    """
+    Mixin with the functionality both JSON-RPC servers share. The servers
+    subclass this, it's not useful on its own.
+
+    @ivar codec: JSON codec for requests and responses, see jsonrpc.getCodec.
+
+    @ivar maxConcurrentCalls: Maximum number of calls of all methods in
+        flight, None for no limit. Set in a subclass, the limit is shared by
+        all its instances.
+
+    @ivar maxQueuedCalls: Maximum number of calls waiting for one of the
+        maxConcurrentCalls slots, None for unbounded. Calls beyond that fail
+        right away with SERVER_OVERLOADED.
+
+    @ivar maxRequestSize: Maximum size of a request in bytes, None for the
+        default (no limit over HTTP, NetstringReceiver.MAX_LENGTH over
+        netstrings). Bigger requests are answered with an INVALID_REQUEST
+        error without being read.
+
+    @ivar maxNestingDepth: Maximum nesting depth (of arrays and objects) of
+        a request, None for no limit. It's checked before the request is
+        decoded, deeper requests are answered with an INVALID_REQUEST error.
+
+    @ivar maxBatchLength: Maximum number of calls in a batch, None for no
+        limit. Longer batches are answered with a single INVALID_REQUEST
+        error.
+
+    @ivar batchWindow: Maximum number of calls of one batch in flight at
+        once, None for no limit. The rest of the batch waits until some of
+        them finish. Calls that finish right away (don't return a Deferred)
+        don't count.
+
+    @ivar incrementalParseSize: Batch requests bigger than this many bytes
+        are decoded incrementally (see jsonrpc.BatchParser), None to always
+        decode requests as a whole. Saves memory with big batches, but
+        a malformed batch is found only when its first calls have already
+        been made.
+
+    @ivar threadedDecodeSize: Requests bigger than this many bytes are
+        decoded in a thread pool rather than in the reactor thread, None to
+        decode all requests in the reactor thread. Results of methods
+        decorated with inThread are always serialized in their thread.
+
+    @ivar threadedEncodeSize: Results estimated to serialize to more than
+        this many bytes (see jsonrpc.exceedsSize) are serialized in a thread
+        pool, None to serialize all of them in the reactor thread. Such
+        results mustn't be modified once the method has returned them.
+
+    @ivar codecThreadPool: Name of the thread pool to decode requests and
+        encode results in, see setThreadPoolSize.
+
+    @ivar streamBatches: If True, responses to calls of a batch are sent as
+        soon as they're ready, rather than all at once when the last call
+        finishes. They're sent in the order the calls finish. See the
+        servers for how they're framed.
+
+    @ivar collectMetrics: If True, keep count of calls, errors and
+        durations of every method, and of sizes of requests and responses.
+        Metrics are shared by all instances of the class, see getMetrics
+        and metrics.MetricsResource.
+
+    @ivar timePhases: If True, measure the time every request spends in
+        each phase of its processing (decoding, calling the methods...)
+        and pass it to requestTimed once the request is finished.
+    """
+
+    codec = None
+    maxConcurrentCalls = None
+    maxQueuedCalls = 0
+    maxRequestSize = None
+    maxNestingDepth = None
+    maxBatchLength = None
+    batchWindow = None
+    streamBatches = False
+    incrementalParseSize = None
+    threadedDecodeSize = None
+    threadedEncodeSize = None
+    codecThreadPool = CODEC_THREAD_POOL
+    collectMetrics = False
+    timePhases = False
+
+    def _getGlobalLimiter(self):
+        """
+        @rtype: limiter.ConcurrencyLimiter
+        @return: The limiter of all calls of our class, None if there's no
+            limit. Created on first use.
+        """
+
+        cls = self.__class__
+        try:
+            return _globalLimiters[cls]
+        except KeyError:
+            if self.maxConcurrentCalls is None:
+                limiter = None
+            else:
+                limiter = ConcurrencyLimiter(self.maxConcurrentCalls,
+                                             self.maxQueuedCalls)
+            _globalLimiters[cls] = limiter
+            return limiter
+
+    def getMetrics(self):
+        """
+        @rtype: metrics.ServerMetrics
+        @return: Metrics of our class, None if collectMetrics is off.
+            Created on first use.
+        """
+
+        if not self.collectMetrics:
+            return None
+
+        cls = self.__class__
+        try:
+            return _serverMetrics[cls]
+        except KeyError:
+            metrics = _serverMetrics[cls] = ServerMetrics()
+            return metrics
+
+    def _observeRequest(self, size):
+        """
+        Count in the size of a request, if we collect metrics.
+
+        @type size: int
+        @param size: Length of the request, in bytes
+        """
+
+        metrics = self.getMetrics()
+        if metrics is not None:
+            metrics.observeRequest(size)
+
+    def _observeResponse(self, size):
+        """
+        Count in the size of a response, if we collect metrics.
+
+        @type size: int
+        @param size: Length of the response, in bytes
+        """
+
+        metrics = self.getMetrics()
+        if metrics is not None:
+            metrics.observeResponse(size)
+
+    def _startTiming(self):
+        """
+        @rtype: metrics.RequestTiming
+        @return: Timing of a request that's just arrived, None if we don't
+            time requests
+        """
+
+        if not self.timePhases:
+            return None
+        return RequestTiming()
+
+    def _finishTiming(self, timing):
+        """
+        The request is finished, report its timing.
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, or None
+        """
+
+        if timing is not None:
+            timing.finish()
+            self.requestTimed(timing)
+
+    def requestTimed(self, timing):
+        """
+        Called with the timing of every request once it's finished, if
+        timePhases is set. Override it to report the timings somewhere, it
+        does nothing by default.
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request
+        """
+
+    def _observeCall(self, result, metrics, request_dict, start):
+        """
+        Count in a finished call. Passes the result through, so it can be
+        used as a callback.
+
+        @type result: mixed
+        @param result: What the method returned, or the exception (or
+            Failure) it failed with
+
+        @type metrics: metrics.ServerMetrics
+        @param metrics: Our metrics
+
+        @type request_dict: dict
+        @param request_dict: The call
+
+        @type start: float
+        @param start: When the call started, by the metrics' clock
+
+        @rtype: mixed
+        @return: result
+        """
+
+        name = None
+        if isinstance(request_dict, dict):
+            name = request_dict.get('method')
+        if (not isinstance(name, basestring) or
+                name not in getMethodTable(self.__class__)):
+            name = metrics.UNKNOWN_METHOD
+
+        if isinstance(result, failure.Failure):
+            error = result.value
+        else:
+            error = result
+
+        error_code = None
+        if isinstance(error, Exception):
+            error_code = getattr(error, 'errno', jsonrpc.INTERNAL_ERROR)
+
+        metrics.observeCall(name, metrics.clock.seconds() - start,
+                            error_code)
+        return result
+
+    def _decodeRequest(self, request_json):
+        """
+        Decode the request. If it's a single call of a method decorated with
+        rawParams, leave the params undecoded.
+
+        @type request_json: str
+        @param request_json: The JSON encoded request
+
+        @rtype: mixed
+        @return: Whatever the client sent, see jsonrpc.decodeRequest.
+
+        @raise JSONRPCError: If there's error in parsing, the request is
+            nested deeper than maxNestingDepth or is a batch longer than
+            maxBatchLength.
+        """
+
+        if self.maxNestingDepth is not None:
+            jsonrpc.checkNestingDepth(request_json, self.maxNestingDepth)
+
+        names = _getRawParamsMethods(self.__class__)
+        if names:
+            for name in names:
+                if '"%s"' % name in request_json:
+                    break
+            else:
+                names = None
+
+        if names:
+            try:
+                request = jsonrpc.decodeRawRequest(request_json, self.codec)
+            except (ValueError, RuntimeError):
+                # A batch or malformed JSON, let decodeRequest handle it.
+                pass
+            else:
+                method = request.get('method')
+                if isinstance(method, types.StringTypes) and method in names:
+                    return request
+
+        request = jsonrpc.decodeRequest(request_json, self.codec)
+        if (self.maxBatchLength is not None and isinstance(request, list) and
+                len(request) > self.maxBatchLength):
+            raise jsonrpc.batchTooLong(self.maxBatchLength)
+        return request
+
+    def _decodeRequestStream(self, stream, size):
+        """
+        Decode the request read from a file. A batch bigger than
+        incrementalParseSize is decoded incrementally, as it's dispatched.
+
+        @type stream: file
+        @param stream: The JSON encoded request, positioned at its start
+
+        @type size: int
+        @param size: Size of the request
+
+        Requests bigger than threadedDecodeSize (and not decoded
+        incrementally) are read and decoded in the thread pool named
+        codecThreadPool.
+
+        @rtype: mixed
+        @return: See _decodeRequest, or a jsonrpc.BatchParser. Or a Deferred
+            firing with it, if it's decoded in a thread.
+
+        @raise JSONRPCError: If there's error in parsing. With incremental
+            decoding, only when iterating over the BatchParser.
+        """
+
+        if (self.incrementalParseSize is not None and
+                size > self.incrementalParseSize):
+            parser = jsonrpc.BatchParser(stream, self.codec,
+                                         self.maxBatchLength,
+                                         maxDepth=self.maxNestingDepth)
+            if parser.isBatch():
+                return parser
+            stream.seek(0, 0)
+
+        if (self.threadedDecodeSize is not None and
+                size > self.threadedDecodeSize):
+            # _decodeRequest needs the method table, build it here rather
+            # than racing the reactor for it in the thread.
+            _getRawParamsMethods(self.__class__)
+            return deferToThreadPool(reactor,
+                                     getThreadPool(self.codecThreadPool),
+                                     self._readRequest, stream)
+
+        return self._readRequest(stream)
+
+    def _readRequest(self, stream):
+        """
+        Read the whole request and decode it, see _decodeRequest.
+        """
+
+        return self._decodeRequest(stream.read())
+
+    def _decodeRequestString(self, request_json):
+        """
+        Decode the request, incrementally or in a thread if it's big enough,
+        see _decodeRequestStream.
+
+        @type request_json: str
+        @param request_json: The JSON encoded request
+
+        @rtype: mixed
+        @return: See _decodeRequestStream
+
+        @raise JSONRPCError: If there's error in parsing.
+        """
+
+        size = len(request_json)
+        if ((self.incrementalParseSize is not None and
+                size > self.incrementalParseSize) or
+                (self.threadedDecodeSize is not None and
+                 size > self.threadedDecodeSize)):
+            return self._decodeRequestStream(StringIO(request_json), size)
+
+        return self._decodeRequest(request_json)
+
+    def _getMethod(self, request_dict):
+        """
+        Find the method to call.
+
+        @type request_dict: dict
+        @param request_dict: Dict with details about the method
+
+        @rtype: ExposedMethod
+        @return: The method
+
+        @raise JSONRPCError: When method not found.
+        """
+
+        name = request_dict['method']
+
+        # A method set on the instance overrides the class's one, like it
+        # would with getattr.
+        function = self.__dict__.get('jsonrpc_%s' % name)
+        if callable(function):
+            return self._getInstanceMethod(name, function)
+
+        try:
+            return getMethodTable(self.__class__)[name]
+        except KeyError:
+            # Might be provided by __getattr__.
+            function = getattr(self, 'jsonrpc_%s' % name, None)
+            if callable(function):
+                return self._getInstanceMethod(name, function)
+
+        msg = 'Method %s not found' % name
+        raise jsonrpc.JSONRPCError(msg, jsonrpc.METHOD_NOT_FOUND,
+                                   id_=request_dict['id'],
+                                   version=request_dict['jsonrpc'])
+
+    def _getInstanceMethod(self, name, function):
+        """
+        ExposedMethod of a method that's not in the class's method table,
+        inspected once per instance, so its cache, limiter etc. are kept
+        between calls. Inspected again if the attribute is replaced.
+
+        @type name: str
+        @param name: Name of the method, without the 'jsonrpc_' prefix
+
+        @type function: callable
+        @param function: The method as found on the instance
+
+        @rtype: ExposedMethod
+        @return: The method
+        """
+
+        try:
+            methods = self.__dict__['_instanceMethods']
+        except KeyError:
+            methods = self.__dict__['_instanceMethods'] = {}
+
+        try:
+            known, method = methods[name]
+        except KeyError:
+            pass
+        else:
+            if known == function:
+                return method
+
+        method = ExposedMethod(name, function)
+        methods[name] = (function, method)
+        return method
+
+    def _invalidParams(self, method, args, kwargs):
+        """
+        Coin the INVALID_PARAMS error for a call the method doesn't accept.
+        The message is the one Python would give us, had we called it.
+
+        @rtype: JSONRPCError
+        @return: The exception to raise
+        """
+
+        function = getattr(self, 'jsonrpc_%s' % method.name)
+        try:
+            inspect.getcallargs(function, *args, **kwargs)
+        except TypeError as e:
+            return jsonrpc.JSONRPCError(str(e), jsonrpc.INVALID_PARAMS)
+
+        return jsonrpc.JSONRPCError('Invalid params', jsonrpc.INVALID_PARAMS)
+
+    def _callMethod(self, request_dict):
+        """
+        Here we actually find and call the method.
+
+        @type request_dict: dict
+        @param request_dict: Dict with details about the method
+
+        @rtype: mixed
+        @return: What the method returned, possibly a Deferred.
+
+        @raise JSONRPCError: When method not found, or it doesn't accept
+            the params.
+        @raise Exception: Whatever the method raised.
+        """
+
+        method = self._getMethod(request_dict)
+        params = request_dict.get('params')
+
+        args = ()
+        kwargs = {}
+        if method.rawParams:
+            if params is None:
+                params = jsonrpc.RawParams('[]', self.codec, [])
+            elif not isinstance(params, jsonrpc.RawParams):
+                params = jsonrpc.RawParams(codec=self.codec, decoded=params)
+            args = (params,)
+
+        elif isinstance(params, dict):
+            kwargs = params
+            if not method.acceptsKeywords(kwargs):
+                raise self._invalidParams(method, args, kwargs)
+
+        else:
+            if params is not None:
+                args = params
+            if not method.acceptsArgs(args):
+                raise self._invalidParams(method, args, kwargs)
+
+        if not method.coalesce:
+            return self._admitCall(method, args, kwargs)
+
+        key = _cacheKey(params)
+        if method.cache is not None:
+            encoded = method.cache.get(key)
+            if encoded is not None:
+                return jsonrpc.RawJSON(encoded)
+
+        if key in method.inFlight:
+            d = Deferred()
+            method.inFlight[key].append(d)
+            return d
+
+        result = self._admitCall(method, args, kwargs)
+        if isinstance(result, Deferred):
+            if method.cache is not None:
+                result.addCallback(self._cacheResult, method.cache, key)
+            method.inFlight[key] = []
+            return result.addBoth(self._shareResult, method, key)
+
+        if method.cache is not None:
+            return self._cacheResult(result, method.cache, key)
+        return result
+
+    def _admitCall(self, method, args, kwargs):
+        """
+        Call the method once the method's limiter and then the global one
+        let us, see limited and maxConcurrentCalls.
+
+        @rtype: mixed
+        @return: What the method returned, possibly a Deferred. A Deferred if
+            the call had to wait.
+
+        @raise OverloadedError: If the call was rejected right away.
+        """
+
+        limiters = [limiter for limiter
+                    in (method.limiter, self._getGlobalLimiter())
+                    if limiter is not None]
+        if not limiters:
+            return self._invokeMethod(method, args, kwargs)
+        return self._invokeLimited(limiters, method, args, kwargs)
+
+    def _invokeLimited(self, limiters, method, args, kwargs):
+        """
+        Take a slot of the first of limiters (waiting for it, if needed),
+        and go on with the rest of them. The slot is released once the call
+        finishes.
+
+        @type limiters: list
+        @param limiters: limiter.ConcurrencyLimiter instances
+
+        @rtype: mixed
+        @return: What the method returned, possibly a Deferred.
+        """
+
+        if not limiters:
+            return self._invokeMethod(method, args, kwargs)
+
+        limiter, rest = limiters[0], limiters[1:]
+
+        if not limiter.tryAcquire():
+            d = limiter.wait()
+            d.addCallback(lambda _: self._invokeLimited(rest, method, args,
+                                                        kwargs))
+            return d.addBoth(self._releaseSlot, limiter)
+
+        try:
+            result = self._invokeLimited(rest, method, args, kwargs)
+        except Exception:
+            limiter.release()
+            raise
+
+        if isinstance(result, Deferred):
+            return result.addBoth(self._releaseSlot, limiter)
+
+        limiter.release()
+        return result
+
+    def _releaseSlot(self, result, limiter):
+        """
+        Callback releasing the call's slot of limiter.
+
+        @rtype: mixed
+        @return: result, unchanged
+        """
+
+        limiter.release()
+        return result
+
+    def _invokeMethod(self, method, args, kwargs):
+        """
+        Call the method with already checked arguments, the way it wants to
+        be called: inline, in a thread or in a worker process.
+
+        @type method: ExposedMethod
+        @param method: The method
+
+        @type args: list
+        @param args: Positional arguments
+
+        @type kwargs: dict
+        @param kwargs: Keyword arguments
+
+        @rtype: mixed
+        @return: What the method returned, possibly a Deferred.
+        """
+
+        if method.processPool is not None:
+            pool = getProcessPool(method.processPool)
+            return pool.callMethod(self.__class__, 'jsonrpc_%s' % method.name,
+                                   args, kwargs, method.rawParams)
+
+        if method.threadPool is not None:
+            function = getattr(self, 'jsonrpc_%s' % method.name)
+            return deferToThreadPool(reactor,
+                                     getThreadPool(method.threadPool),
+                                     self._callAndEncode, function, args,
+                                     kwargs)
+
+        if method.function is not None:
+            return method.function(self, *args, **kwargs)
+
+        function = getattr(self, 'jsonrpc_%s' % method.name)
+        return function(*args, **kwargs)
+
+    def _callAndEncode(self, function, args, kwargs):
+        """
+        Call the function and serialize its result right away. Used in
+        worker threads, so the result isn't serialized in the reactor
+        thread.
+
+        @rtype: mixed
+        @return: The result as jsonrpc.RawJSON. If it cannot be serialized,
+            it's returned as it is, for encodeMethodResponse to report.
+        """
+
+        result = function(*args, **kwargs)
+        if isinstance(result, (jsonrpc.RawJSON, Deferred)):
+            return result
+
+        try:
+            return jsonrpc.RawJSON(jsonrpc.jdumps(result, self.codec))
+        except (TypeError, ValueError):
+            return result
+
+    def _cacheResult(self, result, cache, key):
+        """
+        Serialize the result of a call and store it in the method's cache.
+
+        @type result: mixed
+        @param result: What the method returned
+
+        @type cache: cache.ResultCache
+        @param cache: Cache of the method
+
+        @type key: str
+        @param key: Cache key of the call
+
+        @rtype: mixed
+        @return: The result as jsonrpc.RawJSON, so it's not serialized again.
+            If it cannot be serialized, it's returned as it is.
+        """
+
+        if isinstance(result, jsonrpc.RawJSON):
+            encoded = result.json
+        else:
+            try:
+                encoded = jsonrpc.jdumps(result, self.codec)
+            except (TypeError, ValueError):
+                return result
+
+        cache.set(key, encoded)
+        return jsonrpc.RawJSON(encoded)
+
+    def _shareResult(self, result, method, key):
+        """
+        The call in flight has finished, pass its result (or failure) on to
+        the identical calls that waited for it.
+
+        @type result: mixed
+        @param result: Result of the call, possibly a Failure
+
+        @type method: ExposedMethod
+        @param method: The method called
+
+        @type key: str
+        @param key: Cache key of the call
+
+        @rtype: mixed
+        @return: result, unchanged
+        """
+
+        for d in method.inFlight.pop(key, ()):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+        return result
+
+    def cacheStats(self):
+        """
+        @rtype: dict
+        @return: Method name -> cache statistics (see cache.ResultCache.stats)
+            for every method decorated with cached.
+        """
+
+        return dict((name, method.cache.stats()) for name, method
+                    in getMethodTable(self.__class__).iteritems()
+                    if method.cache is not None)
+
+    def clearCache(self, name=None):
+        """
+        Drop cached results.
+
+        @type name: str
+        @param name: Name of the method whose results to drop. If None, drop
+            results of all methods.
+        """
+
+        for method_name, method in getMethodTable(self.__class__).iteritems():
+            if method.cache is not None and name in (None, method_name):
+                method.cache.clear()
+
+    def limiterStats(self):
+        """
+        @rtype: dict
+        @return: Statistics (see limiter.ConcurrencyLimiter.stats) of the
+            global limiter under 'global' (None if there's no global limit),
+            and of the limited methods under 'methods', by method name.
+        """
+
+        limiter = self._getGlobalLimiter()
+        methods = dict((name, method.limiter.stats()) for name, method
+                       in getMethodTable(self.__class__).iteritems()
+                       if method.limiter is not None)
+
+        return {'global': limiter.stats() if limiter is not None else None,
+                'methods': methods}
+
+    def _dispatchCall(self, request_dict, raiseOverloaded=False,
+                      timing=None):
+        """
+        Verify and call a single method and serialize its response. All of
+        this happens right away, unless the method returns a Deferred.
+
+        @type request_dict: dict
+        @param request_dict: Decoded method call from the client
+
+        @type raiseOverloaded: bool
+        @param raiseOverloaded: If True, a call rejected by a concurrency
+            limit raises OverloadedError instead of being answered with
+            an error response.
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+
+        @rtype: str, None or Deferred
+        @return: Serialized method response, None for a notification. Or
+            a Deferred firing with one of these, if the method returned
+            a Deferred.
+        """
+
+        metrics = self.getMetrics()
+        if metrics is not None:
+            start = metrics.clock.seconds()
+        if timing is not None:
+            timing.calls += 1
+            phase_start = timing.now()
+
+        try:
+            jsonrpc.verifyMethodCall(request_dict)
+            if timing is not None:
+                phase_start = timing.add('verify', phase_start)
+            result = self._callMethod(request_dict)
+        except OverloadedError as e:
+            if raiseOverloaded:
+                if metrics is not None:
+                    self._observeCall(e, metrics, request_dict, start)
+                raise
+            result = e
+        except Exception as e:
+            result = e
+
+        if isinstance(request_dict, dict):
+            id_ = request_dict.get('id')
+            version = request_dict.get('jsonrpc')
+        else:
+            id_ = version = None
+
+        if isinstance(result, Deferred):
+            if metrics is not None:
+                result.addBoth(self._observeCall, metrics, request_dict,
+                               start)
+            if timing is not None:
+                result.addBoth(timing.cbAdd, 'dispatch', phase_start)
+            result.addBoth(self._encodeMethodResponse, id_, version, timing)
+            return result
+
+        if metrics is not None:
+            self._observeCall(result, metrics, request_dict, start)
+        if timing is not None:
+            timing.add('dispatch', phase_start)
+        return self._encodeMethodResponse(result, id_, version, timing)
+
+    def _encodeMethodResponse(self, result, id_, version, timing=None):
+        """
+        Serialize the response to a single call, see
+        jsonrpc.encodeMethodResponse. Big results are serialized in a thread,
+        see threadedEncodeSize.
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+
+        @rtype: str, None or Deferred
+        @return: The response, or a Deferred firing with it if it's
+            serialized in a thread
+        """
+
+        if (self.threadedEncodeSize is not None and id_ is not None and
+                not isinstance(result, (Exception, failure.Failure,
+                                        jsonrpc.RawJSON)) and
+                jsonrpc.exceedsSize(result, self.threadedEncodeSize)):
+            d = deferToThreadPool(reactor,
+                                  getThreadPool(self.codecThreadPool),
+                                  jsonrpc.encodeMethodResponse, result, id_,
+                                  version, self.codec)
+            if timing is not None:
+                d.addBoth(timing.cbAdd, 'encode', timing.now())
+            return d
+
+        if timing is None:
+            return jsonrpc.encodeMethodResponse(result, id_, version,
+                                                self.codec)
+
+        start = timing.now()
+        response = jsonrpc.encodeMethodResponse(result, id_, version,
+                                                self.codec)
+        timing.add('encode', start)
+        return response
+
+    def _streamRequest(self, request_content, write, timing=None):
+        """
+        Dispatch all method calls of the request, passing every serialized
+        response to write as soon as it's ready, in the order they finish
+        (so the client has to match them by id). Respects batchWindow.
+
+        @type request_content: iterable
+        @param request_content: Decoded method calls
+
+        @type write: callable
+        @param write: Called with every serialized response. Not called for
+            notifications.
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+
+        @rtype: Deferred or None
+        @return: None if all calls have already finished, else a Deferred
+            firing once they have.
+
+        @raise JSONRPCError: If an incrementally decoded request turns out to
+            be malformed (or too long). The Deferred fails with it, if we
+            got that far only after some of the calls finished. Responses of
+            the calls before it are still written.
+        """
+
+        batch = _WindowedBatch(self, request_content, self.batchWindow, write,
+                               timing)
+        return self._runBatch(batch)
+
+    def _runBatch(self, batch):
+        """
+        Start the batch and see if it's done right away.
+
+        @type batch: _WindowedBatch
+        @param batch: The batch
+
+        @rtype: mixed
+        @return: What the batch has finished with, or a Deferred firing with
+            it once it has.
+        """
+
+        batch.start()
+        if not batch.done:
+            return batch.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.responses
+
+    def _dispatchRequest(self, request_content, raiseOverloaded=False,
+                         timing=None):
+        """
+        Dispatch all method calls of the request.
+
+        @type request_content: iterable
+        @param request_content: Decoded method calls, a list or
+            a jsonrpc.BatchParser
+
+        @type raiseOverloaded: bool
+        @param raiseOverloaded: See _dispatchCall
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+
+        @rtype: list or Deferred
+        @return: Serialized method responses, in the order of the calls.
+            If any of the methods returned a Deferred, a Deferred firing with
+            the list once they're all finished.
+
+        @raise JSONRPCError: If an incrementally decoded request turns out to
+            be malformed (or too long). The Deferred fails with it, if we
+            got that far only after some of the calls finished. The calls
+            before it are made anyway.
+        """
+
+        if (self.batchWindow is not None and
+                (not isinstance(request_content, list) or
+                 len(request_content) > self.batchWindow)):
+            batch = _WindowedBatch(self, request_content, self.batchWindow,
+                                   timing=timing)
+            return self._runBatch(batch)
+
+        responses = []
+        pending = []
+
+        for request_dict in request_content:
+            response = self._dispatchCall(request_dict, raiseOverloaded,
+                                          timing)
+            if isinstance(response, Deferred):
+                pending.append((len(responses), response))
+                response = None
+            responses.append(response)
+
+        if not pending:
+            return responses
+
+        def store(response, index):
+            responses[index] = response
+
+        dl = []
+        for index, d in pending:
+            d.addCallback(store, index)
+            dl.append(d)
+
+        dl = DeferredList(dl, consumeErrors=True)
+        dl.addCallback(lambda _: responses)
+        return dl
@@ -22,20 +22,8 @@ Provides functions for encoding and decoding the JSON into functions, params
 etc. and other JSON-RPC related stuff like constants.
 """
 
-cjson_loaded = False
-try:
-    import cjson
-    cjson_loaded = True
-except ImportError:
-    try:
-        import json
-    except ImportError:
-        try:
-            import simplejson as json
-        except ImportError:
-            raise ImportError('cjson, json or simplejson required')
-
 import random
+import re
 import types
 from twisted.python.failure import Failure
 
@@ -47,50 +35,354 @@ INVALID_REQUEST = -32600
 METHOD_NOT_FOUND = -32601
 INVALID_PARAMS = -32602
 INTERNAL_ERROR = -32603
+SERVER_OVERLOADED = -32000
+
+BATCH_CHUNK_SIZE = 2 ** 16
 
 ID_MIN = 1
 ID_MAX = 2 ** 31 - 1  # 32-bit maxint
 
 
-def jdumps(obj):
+class JSONCodec(object):
+    """
+    A pair of JSON encoding and decoding functions, registered under a name.
+    Servers and proxies pick one of these by name (or take an instance), so
+    the JSON library is no longer fixed at import time.
+    """
+
+    def __init__(self, name, dumps, loads, errors=()):
+        """
+        @type name: str
+        @param name: Name the codec is registered under, e.g. 'json'
+
+        @type dumps: callable
+        @param dumps: Function taking an object and returning its JSON
+
+        @type loads: callable
+        @param loads: Function taking JSON and returning the decoded object
+
+        @type errors: tuple
+        @param errors: Library specific exceptions that should be translated
+            to ValueError, so callers can catch a single exception type.
+        """
+
+        self.name = name
+        self._dumps = dumps
+        self._loads = loads
+        self._errors = tuple(errors)
+
+    def dumps(self, obj):
+        """
+        @type obj: mixed
+        @param obj: Whatever we want to encode
+
+        @rtype: str
+        @return: JSON representation of obj
+
+        @raise ValueError: If obj cannot be encoded
+        """
+
+        try:
+            return self._dumps(obj)
+        except self._errors as e:
+            raise ValueError(str(e))
+
+    def loads(self, json_string):
+        """
+        @type json_string: str
+        @param json_string: JSON to be decoded
+
+        @rtype: mixed
+        @return: Whatever the JSON contained
+
+        @raise ValueError: If json_string is not valid JSON
+        """
+
+        try:
+            return self._loads(json_string)
+        except self._errors as e:
+            raise ValueError(str(e))
+
+    def __repr__(self):
+        return '<JSONCodec %s>' % self.name
+
+
+_codecs = {}
+_defaultCodec = None
+
+
+def registerCodec(codec, default=False):
+    """
+    Make a codec available to servers and proxies by its name.
+
+    @type codec: JSONCodec
+    @param codec: The codec to register. Replaces any codec registered under
+        the same name.
+
+    @type default: bool
+    @param default: If True, use this codec whenever none is specified.
+    """
+
+    global _defaultCodec
+
+    _codecs[codec.name] = codec
+    if default or _defaultCodec is None:
+        _defaultCodec = codec
+
+
+def getCodec(codec=None):
+    """
+    Resolve a codec specification to a JSONCodec.
+
+    @type codec: JSONCodec, str or None
+    @param codec: Codec instance, name of a registered codec, or None for
+        the default one.
+
+    @rtype: JSONCodec
+    @return: The codec to use
+
+    @raise ValueError: If there's no codec registered under given name.
+    """
+
+    if codec is None:
+        return _defaultCodec
+    if isinstance(codec, JSONCodec):
+        return codec
+
+    try:
+        return _codecs[codec]
+    except KeyError:
+        raise ValueError('Unknown JSON codec: %s' % codec)
+
+
+def availableCodecs():
+    """
+    @rtype: list
+    @return: Names of all registered codecs, sorted
+    """
+
+    return sorted(_codecs)
+
+
+def _registerAvailableCodecs():
+    """
+    Register a codec for every JSON library we can import. The default is
+    chosen in the same order we've always probed: cjson, json, simplejson.
+    """
+
+    try:
+        import cjson
+        registerCodec(JSONCodec('cjson', cjson.encode, cjson.decode,
+                                (cjson.EncodeError, cjson.DecodeError)))
+    except ImportError:
+        pass
+
+    try:
+        import json
+        registerCodec(JSONCodec('json', json.dumps, json.loads))
+    except ImportError:
+        pass
+
+    try:
+        import simplejson
+        registerCodec(JSONCodec('simplejson', simplejson.dumps,
+                                simplejson.loads))
+    except ImportError:
+        pass
+
+    try:
+        import ujson
+        registerCodec(JSONCodec('ujson', ujson.dumps, ujson.loads))
+    except ImportError:
+        pass
+
+    try:
+        import orjson
+        registerCodec(JSONCodec('orjson', orjson.dumps, orjson.loads,
+                                (orjson.JSONEncodeError,)))
+    except ImportError:
+        pass
+
+    if _defaultCodec is None:
+        raise ImportError('cjson, json or simplejson required')
+
+_registerAvailableCodecs()
+
+# Kept for backwards compatibility, the default codec is what matters now.
+cjson_loaded = _defaultCodec.name == 'cjson'
+
+
+def jdumps(obj, codec=None):
     """
     Encode JSON no matter what library did we import
 
     @type obj: mixed
     @param obj: Whatever we want to encode
 
+    @type codec: JSONCodec, str or None
+    @param codec: Codec to use, see getCodec. Defaults to the default codec.
+
     @rtype: str
     @return: JSON representation of obj
     """
-    if cjson_loaded:
-        try:
-            return cjson.encode(obj)
-        except cjson.EncodeError as e:
-            raise ValueError(str(e))
-    else:
-        return json.dumps(obj)
+    return getCodec(codec).dumps(obj)
 
 
-def jloads(json_string):
+def jloads(json_string, codec=None):
     """
     Decode JSON no matter what library did we import
 
     @type json_string: str
     @param json_string: JSON to be decoded
 
+    @type codec: JSONCodec, str or None
+    @param codec: Codec to use, see getCodec. Defaults to the default codec.
+
     @rtype: mixed
     @return: Whatever the JSON contained
     """
-    if cjson_loaded:
-        try:
-            return cjson.decode(json_string)
-        except cjson.DecodeError as e:
-            raise ValueError(str(e))
-    else:
-        return json.loads(json_string)
+    return getCodec(codec).loads(json_string)
 
 
-def encodeRequest(method, args=None, id_=0, version=VERSION_1):
+def exceedsSize(obj, size):
+    """
+    Estimate whether obj serializes to more than size bytes, without
+    serializing it. The estimate is a rough lower bound, and obj is walked
+    only until it exceeds size, so the check costs about as much as walking
+    size bytes worth of obj at most.
+
+    @type obj: mixed
+    @param obj: Plain value (dicts, lists, strings, numbers...)
+
+    @type size: int
+    @param size: Size in bytes
+
+    @rtype: bool
+    @return: True if obj is estimated to be longer than size when serialized
+    """
+
+    total = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, basestring):
+            total += len(obj) + 2
+        elif isinstance(obj, dict):
+            # braces, colons and commas
+            total += 2 + 2 * len(obj)
+            if total > size:
+                return True
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple)):
+            total += 2 + len(obj)
+            if total > size:
+                return True
+            stack.extend(obj)
+        elif isinstance(obj, RawJSON):
+            total += len(obj.json)
+        else:
+            # numbers, true, false, null
+            total += 4
+
+        if total > size:
+            return True
+
+    return False
+
+
+class RawJSON(object):
+    """
+    Already serialized JSON. Return an instance of this from a jsonrpc_
+    method and the server puts the JSON into the response as it is, without
+    decoding and re-encoding it. Useful for data we already hold as JSON,
+    e.g. from a cache or a database column.
+
+    Nobody checks the JSON is valid, that's up to whoever creates this.
+    """
+
+    __slots__ = ('json',)
+
+    def __init__(self, json):
+        """
+        @type json: str|unicode
+        @param json: The serialized JSON value. Unicode gets UTF-8 encoded.
+        """
+
+        if isinstance(json, unicode):
+            json = json.encode('utf-8')
+        self.json = json
+
+    def __eq__(self, other):
+        return isinstance(other, RawJSON) and self.json == other.json
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'RawJSON(%r)' % self.json
+
+
+class RawParams(object):
+    """
+    Params of a method call, not decoded until somebody asks for them.
+    Methods decorated with dispatch.rawParams get these instead of the
+    decoded arguments.
+    """
+
+    def __init__(self, json=None, codec=None, decoded=None):
+        """
+        Pass either the serialized params (json), or the already decoded ones
+        (decoded), e.g. if the whole request had to be decoded anyway.
+
+        @type json: str
+        @param json: Params as they came in the request
+
+        @type codec: JSONCodec, str or None
+        @param codec: Codec to decode (or encode) the params with
+
+        @type decoded: list|dict
+        @param decoded: Already decoded params
+        """
+
+        self._json = json
+        self._decoded = decoded
+        self.codec = codec
+
+    @property
+    def json(self):
+        """
+        Params serialized as JSON. Encoded on demand if we only have the
+        decoded ones.
+        """
+
+        if self._json is None:
+            self._json = jdumps(self._decoded, self.codec)
+        return self._json
+
+    def decode(self):
+        """
+        @rtype: list|dict
+        @return: Decoded params. They're decoded only once.
+
+        @raise JSONRPCError: If the params are not valid JSON.
+        """
+
+        if self._decoded is None:
+            try:
+                self._decoded = jloads(self._json, self.codec)
+            except ValueError:
+                raise JSONRPCError('Failed to parse params', INVALID_PARAMS)
+        return self._decoded
+
+    def __len__(self):
+        return len(self.json)
+
+    def __repr__(self):
+        return '<RawParams %d bytes>' % len(self)
+
+
+def encodeRequest(method, args=None, id_=0, version=VERSION_1, codec=None):
     """
     Return a JSON object representation of the request.
 
@@ -108,6 +400,9 @@ def encodeRequest(method, args=None, id_=0, version=VERSION_1):
     @type version: float
     @param version: Which JSON-RPC version to use? Defaults to version 1.
 
+    @type codec: JSONCodec, str or None
+    @param codec: JSON codec to encode the request with
+
     @rtype: str
     @return: JSON representation of the request
     @TODO support batch requests
@@ -127,10 +422,10 @@ def encodeRequest(method, args=None, id_=0, version=VERSION_1):
     if version == VERSION_2:
         request['jsonrpc'] = '2.0'
 
-    return jdumps(request)
+    return jdumps(request, codec)
 
 
-def decodeResponse(json_response):
+def decodeResponse(json_response, codec=None, id_=None):
     """
     Parse the response JSON and return what the called function returned. Raise
     an exception in the case there was an error.
@@ -138,14 +433,50 @@ def decodeResponse(json_response):
     @type json_response: str
     @param json_response: JSON from the server
 
+    @type codec: JSONCodec, str or None
+    @param codec: JSON codec to decode the response with
+
+    @type id_: int or None
+    @param id_: Id of the request, to check the response belongs to it. If
+        None, we don't check.
+
     @rtype: mixed
     @return: What the function returned
 
-    @raise ValueError: If the response is not valid JSON-RPC response.
+    @raise ValueError: If the response is not valid JSON-RPC response, or a
+        response to another request.
     @TODO support batch requests
     """
 
-    response = jloads(json_response)
+    return resultFromResponse(jloads(json_response, codec), id_)
+
+
+def resultFromResponse(response, id_=None):
+    """
+    Return what the called function returned, given an already decoded
+    response. Raise an exception in the case there was an error.
+
+    @type response: dict
+    @param response: Decoded response from the server
+
+    @type id_: int or None
+    @param id_: Id of the request, see decodeResponse
+
+    @rtype: mixed
+    @return: What the function returned
+
+    @raise ValueError: If the response is not valid JSON-RPC response, or a
+        response to another request.
+    """
+
+    if not isinstance(response, dict):
+        raise ValueError('Not a valid JSON-RPC response')
+
+    if id_ is not None and response.get('id') != id_:
+        # the server answers with null id if it can't read the request's id
+        if response.get('id') is not None or not response.get('error'):
+            raise ValueError('Response id %r does not match request id %r'
+                             % (response.get('id'), id_))
 
     if 'jsonrpc' in response and response['jsonrpc'] == "2.0":
         if 'result' in response and 'error' in response:
@@ -173,29 +504,542 @@ def decodeResponse(json_response):
     raise ValueError('Not a valid JSON-RPC response')
 
 
-def decodeRequest(request):
+class IdAllocator(object):
+    """
+    Coins ids of the requests of one proxy. Counts up from ID_MIN, which is
+    cheaper than random ids and can't collide: ids of calls still waiting
+    for their responses are skipped when the counter wraps around.
+
+    @ivar outstanding: Ids given away and not released yet
+    """
+
+    def __init__(self, start=ID_MIN):
+        """
+        @type start: int
+        @param start: First id to give away
+        """
+
+        self._next = start
+        self.outstanding = set()
+
+    def allocate(self):
+        """
+        @rtype: int
+        @return: An id no outstanding call has. Release it once the response
+            is in.
+        """
+
+        while True:
+            id_ = self._next
+            if id_ < ID_MAX:
+                self._next = id_ + 1
+            else:
+                self._next = ID_MIN
+
+            if id_ not in self.outstanding:
+                self.outstanding.add(id_)
+                return id_
+
+    def release(self, id_):
+        """
+        @type id_: int
+        @param id_: Id from allocate, free to be given away again
+        """
+
+        self.outstanding.discard(id_)
+
+
+class InFlightCalls(object):
+    """
+    Calls sent over a connection and waiting for their responses, by id, so
+    responses can be routed to their calls in whatever order they come.
+    """
+
+    def __init__(self, ids=None):
+        """
+        @type ids: IdAllocator
+        @param ids: Allocator to take the ids from. Share one between the
+            connections of a proxy to keep ids unique across all of them.
+        """
+
+        if ids is None:
+            ids = IdAllocator()
+        self.ids = ids
+        self._calls = {}
+
+    def add(self, call):
+        """
+        @type call: mixed
+        @param call: What to route the response to, e.g. a Deferred
+
+        @rtype: int
+        @return: Id to send the call with
+        """
+
+        id_ = self.ids.allocate()
+        self._calls[id_] = call
+        return id_
+
+    def pop(self, id_):
+        """
+        @type id_: mixed
+        @param id_: Id of a response
+
+        @rtype: mixed
+        @return: The call with given id, or None if there's no such call in
+            flight. Either way the id is forgotten.
+        """
+
+        try:
+            call = self._calls.pop(id_, None)
+        except TypeError:
+            # unhashable id, can't be one of ours
+            return None
+
+        if call is not None:
+            self.ids.release(id_)
+        return call
+
+    def popAll(self):
+        """
+        @rtype: list
+        @return: All calls in flight, e.g. to fail them when the connection
+            is lost. They're forgotten.
+        """
+
+        calls, self._calls = self._calls, {}
+        for id_ in calls:
+            self.ids.release(id_)
+        return calls.values()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, id_):
+        return id_ in self._calls
+
+
+def decodeRequest(request, codec=None):
     """
     Decodes the JSON encoded request.
 
     @type request: str
     @param request: The JSON encoded request
 
+    @type codec: JSONCodec, str or None
+    @param codec: JSON codec to decode the request with
+
     @rtype: mixed
     @return: Whatever the client sent, most probably a list (in the case of
         a batch request) or dict (in the case of a single method call).
 
     @raise JSONRPCError: If there's error in parsing.
-    @TODO if cjson_loaded catch cjson.DecodeError
     """
 
     try:
-        decoded = jloads(request)
-    except ValueError:
+        decoded = jloads(request, codec)
+    except (ValueError, RuntimeError):
+        # RuntimeError: nested too deep for the decoder's recursion
         raise JSONRPCError('Failed to parse JSON', PARSE_ERROR)
 
     return decoded
 
 
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+_CONTAINER_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]')
+_SCALAR = re.compile(r'[^,:\[\]{}\s"]+')
+# Everything up to the next bracket outside of strings, and the bracket (in
+# group 1 if it opens a container, in group 2 if it closes one). Short
+# strings without escapes are skipped on the way, any other string stops
+# the match at its opening quote, see _skipString.
+_TO_BRACKET = re.compile(r'[^"\[\]{}]*'
+                         r'(?:"[^"\\]{0,256}"[^"\[\]{}]*)*'
+                         r'(?:([\[{])|([\]}])|")')
+
+
+def _skipString(string, pos):
+    """
+    Find where the JSON string starting at pos ends. The closing quote is
+    looked up by str.find, which is much faster on long strings (documents,
+    base64 data) than any regular expression.
+
+    @rtype: int
+    @return: Position right after the string
+
+    @raise ValueError: If there's no complete string at pos.
+    """
+
+    end = string.find('"', pos + 1)
+    if end != -1 and string[end - 1] != '\\':
+        return end + 1
+
+    # escaped quotes, leave them to the regular expression
+    match = _STRING.match(string, pos)
+    if match:
+        return match.end()
+
+    raise ValueError('No JSON string at %d' % pos)
+
+
+def _skipValue(string, pos):
+    """
+    Find where the JSON value starting at pos ends, without decoding it.
+    Strings are skipped as a whole, so brackets inside them don't count.
+
+    This is done in Python, one step per bracket and per long string, so it
+    saves time only if the value is mostly long strings. Otherwise it costs
+    about as much as decoding the value with the json module.
+
+    @rtype: int
+    @return: Position right after the value
+
+    @raise ValueError: If there's no complete value at pos.
+    """
+
+    char = string[pos:pos + 1]
+
+    if char == '"':
+        return _skipString(string, pos)
+
+    elif char == '{' or char == '[':
+        depth = 0
+        match = _TO_BRACKET.match(string, pos)
+        while match:
+            if match.lastindex == 1:
+                depth += 1
+                pos = match.end()
+            elif match.lastindex == 2:
+                depth -= 1
+                pos = match.end()
+                if depth == 0:
+                    return pos
+            else:
+                pos = _skipString(string, match.end() - 1)
+            match = _TO_BRACKET.match(string, pos)
+
+    else:
+        match = _SCALAR.match(string, pos)
+        if match:
+            return match.end()
+
+    raise ValueError('No JSON value at %d' % pos)
+
+
+def splitObject(string):
+    """
+    Split a serialized JSON object into its members, without decoding the
+    values.
+
+    @type string: str
+    @param string: Serialized JSON object
+
+    @rtype: dict
+    @return: Member name -> serialized value
+
+    @raise ValueError: If string doesn't look like a JSON object.
+    """
+
+    members = {}
+
+    pos = _WHITESPACE.match(string).end()
+    if string[pos:pos + 1] != '{':
+        raise ValueError('Not a JSON object')
+    pos = _WHITESPACE.match(string, pos + 1).end()
+
+    if string[pos:pos + 1] == '}':
+        pos = _WHITESPACE.match(string, pos + 1).end()
+        if pos != len(string):
+            raise ValueError('Extra data after JSON object')
+        return members
+
+    while True:
+        match = _STRING.match(string, pos)
+        if not match:
+            raise ValueError('Expected member name at %d' % pos)
+        name = jloads(match.group())
+
+        pos = _WHITESPACE.match(string, match.end()).end()
+        if string[pos:pos + 1] != ':':
+            raise ValueError('Expected \':\' at %d' % pos)
+        pos = _WHITESPACE.match(string, pos + 1).end()
+
+        end = _skipValue(string, pos)
+        members[name] = string[pos:end]
+
+        pos = _WHITESPACE.match(string, end).end()
+        char = string[pos:pos + 1]
+        if char != ',' and char != '}':
+            raise ValueError('Expected \',\' or \'}\' at %d' % pos)
+
+        pos = _WHITESPACE.match(string, pos + 1).end()
+        if char == '}':
+            if pos != len(string):
+                raise ValueError('Extra data after JSON object')
+            return members
+
+
+def decodeRawRequest(request, codec=None):
+    """
+    Decode a single method call, except for its params, which are returned
+    as RawParams.
+
+    @type request: str
+    @param request: The JSON encoded request
+
+    @type codec: JSONCodec, str or None
+    @param codec: JSON codec to decode the request with
+
+    @rtype: dict
+    @return: Decoded request, with RawParams in 'params' if there are any.
+
+    @raise ValueError: If the request is not a single JSON object, or is
+        malformed.
+    """
+
+    decoded = {}
+
+    for name, value in splitObject(request).iteritems():
+        if name == 'params' and value[:1] in ('[', '{'):
+            decoded[name] = RawParams(value, codec)
+        else:
+            decoded[name] = jloads(value, codec)
+
+    return decoded
+
+
+def batchTooLong(maxLength):
+    """
+    @type maxLength: int
+    @param maxLength: Maximum number of calls in a batch
+
+    @rtype: JSONRPCError
+    @return: The error to reject a longer batch with
+    """
+
+    msg = 'Batch too long, at most %d calls allowed' % maxLength
+    return JSONRPCError(msg, INVALID_REQUEST)
+
+
+def requestTooLarge(maxSize):
+    """
+    @type maxSize: int
+    @param maxSize: Maximum size of a request in bytes
+
+    @rtype: JSONRPCError
+    @return: The error to reject a bigger request with
+    """
+
+    msg = 'Request too large, at most %d bytes allowed' % maxSize
+    return JSONRPCError(msg, INVALID_REQUEST)
+
+
+def checkNestingDepth(string, maxDepth, start=0, end=None):
+    """
+    Make sure the serialized JSON is nested at most maxDepth levels deep
+    (arrays and objects), without decoding it. Brackets inside strings
+    don't count.
+
+    @type string: str
+    @param string: Serialized JSON
+
+    @type maxDepth: int
+    @param maxDepth: Maximum depth, a scalar has depth 0
+
+    @type start: int
+    @param start: Where the JSON starts in string
+
+    @type end: int
+    @param end: Where the JSON ends in string, None for its end
+
+    @raise JSONRPCError: If it's nested deeper.
+    """
+
+    depth = 0
+    if end is None:
+        end = len(string)
+
+    for match in _CONTAINER_TOKEN.finditer(string, start, end):
+        token = match.group()
+        if token == '{' or token == '[':
+            depth += 1
+            if depth > maxDepth:
+                msg = 'Request nested too deep, at most %d levels ' \
+                      'allowed' % maxDepth
+                raise JSONRPCError(msg, INVALID_REQUEST)
+        elif token == '}' or token == ']':
+            depth -= 1
+
+
+class BatchParser(object):
+    """
+    Incremental decoder of a batch request. Reads the request from a file
+    in chunks and yields the method calls one by one as it's iterated over,
+    so only about one call is held in memory (decoded or not) at a time, and
+    the first calls can be dispatched before the last ones are decoded.
+
+    Unlike decodeRequest, it finds a malformed request only when it gets to
+    the malformed part.
+    """
+
+    def __init__(self, stream, codec=None, maxLength=None,
+                 chunkSize=BATCH_CHUNK_SIZE, maxDepth=None):
+        """
+        @type stream: file
+        @param stream: The JSON encoded request, positioned at its start
+
+        @type codec: JSONCodec, str or None
+        @param codec: JSON codec to decode the calls with
+
+        @type maxLength: int
+        @param maxLength: Maximum number of calls, None for no limit
+
+        @type maxDepth: int
+        @param maxDepth: Maximum nesting depth of the request (including
+            the batch array), see checkNestingDepth. None for no limit.
+
+        @type chunkSize: int
+        @param chunkSize: How much of the request to read at once
+        """
+
+        self.stream = stream
+        self.codec = getCodec(codec)
+        self.maxLength = maxLength
+        self.chunkSize = chunkSize
+        self.maxDepth = maxDepth
+
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _read(self, size):
+        """
+        Read more of the request, dropping what we've already parsed.
+
+        @rtype: bool
+        @return: False at the end of the request
+        """
+
+        chunk = self.stream.read(size)
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        if not chunk:
+            self._eof = True
+        return not self._eof
+
+    def _peek(self):
+        """
+        Skip whitespace.
+
+        @rtype: str
+        @return: The next character, '' at the end of the request
+        """
+
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._read(self.chunkSize):
+                return self._buffer[self._pos:self._pos + 1]
+
+    def _expect(self, chars):
+        """
+        Consume the next character, which has to be one of chars.
+
+        @rtype: str
+        @return: The character
+
+        @raise JSONRPCError: If it isn't.
+        """
+
+        char = self._peek()
+        if not char or char not in chars:
+            raise JSONRPCError('Failed to parse JSON', PARSE_ERROR)
+        self._pos += 1
+        return char
+
+    def _nextValue(self):
+        """
+        Consume the next value, reading as much of the request as it takes.
+        Each retry reads at least as much as we already have, so a big value
+        gets scanned only a few times.
+
+        @rtype: str
+        @return: The serialized value
+
+        @raise JSONRPCError: If there's no complete value, or it's nested too
+            deep.
+        """
+
+        self._peek()
+        while True:
+            try:
+                end = _skipValue(self._buffer, self._pos)
+            except ValueError:
+                end = None
+
+            # A scalar ending with the buffer might go on in the next chunk.
+            if end is not None and (end < len(self._buffer) or self._eof):
+                if self.maxDepth is not None:
+                    checkNestingDepth(self._buffer, self.maxDepth - 1,
+                                      self._pos, end)
+                value = self._buffer[self._pos:end]
+                self._pos = end
+                return value
+
+            if not self._read(max(self.chunkSize, len(self._buffer))):
+                if end is None:
+                    raise JSONRPCError('Failed to parse JSON', PARSE_ERROR)
+
+    def isBatch(self):
+        """
+        @rtype: bool
+        @return: True if the request looks like a batch, i.e. a JSON array
+        """
+
+        return self._peek() == '['
+
+    def __iter__(self):
+        """
+        @rtype: iterator
+        @return: Decoded method calls
+
+        @raise JSONRPCError: When iterating, if the request is malformed,
+            has more than maxLength calls or is nested deeper than maxDepth.
+        """
+
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            self._expectEnd()
+            return
+
+        count = 0
+        while True:
+            count += 1
+            if self.maxLength is not None and count > self.maxLength:
+                raise batchTooLong(self.maxLength)
+
+            value = self._nextValue()
+            try:
+                call = self.codec.loads(value)
+            except (ValueError, RuntimeError):
+                # RuntimeError: nested too deep for the decoder's recursion
+                raise JSONRPCError('Failed to parse JSON', PARSE_ERROR)
+
+            yield call
+
+            if self._expect(',]') == ']':
+                self._expectEnd()
+                return
+
+    def _expectEnd(self):
+        """
+        @raise JSONRPCError: If there's anything but whitespace left.
+        """
+
+        if self._peek():
+            raise JSONRPCError('Failed to parse JSON', PARSE_ERROR)
+
+
 def verifyMethodCall(request):
     """
     Verifies a single method call. We call this for every method in case of a
@@ -233,7 +1077,7 @@ def verifyMethodCall(request):
         if ('params' in request and
                 not isinstance(request['params'],
                                (types.ListType, types.TupleType,
-                                types.DictType))):
+                                types.DictType, RawParams))):
             raise JSONRPCError('Invalid params type', INVALID_REQUEST)
 
         return request
@@ -269,13 +1113,10 @@ def _getErrorResponse(exception):
     except AttributeError:
         error_result['message'] = str(exception)
 
-    if isinstance(exception, TypeError):
-        error_result['code'] = INVALID_PARAMS
-    else:
-        try:
-            error_result['code'] = exception.errno
-        except AttributeError:
-            error_result['code'] = INTERNAL_ERROR
+    try:
+        error_result['code'] = exception.errno
+    except AttributeError:
+        error_result['code'] = INTERNAL_ERROR
 
     try:
         if exception.data is not None:
@@ -310,6 +1151,10 @@ def prepareMethodResponse(result, id_=None, version=VERSION_1):
     if isinstance(result, Failure):
         result = result.value
 
+    if isinstance(result, RawJSON):
+        # the dict is going to be serialized as a whole
+        result = jloads(result.json)
+
     if isinstance(result, Exception):
         error_result = _getErrorResponse(result)
     else:
@@ -333,7 +1178,7 @@ def prepareMethodResponse(result, id_=None, version=VERSION_1):
     return response
 
 
-def prepareCallResponse(result):
+def prepareCallResponse(result, codec=None):
     """
     Prepare the response to the 'whole' call, be it a single method or a batch
     request.
@@ -341,24 +1186,143 @@ def prepareCallResponse(result):
     @type result: mixed
     @param result: What we want to return to the client
 
+    @type codec: JSONCodec, str or None
+    @param codec: JSON codec to encode the response with
+
     @rtype: str
     @return: Serialized result
     """
-    return jdumps(result)
+    return jdumps(result, codec)
+
+
+# Response envelopes with the result (or error) and id spliced in. The member
+# order is the one our responses have always had.
+_RESULT_V1 = '{"error": null, "id": %s, "result": %s}'
+_RESULT_V2 = '{"jsonrpc": "2.0", "id": %s, "result": %s}'
+_ERROR_V1 = '{"result": null, "id": %s, "error": %s}'
+_ERROR_V2 = '{"jsonrpc": "2.0", "id": %s, "error": %s}'
+
+
+def encodeMethodResponse(result, id_=None, version=VERSION_1, codec=None):
+    """
+    Serialize the response to a single method call. Equivalent to
+    serializing what prepareMethodResponse returns, but only the result (or
+    error) and id get encoded, the rest of the envelope is a constant.
 
+    A RawJSON result is spliced in as it is. If the result cannot be
+    serialized, an INTERNAL_ERROR response is returned instead, so one bad
+    result doesn't break a whole batch.
 
-def parseError():
+    @type result: mixed
+    @param result: What the called function returned. Might be a Failure!
+
+    @type id_: int
+    @param id_: the request id
+
+    @type version: float
+    @param version: JSON-RPC version
+
+    @type codec: JSONCodec, str or None
+    @param codec: JSON codec to encode the response with
+
+    @rtype: str
+    @return: JSON-encoded response, None in case of a notification
+    """
+
+    if id_ is None:
+        # notification
+        return None
+
+    codec = getCodec(codec)
+
+    if isinstance(result, Failure):
+        result = result.value
+
+    if isinstance(result, RawJSON):
+        encoded = result.json
+    elif not isinstance(result, Exception):
+        try:
+            encoded = codec.dumps(result)
+        except (TypeError, ValueError) as e:
+            result = JSONRPCError('Cannot serialize result: %s' % e,
+                                  INTERNAL_ERROR)
+
+    if not isinstance(result, Exception):
+        if version == VERSION_2:
+            return _RESULT_V2 % (codec.dumps(id_), encoded)
+        return _RESULT_V1 % (codec.dumps(id_), encoded)
+
+    encoded = codec.dumps(_getErrorResponse(result))
+    if version == VERSION_2:
+        return _ERROR_V2 % (codec.dumps(id_), encoded)
+    return _ERROR_V1 % (codec.dumps(id_), encoded)
+
+
+def encodeCallResponse(method_responses, is_batch=True):
+    """
+    Join already serialized method responses into the response to the
+    'whole' call, without decoding or re-encoding them.
+
+    @type method_responses: list
+    @param method_responses: Serialized method responses, as returned by
+        encodeMethodResponse. None (notifications) are skipped.
+
+    @type is_batch: bool
+    @param is_batch: True if the request was a batch. If it wasn't, the single
+        method response is returned as it is.
+
+    @rtype: str
+    @return: Serialized response
+    """
+
+    method_responses = [response for response in method_responses
+                        if response is not None]
+
+    if not is_batch and len(method_responses) == 1:
+        return method_responses[0]
+
+    return '[' + ', '.join(method_responses) + ']'
+
+
+def parseError(codec=None):
     """
     Coin 'parse error' response. Since we don't know id, default to NULL. And
     since we don't know jsonrpc version, default to '2.0', given that V1 spec
     doesn't cover parse errors.
 
+    @type codec: JSONCodec, str or None
+    @param codec: JSON codec to encode the response with
+
     @rtype: str
     @return: Serialized message informing that there was a parse error.
     """
     response = {'jsonrpc': '2.0', 'id': None, 'error':
                 {'code': PARSE_ERROR, 'message': 'Parse error'}}
-    return jdumps(response)
+    return jdumps(response, codec)
+
+
+def requestError(error, codec=None):
+    """
+    Coin response to a request that can't be dispatched at all, e.g. a batch
+    that is too long. Like with parse errors, id is NULL and jsonrpc version
+    '2.0'. Parse errors get the response of parseError.
+
+    @type error: Exception
+    @param error: What's wrong with the request
+
+    @type codec: JSONCodec, str or None
+    @param codec: JSON codec to encode the response with
+
+    @rtype: str
+    @return: Serialized error response
+    """
+
+    if getattr(error, 'errno', None) == PARSE_ERROR:
+        return parseError(codec)
+
+    response = {'jsonrpc': '2.0', 'id': None,
+                'error': _getErrorResponse(error)}
+    return jdumps(response, codec)
 
 
 class JSONRPCError(Exception):
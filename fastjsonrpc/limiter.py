@@ -0,0 +1,168 @@
+"""
+Copyright 2012 Tadeas Moravec
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+
+==================
+Concurrency limits
+==================
+
+Provides ConcurrencyLimiter, which caps the number of calls in flight and
+keeps a bounded queue of calls waiting for a free slot. Used by the
+dispatcher for per-method (see dispatch.limited) and per-server (see
+JSONRPCDispatcher.maxConcurrentCalls) limits.
+"""
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+import jsonrpc
+
+
+class OverloadedError(jsonrpc.JSONRPCError):
+    """
+    Raised when a call can be neither started nor queued. The HTTP server
+    answers single calls rejected this way with 503 Service Unavailable.
+    """
+
+    def __init__(self, strerror='Server overloaded',
+                 errno=jsonrpc.SERVER_OVERLOADED, *args, **kwargs):
+        jsonrpc.JSONRPCError.__init__(self, strerror, errno, *args, **kwargs)
+
+
+class ConcurrencyLimiter(object):
+    """
+    At most maxConcurrent calls run at once, at most maxQueued more wait for
+    their turn (first come, first served), the rest is rejected right away.
+
+    A call takes a slot either by tryAcquire (when one is free) or by wait,
+    and gives it back by release.
+    """
+
+    def __init__(self, maxConcurrent, maxQueued=0, clock=None):
+        """
+        @type maxConcurrent: int
+        @param maxConcurrent: Maximum number of calls in flight
+
+        @type maxQueued: int
+        @param maxQueued: Maximum number of calls waiting for a slot. If
+            None, the queue is unbounded.
+
+        @type clock: t.i.interfaces.IReactorTime
+        @param clock: Source of time for wait times, the reactor by default
+        """
+
+        self.maxConcurrent = maxConcurrent
+        self.maxQueued = maxQueued
+        self.clock = clock or reactor
+
+        self.inFlight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.waited = 0
+        self.waitTime = 0.0
+        self.maxWaitTime = 0.0
+
+        self._queue = deque()
+        self._released = 0
+        self._releasing = False
+
+    def tryAcquire(self):
+        """
+        Take a slot if one is free and nobody's waiting for it.
+
+        @rtype: bool
+        @return: True if we've got the slot
+        """
+
+        if self.inFlight < self.maxConcurrent and not self._queue:
+            self.inFlight += 1
+            self.admitted += 1
+            return True
+        return False
+
+    def wait(self):
+        """
+        Queue up for a slot.
+
+        @rtype: Deferred
+        @return: Deferred firing (with None) when we've got the slot
+
+        @raise OverloadedError: If the queue is full.
+        """
+
+        if self.maxQueued is not None and len(self._queue) >= self.maxQueued:
+            self.rejected += 1
+            raise OverloadedError()
+
+        d = Deferred()
+        self._queue.append((self.clock.seconds(), d))
+        return d
+
+    def release(self):
+        """
+        Give back a slot, passing it on to the first call waiting, if any.
+
+        A call that got the slot may finish (and release it) right away,
+        within the callback. Such releases are only counted and passed on by
+        the loop below, so a long queue doesn't end up in deep recursion.
+        """
+
+        self._released += 1
+        if self._releasing:
+            return
+
+        self._releasing = True
+        try:
+            while self._released:
+                self._released -= 1
+                if self._queue:
+                    queued_at, d = self._queue.popleft()
+                    waited = self.clock.seconds() - queued_at
+                    self.admitted += 1
+                    self.waited += 1
+                    self.waitTime += waited
+                    self.maxWaitTime = max(self.maxWaitTime, waited)
+                    d.callback(None)
+                else:
+                    self.inFlight -= 1
+        finally:
+            self._releasing = False
+
+    def __len__(self):
+        """
+        @rtype: int
+        @return: Number of calls waiting for a slot
+        """
+
+        return len(self._queue)
+
+    def stats(self):
+        """
+        @rtype: dict
+        @return: Current calls in flight and queue depth, number of calls
+            admitted and rejected, and wait times (in seconds) of the calls
+            that had to queue.
+        """
+
+        return {'inFlight': self.inFlight,
+                'queued': len(self._queue),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'waited': self.waited,
+                'waitTime': self.waitTime,
+                'maxWaitTime': self.maxWaitTime}
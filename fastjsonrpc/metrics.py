@@ -0,0 +1,404 @@
+"""
+Copyright 2012 Tadeas Moravec
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+=======
+Metrics
+=======
+
+Provides ServerMetrics, per-method call counts, error counts and latency
+histograms plus request and response sizes of a server (see
+JSONRPCDispatcher.collectMetrics), and MetricsResource, which publishes
+them in the Prometheus text format.
+
+Also provides RequestTiming, the time a single request spent in each phase
+of its processing (see JSONRPCDispatcher.timePhases).
+"""
+
+from bisect import bisect_left
+
+from twisted.internet import reactor
+from twisted.web import resource
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = tuple(4 ** i for i in range(3, 13))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Phases of processing a request, in the order they go
+PHASES = ('decode', 'verify', 'dispatch', 'encode', 'write')
+
+
+class Histogram(object):
+    """
+    Counts of observed values falling into buckets, plus their sum.
+    """
+
+    def __init__(self, buckets):
+        """
+        @type buckets: sequence
+        @param buckets: Upper bounds of the buckets, ascending. A bucket for
+            values above the last one is added.
+        """
+
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        @type value: float
+        @param value: Value to count in
+        """
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        @rtype: list
+        @return: (upper bound, number of values <= it) for every bucket, the
+            last bound is float('inf')
+        """
+
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def stats(self):
+        """
+        @rtype: dict
+        @return: Cumulative bucket counts, sum and count of the values
+        """
+
+        return {'buckets': self.cumulative(),
+                'sum': self.sum,
+                'count': self.count}
+
+
+class MethodMetrics(object):
+    """
+    Metrics of one method.
+
+    @ivar calls: Number of calls
+    @ivar errors: Error code -> number of calls that failed with it
+    @ivar latency: Histogram of call durations in seconds
+    """
+
+    def __init__(self, latencyBuckets=LATENCY_BUCKETS):
+        self.calls = 0
+        self.errors = {}
+        self.latency = Histogram(latencyBuckets)
+
+    def stats(self):
+        return {'calls': self.calls,
+                'errors': dict(self.errors),
+                'latency': self.latency.stats()}
+
+
+class ServerMetrics(object):
+    """
+    Metrics of all methods of a server, and sizes of its requests and
+    responses. Calls of methods that don't exist are counted under
+    UNKNOWN_METHOD, so clients can't make us keep metrics of any name they
+    come up with.
+    """
+
+    UNKNOWN_METHOD = '<unknown>'
+
+    def __init__(self, latencyBuckets=LATENCY_BUCKETS,
+                 sizeBuckets=SIZE_BUCKETS, clock=None):
+        """
+        @type latencyBuckets: sequence
+        @param latencyBuckets: Bucket bounds of the latency histograms, in
+            seconds
+
+        @type sizeBuckets: sequence
+        @param sizeBuckets: Bucket bounds of the size histograms, in bytes
+
+        @type clock: t.i.interfaces.IReactorTime
+        @param clock: Source of time, the reactor by default
+        """
+
+        self.latencyBuckets = latencyBuckets
+        self.sizeBuckets = sizeBuckets
+        self.clock = clock or reactor
+        self.reset()
+
+    def reset(self):
+        """
+        Start counting from zero.
+        """
+
+        self.methods = {}
+        self.requestSize = Histogram(self.sizeBuckets)
+        self.responseSize = Histogram(self.sizeBuckets)
+
+    def observeCall(self, method, duration, errorCode=None):
+        """
+        @type method: str
+        @param method: Name of the method
+
+        @type duration: float
+        @param duration: How long the call took, in seconds
+
+        @type errorCode: int
+        @param errorCode: JSON-RPC error code the call failed with, None if
+            it succeeded
+        """
+
+        try:
+            metrics = self.methods[method]
+        except KeyError:
+            metrics = self.methods[method] = MethodMetrics(
+                self.latencyBuckets)
+
+        metrics.calls += 1
+        metrics.latency.observe(duration)
+        if errorCode is not None:
+            metrics.errors[errorCode] = metrics.errors.get(errorCode, 0) + 1
+
+    def observeRequest(self, size):
+        """
+        @type size: int
+        @param size: Length of a request, in bytes
+        """
+
+        self.requestSize.observe(size)
+
+    def observeResponse(self, size):
+        """
+        @type size: int
+        @param size: Length of a response, in bytes
+        """
+
+        self.responseSize.observe(size)
+
+    def stats(self):
+        """
+        @rtype: dict
+        @return: Method name -> its metrics under 'methods', request and
+            response size histograms under 'requestSize' and 'responseSize'
+        """
+
+        return {'methods': dict((name, metrics.stats()) for name, metrics
+                                in self.methods.iteritems()),
+                'requestSize': self.requestSize.stats(),
+                'responseSize': self.responseSize.stats()}
+
+    def exposition(self, prefix='jsonrpc'):
+        """
+        @type prefix: str
+        @param prefix: Prefix of the metric names
+
+        @rtype: str
+        @return: The metrics in the Prometheus text format
+        """
+
+        lines = []
+
+        def header(name, kind, description):
+            lines.append('# HELP %s_%s %s' % (prefix, name, description))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        def sample(name, labels, value):
+            if labels:
+                labels = ','.join('%s="%s"' % (key, _escape(value))
+                                  for key, value in labels)
+                lines.append('%s_%s{%s} %s' % (prefix, name, labels,
+                                               _format(value)))
+            else:
+                lines.append('%s_%s %s' % (prefix, name, _format(value)))
+
+        def histogram(name, labels, histogram):
+            for bound, count in histogram.cumulative():
+                sample(name + '_bucket', labels + [('le', bound)], count)
+            sample(name + '_sum', labels, histogram.sum)
+            sample(name + '_count', labels, histogram.count)
+
+        methods = sorted(self.methods.iteritems())
+
+        header('calls_total', 'counter', 'Method calls.')
+        for name, metrics in methods:
+            sample('calls_total', [('method', name)], metrics.calls)
+
+        header('errors_total', 'counter',
+               'Method calls that failed, by error code.')
+        for name, metrics in methods:
+            for code, count in sorted(metrics.errors.iteritems()):
+                sample('errors_total', [('method', name), ('code', code)],
+                       count)
+
+        header('call_duration_seconds', 'histogram',
+               'Duration of method calls.')
+        for name, metrics in methods:
+            histogram('call_duration_seconds', [('method', name)],
+                      metrics.latency)
+
+        header('request_size_bytes', 'histogram', 'Size of requests.')
+        histogram('request_size_bytes', [], self.requestSize)
+
+        header('response_size_bytes', 'histogram', 'Size of responses.')
+        histogram('response_size_bytes', [], self.responseSize)
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format(value):
+    """
+    Format a sample value or a bucket bound the Prometheus way.
+    """
+
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    """
+    Escape a label value.
+    """
+
+    value = _format(value)
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class RequestTiming(object):
+    """
+    Time a request spent in each of PHASES, in seconds:
+
+        - decode: decoding the request JSON (and decompressing it)
+        - verify: checking the calls are valid JSON-RPC
+        - dispatch: calling the methods, until their Deferreds fire
+        - encode: encoding the responses (and compressing them)
+        - write: handing the response over to the transport
+
+    Times of the calls of a batch are summed up, so with methods returning
+    Deferreds the phases can take longer than the request as a whole.
+
+    @ivar phases: Phase name -> seconds spent in it
+    @ivar calls: Number of calls in the request
+    @ivar total: Seconds from the start of processing to the end, None
+        until the request is finished
+    """
+
+    def __init__(self, clock=None):
+        """
+        @type clock: t.i.interfaces.IReactorTime
+        @param clock: Source of time, the reactor by default
+        """
+
+        self.clock = clock or reactor
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.calls = 0
+        self.total = None
+        self.start = self.clock.seconds()
+
+    def now(self):
+        """
+        @rtype: float
+        @return: Current time by our clock, to pass to add later
+        """
+
+        return self.clock.seconds()
+
+    def add(self, phase, start):
+        """
+        Count the time since start in a phase.
+
+        @type phase: str
+        @param phase: One of PHASES
+
+        @type start: float
+        @param start: When the phase started, see now
+
+        @rtype: float
+        @return: Current time, the start of the next phase
+        """
+
+        now = self.clock.seconds()
+        self.phases[phase] += now - start
+        return now
+
+    def cbAdd(self, result, phase, start):
+        """
+        Callback version of add, passing the result through.
+        """
+
+        self.add(phase, start)
+        return result
+
+    def finish(self):
+        """
+        The request is done, stop the clock.
+        """
+
+        self.total = self.clock.seconds() - self.start
+
+    def serverTiming(self):
+        """
+        @rtype: str
+        @return: Value of a Server-Timing HTTP header, with the phases
+            measured so far and the time since the start as total
+        """
+
+        total = self.total
+        if total is None:
+            total = self.clock.seconds() - self.start
+
+        metrics = ['%s;dur=%.3f' % (phase, self.phases[phase] * 1000)
+                   for phase in PHASES if self.phases[phase]]
+        metrics.append('total;dur=%.3f' % (total * 1000))
+        return ', '.join(metrics)
+
+
+class MetricsResource(resource.Resource):
+    """
+    Publishes metrics of a server (HTTP or netstring one) in the Prometheus
+    text format. Put it next to the server in the resource tree, e.g.
+    root.putChild('metrics', MetricsResource(server)).
+    """
+
+    isLeaf = 1
+
+    def __init__(self, server, prefix='jsonrpc'):
+        """
+        @type server: dispatch.JSONRPCDispatcher
+        @param server: Server (or a subclass of one) to publish metrics of.
+            Metrics are kept per server class, so any instance will do.
+
+        @type prefix: str
+        @param prefix: Prefix of the metric names
+        """
+
+        resource.Resource.__init__(self)
+        self.server = server
+        self.prefix = prefix
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', CONTENT_TYPE)
+        metrics = self.server.getMetrics()
+        if metrics is None:
+            return ''
+        return metrics.exposition(self.prefix)
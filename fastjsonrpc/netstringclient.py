@@ -23,10 +23,11 @@ Provides JSONRPCServer class, which can be used to expose methods via RPC.
 
 from twisted.protocols import basic
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.internet.protocol import Factory
 from twisted.internet import reactor
 from twisted.internet.endpoints import TCP4ClientEndpoint
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, DeferredList, succeed
 
 import jsonrpc
 
@@ -127,6 +128,267 @@ class ResponseDeferred(Deferred):
         self.callback(json_response)
 
 
+class PooledProtocol(basic.NetstringReceiver):
+    """
+    Client side of a connection kept in a ConnectionPool. Carries one call
+    at a time and stays open after the response.
+    """
+
+    def __init__(self, pool, key):
+        """
+        @type pool: ConnectionPool
+        @param pool: The pool this connection belongs to
+
+        @type key: tuple
+        @param key: (hostname, port) of the server
+        """
+
+        self.pool = pool
+        self.key = key
+        self.state = 'busy'
+        self.response = None
+        self.closed = Deferred()
+
+    def sendCall(self, json_request):
+        """
+        @type json_request: str
+        @param json_request: The encoded request
+
+        @rtype: Deferred
+        @return: Deferred firing with the response string
+        """
+
+        self.response = Deferred()
+        self.sendString(json_request)
+        return self.response
+
+    def stringReceived(self, string):
+        """
+        Fire the Deferred of the call in progress. A response nobody asked
+        for means we can't trust the connection any more.
+
+        @type string: str
+        @param string: The response
+        """
+
+        d, self.response = self.response, None
+        if d is None:
+            log.msg('Unexpected response: %r' % string)
+            self.transport.loseConnection()
+            return
+
+        d.callback(string)
+
+    def connectionLost(self, reason):
+        """
+        @type reason: t.p.f.Failure
+        @param reason: Why the connection was lost
+        """
+
+        self.pool._connectionLost(self)
+
+        d, self.response = self.response, None
+        if d is not None:
+            d.errback(reason)
+
+        self.closed.callback(None)
+
+
+class _PooledFactory(Factory):
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+
+    def buildProtocol(self, _):
+        return PooledProtocol(self.pool, self.key)
+
+
+class ConnectionPool(object):
+    """
+    Keeps connections to netstring servers open after a call, so the next
+    call to the same server doesn't have to connect again. The netstring
+    counterpart of t.w.client.HTTPConnectionPool, pass it to Proxy.
+
+    It only pays off with servers that keep connections open (see
+    netstringserver.JSONRPCServer.persistent), others close a connection
+    after the response and it's simply dropped from the pool. Make
+    cachedConnectionTimeout shorter than the server's idleTimeout, or a call
+    can be sent over a connection the server is just closing.
+
+    @ivar maxPersistentPerHost: Maximum number of idle connections kept
+        per server
+    @ivar maxConnectionsPerHost: Maximum number of connections per server,
+        idle or in use. Calls above it wait for a connection to be free.
+        None means no limit.
+    @ivar cachedConnectionTimeout: Seconds an idle connection is kept
+    """
+
+    maxPersistentPerHost = 2
+    maxConnectionsPerHost = None
+    cachedConnectionTimeout = 240
+
+    def __init__(self, clock=None):
+        """
+        @type clock: t.i.interfaces.IReactorTime
+        @param clock: Schedules eviction of idle connections, the reactor by
+            default
+        """
+
+        self._clock = clock or reactor
+        self._connections = {}
+        self._timeouts = {}
+        self._busy = {}
+        self._waiting = {}
+
+    def getConnection(self, key, endpoint):
+        """
+        @type key: tuple
+        @param key: (hostname, port) of the server
+
+        @type endpoint: t.i.interfaces.IStreamClientEndpoint
+        @param endpoint: Endpoint to connect to if there's no idle
+            connection
+
+        @rtype: Deferred
+        @return: Deferred firing with a PooledProtocol. Give it back with
+            returnConnection once the call is done.
+        """
+
+        idle = self._connections.get(key)
+        while idle:
+            protocol = idle.pop()
+            self._timeouts.pop(protocol).cancel()
+            if self._isHealthy(protocol):
+                protocol.state = 'busy'
+                self._busy[key] = self._busy.get(key, 0) + 1
+                return succeed(protocol)
+            protocol.state = 'closed'
+            protocol.transport.loseConnection()
+
+        limit = self.maxConnectionsPerHost
+        if limit is not None and self._busy.get(key, 0) >= limit:
+            d = Deferred()
+            self._waiting.setdefault(key, []).append((d, endpoint))
+            return d
+
+        return self._connect(key, endpoint)
+
+    def _isHealthy(self, protocol):
+        """
+        Health check of an idle connection before it's reused. Connections
+        the server closes while idle are dropped right away (see
+        _connectionLost), this catches those we haven't heard of yet.
+        """
+
+        return (protocol.state == 'idle' and protocol.response is None
+                and not protocol.transport.disconnecting)
+
+    def _connect(self, key, endpoint):
+        """
+        @rtype: Deferred
+        @return: Deferred firing with a new connection
+        """
+
+        self._busy[key] = self._busy.get(key, 0) + 1
+
+        def failed(failure):
+            self._busy[key] -= 1
+            self._serveWaiting(key)
+            return failure
+
+        d = endpoint.connect(_PooledFactory(self, key))
+        d.addErrback(failed)
+        return d
+
+    def _serveWaiting(self, key):
+        """
+        Connect for a waiting call, if there's one and room for it.
+        """
+
+        waiting = self._waiting.get(key)
+        if not waiting:
+            return
+
+        limit = self.maxConnectionsPerHost
+        if limit is not None and self._busy.get(key, 0) >= limit:
+            return
+
+        d, endpoint = waiting.pop(0)
+        self._connect(key, endpoint).chainDeferred(d)
+
+    def returnConnection(self, protocol):
+        """
+        The call is done, keep the connection for the next one. It goes to
+        a waiting call right away if there's one.
+
+        @type protocol: PooledProtocol
+        @param protocol: Connection got from getConnection
+        """
+
+        if protocol.state != 'busy':
+            return
+
+        key = protocol.key
+        waiting = self._waiting.get(key)
+        if waiting and not protocol.transport.disconnecting:
+            d, _ = waiting.pop(0)
+            d.callback(protocol)
+            return
+
+        self._busy[key] -= 1
+        idle = self._connections.setdefault(key, [])
+        if (len(idle) >= self.maxPersistentPerHost
+                or protocol.transport.disconnecting):
+            protocol.state = 'closed'
+            protocol.transport.loseConnection()
+            return
+
+        protocol.state = 'idle'
+        idle.append(protocol)
+        self._timeouts[protocol] = self._clock.callLater(
+            self.cachedConnectionTimeout, self._evict, protocol)
+
+    def _evict(self, protocol):
+        """
+        Close a connection that has been idle for cachedConnectionTimeout.
+        """
+
+        del self._timeouts[protocol]
+        self._connections[protocol.key].remove(protocol)
+        protocol.state = 'closed'
+        protocol.transport.loseConnection()
+
+    def _connectionLost(self, protocol):
+        """
+        Forget a lost connection, see PooledProtocol.connectionLost.
+        """
+
+        key = protocol.key
+        if protocol.state == 'idle':
+            self._timeouts.pop(protocol).cancel()
+            self._connections[key].remove(protocol)
+        elif protocol.state == 'busy':
+            self._busy[key] -= 1
+            self._serveWaiting(key)
+        protocol.state = 'closed'
+
+    def closeCachedConnections(self):
+        """
+        Close all idle connections.
+
+        @rtype: Deferred
+        @return: Deferred firing once they're closed
+        """
+
+        closed = []
+        for idle in self._connections.values():
+            for protocol in list(idle):
+                closed.append(protocol.closed)
+                protocol.transport.loseConnection()
+        return DeferredList(closed)
+
+
 class Proxy(object):
     """
     A proxy to one specific JSON-RPC server. Pass the server URL to the
@@ -139,7 +401,7 @@ class Proxy(object):
     """
 
     def __init__(self, url, version=jsonrpc.VERSION_1, timeout=None,
-                 verbose=False):
+                 verbose=False, codec=None, pool=None):
         """
         @type url: str
         @param url: URL of the RPC server, including the port
@@ -152,6 +414,15 @@ class Proxy(object):
 
         @type verbose: bool
         @param verbose: If True, we log the outgoing and incoming JSON
+
+        @type codec: jsonrpc.JSONCodec or str
+        @param codec: JSON codec to encode requests and decode responses
+            with, see jsonrpc.getCodec. If None then the default codec is used.
+
+        @type pool: ConnectionPool
+        @param pool: Pool to take connections from and give them back to
+            after the call. If None then we connect for every call and
+            hang up after it.
         """
 
         self.hostname, self.port = url.split(':')
@@ -159,6 +430,9 @@ class Proxy(object):
         self.version = version
         self.timeout = timeout
         self.verbose = verbose
+        self.codec = jsonrpc.getCodec(codec)
+        self.pool = pool
+        self._ids = jsonrpc.IdAllocator()
 
     def connectionMade(self, protocol, json_request):
         """
@@ -178,8 +452,8 @@ class Proxy(object):
     def callRemote(self, method, *args, **kwargs):
         """
         Remotely calls the method, with args. Given that we keep reference to
-        the call via the Deferred, there's no need for id. It will coin some
-        random anyway, just to satisfy the spec.
+        the call via the Deferred, there's no need for id. We coin one
+        anyway, just to satisfy the spec, and check the response carries it.
 
         According to the spec, we cannot use either args and kwargs at once.
         If there are kwargs, they get used and args are ignored.
@@ -200,24 +474,320 @@ class Proxy(object):
         @TODO support batch requests
         """
 
+        id_ = self._ids.allocate()
         if kwargs:
-            json_request = jsonrpc.encodeRequest(method, kwargs,
-                                                 version=self.version)
+            json_request = jsonrpc.encodeRequest(method, kwargs, id_=id_,
+                                                 version=self.version,
+                                                 codec=self.codec)
         else:
-            json_request = jsonrpc.encodeRequest(method, args,
-                                                 version=self.version)
+            json_request = jsonrpc.encodeRequest(method, args, id_=id_,
+                                                 version=self.version,
+                                                 codec=self.codec)
 
         if self.verbose:
             log.msg('Sending: %s' % json_request)
 
+        # response_deferred will be fired in responseReceived, after
+        # we got response from the RPC server
         response_deferred = ResponseDeferred(verbose=self.verbose)
-        factory = CallbackFactory(response_deferred.responseReceived)
+        response_deferred.addCallback(jsonrpc.decodeResponse, self.codec,
+                                      id_)
+        response_deferred.addBoth(self._callDone, id_)
+
+        if self.pool is not None:
+            self._callPooled(json_request, response_deferred)
+        else:
+            factory = CallbackFactory(response_deferred.responseReceived)
+            point = TCP4ClientEndpoint(reactor, self.hostname, self.port,
+                                       timeout=self.timeout)
+            d = point.connect(factory)
+            d.addCallback(self.connectionMade, json_request)
+            d.addErrback(response_deferred.errback)
+
+        return response_deferred
+
+    def _callDone(self, result, id_):
+        """
+        Free the id of a finished call, passing the result through.
+        """
+
+        self._ids.release(id_)
+        return result
+
+    def _callPooled(self, json_request, response_deferred):
+        """
+        Send the request over a connection from our pool and give the
+        connection back once the response is in. If the response is not
+        valid or not ours, the connection is out of step with the server, so
+        we close it instead.
+
+        @type json_request: str
+        @param json_request: The already encoded request
+
+        @type response_deferred: ResponseDeferred
+        @param response_deferred: Deferred to fire with the response
+        """
+
         point = TCP4ClientEndpoint(reactor, self.hostname, self.port,
                                    timeout=self.timeout)
-        d = point.connect(factory)
-        d.addCallback(self.connectionMade, json_request)
+        connection = []
 
-        # response_deferred will be fired in responseReceived, after
-        # we got response from the RPC server
-        response_deferred.addCallback(jsonrpc.decodeResponse)
-        return response_deferred
+        def send(protocol):
+            connection.append(protocol)
+            d = protocol.sendCall(json_request)
+            d.addCallbacks(response_deferred.responseReceived,
+                           response_deferred.errback)
+
+        def release(result):
+            if connection:
+                protocol = connection[0]
+                if isinstance(result, Failure) and result.check(ValueError):
+                    protocol.transport.loseConnection()
+                else:
+                    self.pool.returnConnection(protocol)
+            return result
+
+        response_deferred.addBoth(release)
+
+        d = self.pool.getConnection((self.hostname, self.port), point)
+        d.addCallback(send)
+        d.addErrback(response_deferred.errback)
+
+
+class MultiplexingProtocol(basic.NetstringReceiver):
+    """
+    Client side of a long-lived connection carrying many calls at once.
+    Every call is sent as soon as it's made, responses are matched to the
+    calls by id, in whatever order they come.
+    """
+
+    def __init__(self, proxy):
+        """
+        @type proxy: MultiplexingProxy
+        @param proxy: The proxy this connection belongs to
+        """
+
+        self.proxy = proxy
+        self.calls = jsonrpc.InFlightCalls(proxy._ids)
+        self.closed = Deferred()
+
+    def sendCall(self, method, params, d):
+        """
+        @type method: str
+        @param method: Method name
+
+        @type params: list or dict
+        @param params: Arguments of the method
+
+        @type d: Deferred
+        @param d: Deferred to fire with the decoded response
+
+        @rtype: int
+        @return: Id the call was sent with
+        """
+
+        id_ = self.calls.add(d)
+        json_request = jsonrpc.encodeRequest(method, params, id_=id_,
+                                             version=self.proxy.version,
+                                             codec=self.proxy.codec)
+
+        if self.proxy.verbose:
+            log.msg('Sending: %s' % json_request)
+
+        self.sendString(json_request)
+        return id_
+
+    def stringReceived(self, string):
+        """
+        Fire the Deferred of the call the response belongs to.
+
+        @type string: str
+        @param string: The response
+        """
+
+        if self.proxy.verbose:
+            log.msg('Response received: %s' % string)
+
+        try:
+            response = jsonrpc.jloads(string, self.proxy.codec)
+            id_ = response.get('id')
+        except (ValueError, AttributeError):
+            log.msg('Malformed response: %r' % string)
+            return
+
+        d = self.calls.pop(id_)
+        if d is None:
+            log.msg('Response to an unknown call: %r' % string)
+            return
+
+        try:
+            result = jsonrpc.resultFromResponse(response, id_)
+        except Exception as e:
+            d.errback(e)
+        else:
+            d.callback(result)
+
+    def connectionLost(self, reason):
+        """
+        Fail the calls we haven't got responses to. They may or may not
+        have been made, so we don't repeat them.
+
+        @type reason: t.p.f.Failure
+        @param reason: Why the connection was lost
+        """
+
+        self.proxy._connectionLost(self)
+
+        for d in self.calls.popAll():
+            d.errback(reason)
+
+        self.closed.callback(None)
+
+
+class _MultiplexingFactory(Factory):
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def buildProtocol(self, _):
+        return MultiplexingProtocol(self.proxy)
+
+
+class MultiplexingProxy(object):
+    """
+    A proxy to one netstring JSON-RPC server, keeping up to maxConnections
+    connections to it open and sending any number of calls over each of
+    them at once. The server has to be a persistent, pipelined one (see
+    netstringserver.JSONRPCServer.persistent and pipelineDepth).
+
+    Connections are made on demand. A lost connection is replaced by a new
+    one with the next call, calls in flight on the lost connection fail.
+    """
+
+    def __init__(self, url, version=jsonrpc.VERSION_1, timeout=None,
+                 verbose=False, codec=None, maxConnections=1):
+        """
+        @type url: str
+        @param url: URL of the RPC server, including the port
+
+        @type version: float
+        @param version: Which JSON-RPC version to use? Defaults to version 1.
+
+        @type timeout: int
+        @param timeout: Timeout of connecting, in seconds
+
+        @type verbose: bool
+        @param verbose: If True, we log the outgoing and incoming JSON
+
+        @type codec: jsonrpc.JSONCodec or str
+        @param codec: JSON codec to encode requests and decode responses
+            with, see jsonrpc.getCodec. If None then the default codec is used.
+
+        @type maxConnections: int
+        @param maxConnections: Maximum number of connections to the server.
+            Calls go over the connection with the fewest calls in flight.
+        """
+
+        self.hostname, self.port = url.split(':')
+        self.port = int(self.port)
+        self.version = version
+        self.timeout = timeout
+        self.verbose = verbose
+        self.codec = jsonrpc.getCodec(codec)
+        self.maxConnections = maxConnections
+
+        self.connections = []
+        self.connecting = []
+        self._ids = jsonrpc.IdAllocator()
+
+    def _getConnection(self):
+        """
+        @rtype: Deferred
+        @return: Deferred firing with the connection to send a call over
+        """
+
+        if len(self.connections) + len(self.connecting) < self.maxConnections:
+            if not self.connections or min(
+                    len(p.calls) for p in self.connections):
+                return self._connect()
+
+        if self.connections:
+            return succeed(min(self.connections, key=lambda p: len(p.calls)))
+
+        # all our connections are still being made
+        d = Deferred()
+        self.connecting[0].append(d)
+        return d
+
+    def _connect(self):
+        """
+        Make a new connection to the server.
+
+        @rtype: Deferred
+        @return: Deferred firing with the connection once it's made
+        """
+
+        waiting = []
+        self.connecting.append(waiting)
+
+        def connected(protocol):
+            self.connecting.remove(waiting)
+            self.connections.append(protocol)
+            for d in waiting:
+                d.callback(protocol)
+            return protocol
+
+        def failed(failure):
+            self.connecting.remove(waiting)
+            for d in waiting:
+                d.errback(failure)
+            return failure
+
+        point = TCP4ClientEndpoint(reactor, self.hostname, self.port,
+                                   timeout=self.timeout)
+        d = point.connect(_MultiplexingFactory(self))
+        d.addCallbacks(connected, failed)
+        return d
+
+    def _connectionLost(self, protocol):
+        """
+        Forget a lost connection, see MultiplexingProtocol.connectionLost.
+        """
+
+        if protocol in self.connections:
+            self.connections.remove(protocol)
+
+    def callRemote(self, method, *args, **kwargs):
+        """
+        Remotely calls the method, with args or kwargs (not both, kwargs
+        win). See Proxy.callRemote.
+
+        @type method: str
+        @param method: Method name
+
+        @rtype: t.i.d.Deferred
+        @return: Deferred, that will fire with whatever the 'method' returned.
+        """
+
+        params = kwargs or args
+        response = Deferred()
+
+        def send(protocol):
+            protocol.sendCall(method, params, response)
+
+        d = self._getConnection()
+        d.addCallbacks(send, response.errback)
+        return response
+
+    def disconnect(self):
+        """
+        Close all connections. Calls in flight fail.
+
+        @rtype: Deferred
+        @return: Deferred firing once they're closed
+        """
+
+        closed = [protocol.closed for protocol in self.connections]
+        for protocol in list(self.connections):
+            protocol.transport.loseConnection()
+        return DeferredList(closed)
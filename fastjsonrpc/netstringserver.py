@@ -21,16 +21,95 @@ JSONRPC Server
 Provides JSONRPCServer class, which can be used to expose methods via RPC.
 """
 
-from twisted.protocols import basic
-from twisted.internet.defer import succeed, DeferredList, maybeDeferred
+from twisted.protocols import basic, policies
+from twisted.internet.defer import Deferred
 from twisted.python import log
+from twisted.python.failure import Failure
 
 import jsonrpc
+from dispatch import JSONRPCDispatcher
+
+
+class JSONRPCServer(JSONRPCDispatcher, basic.NetstringReceiver,
+                    policies.TimeoutMixin):
+    """
+    JSON-RPC server over netstrings. Subclass this, implement your own
+    methods and use it as the protocol of a t.i.p.Factory.
+
+    With streamBatches set, a batch is answered in the framed mode: a
+    netstring per method response, sent as soon as it's ready, followed by
+    an empty netstring.
+
+    A request longer than maxRequestSize (if set, else MAX_LENGTH) is
+    answered with an error as soon as we get its length, and the connection
+    is closed.
+
+    By default the connection is closed once the response is sent. With
+    persistent set, we keep reading requests from it and answer them one
+    by one, in the order they came. Reading from the connection is paused
+    while requests wait for their turn. The connection is closed after
+    idleTimeout seconds without a request in progress (None for never), or
+    once maxRequestsPerConnection requests have been answered (None for no
+    limit).
+
+    A persistent connection can be pipelined: with pipelineDepth above 1
+    (or None for no limit), that many of its requests are processed at
+    once, and each response is sent as soon as it's ready. Responses come
+    in the order the requests finish, clients have to match them by id.
+    Batches are then answered as a whole even with streamBatches set, so
+    their responses don't interleave with responses to other requests.
+    """
+
+    persistent = False
+    idleTimeout = None
+    maxRequestsPerConnection = None
+    pipelineDepth = 1
+
+    _tooLarge = False
+    _inProgress = 0
+    _serving = False
+    _queued = ()
+    _served = 0
+    _paused = False
+    _closing = False
+    _disconnected = False
+
+    @property
+    def MAX_LENGTH(self):
+        """
+        NetstringReceiver's limit of a netstring length, see maxRequestSize.
+        """
+
+        if self.maxRequestSize is not None:
+            return self.maxRequestSize
+        return basic.NetstringReceiver.MAX_LENGTH
 
+    def _extractLength(self, lengthAsString):
+        """
+        NetstringReceiver calls this as soon as it has got the length of
+        a netstring. Remember if it was too long, see _handleParseError.
+        """
 
-class JSONRPCServer(basic.NetstringReceiver):
+        try:
+            return basic.NetstringReceiver._extractLength(self, lengthAsString)
+        except basic.NetstringParseError:
+            self._tooLarge = True
+            raise
 
-    def __init__(self, verbose=False):
+    def _handleParseError(self):
+        """
+        Answer a too long request with an error before NetstringReceiver
+        closes the connection. Other malformed netstrings get no response.
+        """
+
+        if self._tooLarge:
+            error = jsonrpc.requestTooLarge(self.MAX_LENGTH)
+            response = jsonrpc.requestError(error, self.codec)
+            self._logResponse(response)
+            self.sendString(response)
+        basic.NetstringReceiver._handleParseError(self)
+
+    def __init__(self, verbose=False, codec=None):
         """
         Set verbosity level. By default we only log IP version, IP address
         and port of incoming request. With verbose=True, we log incoming
@@ -38,49 +117,96 @@ class JSONRPCServer(basic.NetstringReceiver):
 
         @type verbose: bool
         @param verbose: Log details or not
+
+        @type codec: jsonrpc.JSONCodec, str or None
+        @param codec: JSON codec to use, see jsonrpc.getCodec. If None, the
+            codec class attribute is used (which defaults to the default
+            codec).
         """
 
         self.verbose = verbose
+        if codec is not None:
+            self.codec = codec
+
+    def connectionMade(self):
+        """
+        Start the idle timeout of a persistent connection.
+        """
+
+        if self.persistent:
+            self.setTimeout(self.idleTimeout)
+
+    def connectionLost(self, reason):
+        """
+        Stop the idle timeout, drop requests waiting for their turn.
+        """
+
+        self._disconnected = True
+        self.setTimeout(None)
+        self._queued = ()
 
-    def _parseError(self):
+    def _parseError(self, timing=None):
         """
         Coin a 'parse error' response and finish the request.
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+        """
+
+        response = jsonrpc.parseError(self.codec)
+        self._sendResponse(response, timing)
+
+    def _requestError(self, error, timing=None):
         """
+        Answer a request that can't be dispatched (e.g. a malformed one) with
+        an error and finish it.
 
-        response = jsonrpc.parseError()
-        self._sendResponse(response)
+        @type error: jsonrpc.JSONRPCError
+        @param error: What's wrong with the request
 
-    def _callMethod(self, request_dict):
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
         """
-        Here we actually find and call the method.
 
-        @type request_dict: dict
-        @param request_dict: Dict with details about the method
+        if error.errno == jsonrpc.PARSE_ERROR:
+            self._parseError(timing)
+            return
 
-        @rtype: Deferred
-        @return: Deferred, that will eventually fire with the method's result.
+        response = jsonrpc.requestError(error, self.codec)
+        self._sendResponse(response, timing)
 
-        @raise JSONRPCError: When method not found.
+    def _ebRequestError(self, failure, timing=None):
         """
+        Errback answering a request found malformed (or too long) only while
+        it was being decoded in a thread or dispatched, see
+        threadedDecodeSize and incrementalParseSize. Any other failure is
+        logged and answered with INTERNAL_ERROR, so the request is finished
+        (and a persistent connection goes on) either way.
 
-        function = getattr(self, 'jsonrpc_%s' % request_dict['method'], None)
-        if callable(function):
+        @type failure: t.p.f.Failure
+        @param failure: Failure wrapping the jsonrpc.JSONRPCError
 
-            if 'params' in request_dict:
-                if isinstance(request_dict['params'], dict):
-                    d = maybeDeferred(function, **request_dict['params'])
-                else:
-                    d = maybeDeferred(function, *request_dict['params'])
-            else:
-                d = maybeDeferred(function)
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+        """
 
-            return d
+        self._requestError(self._errorFromFailure(failure), timing)
 
-        else:
-            msg = 'Method %s not found' % request_dict['method']
-            raise jsonrpc.JSONRPCError(msg, jsonrpc.METHOD_NOT_FOUND,
-                                       id_=request_dict['id'],
-                                       version=request_dict['jsonrpc'])
+    def _errorFromFailure(self, failure):
+        """
+        @type failure: t.p.f.Failure
+        @param failure: Failure of a request
+
+        @rtype: jsonrpc.JSONRPCError
+        @return: The error to answer the request with. INTERNAL_ERROR for
+            anything but a JSONRPCError, which is logged.
+        """
+
+        if failure.check(jsonrpc.JSONRPCError):
+            return failure.value
+
+        log.err(failure, 'Unexpected failure processing a request')
+        return jsonrpc.JSONRPCError('Internal error', jsonrpc.INTERNAL_ERROR)
 
     def _logRequest(self, request):
         """
@@ -104,61 +230,240 @@ class JSONRPCServer(basic.NetstringReceiver):
         @param string: Request from client, just the 'string' itself, already
             stripped of the netstring stuff.
 
-        @rtype: DeferredList
+        @rtype: Deferred or None
         @return: Deferred, that will fire when all methods are finished. It
             will already have all the callbacks and errbacks neccessary to
-            finish and send the response.
+            finish and send the response. None if no method returned
+            a Deferred, the response has already been sent then. Always None
+            on a persistent connection, the request may have to wait for
+            its turn.
         """
 
+        if not self.persistent:
+            return self._serveRequest(string)
+
+        if not self._queued:
+            self._queued = []
+        self._queued.append(string)
+        self._serveQueued()
+        return None
+
+    def _serveQueued(self):
+        """
+        Serve the requests waiting on a persistent connection, as many at
+        once as pipelineDepth allows. Once there are none in progress,
+        start the idle timeout.
+        """
+
+        if self._serving or self._closing:
+            # A request finished right away, the loop below goes on. Or we
+            # are done with the connection.
+            return
+
+        self._serving = True
+        while self._queued and (self.pipelineDepth is None or
+                                self._inProgress < self.pipelineDepth):
+            if (self.maxRequestsPerConnection is not None and
+                    self._served >= self.maxRequestsPerConnection):
+                break
+            self._inProgress += 1
+            self._served += 1
+            self.setTimeout(None)
+            self._serveRequest(self._queued.pop(0))
+        self._serving = False
+
+        if self._closing:
+            return
+
+        if self._queued and not self._paused:
+            # Don't read more requests than we can keep up with.
+            self._paused = True
+            self.transport.pauseProducing()
+        elif not self._queued and self._paused:
+            self._paused = False
+            self.transport.resumeProducing()
+
+        if not self._inProgress:
+            self.setTimeout(self.idleTimeout)
+
+    def _requestFinished(self):
+        """
+        The response has been sent. Close the connection, unless it's
+        a persistent one, then go on with the next request. Once
+        maxRequestsPerConnection have been started, close it when the last
+        of them is answered.
+        """
+
+        if self._disconnected:
+            return
+
+        if self.persistent:
+            self._inProgress -= 1
+            if (self.maxRequestsPerConnection is None or
+                    self._served < self.maxRequestsPerConnection):
+                self._serveQueued()
+                return
+            if self._inProgress:
+                return
+
+        self._closing = True
+        self.setTimeout(None)
+        self.transport.loseConnection()
+
+    def _isPipelined(self):
+        """
+        @rtype: bool
+        @return: True if more requests of the connection can be in progress
+            at once, see pipelineDepth
+        """
+
+        return self.persistent and self.pipelineDepth != 1
+
+    def _serveRequest(self, string):
+        """
+        Decode and dispatch a request, see stringReceived.
+
+        @type string: str
+        @param string: The request
+
+        @rtype: Deferred or None
+        @return: See stringReceived
+        """
+
+        timing = self._startTiming()
         self._logRequest(string)
+        self._observeRequest(len(string))
         try:
-            request_content = jsonrpc.decodeRequest(string)
-        except jsonrpc.JSONRPCError:
-            self._parseError()
+            request_content = self._decodeRequestString(string)
+        except jsonrpc.JSONRPCError as e:
+            self._requestError(e, timing)
             return None
 
+        if isinstance(request_content, Deferred):
+            if timing is not None:
+                request_content.addBoth(timing.cbAdd, 'decode', timing.start)
+            return request_content.addCallbacks(self._dispatchContent,
+                                                self._ebRequestError,
+                                                callbackArgs=(timing,),
+                                                errbackArgs=(timing,))
+
+        if timing is not None:
+            timing.add('decode', timing.start)
+        return self._dispatchContent(request_content, timing)
+
+    def _dispatchContent(self, request_content, timing=None):
+        """
+        Dispatch the decoded request. The response is sent once all methods
+        have returned.
+
+        @type request_content: mixed
+        @param request_content: Decoded request, see _decodeRequestString
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+
+        @rtype: Deferred or None
+        @return: See stringReceived
+        """
+
         is_batch = True
-        if not isinstance(request_content, list):
+        if not isinstance(request_content, (list, jsonrpc.BatchParser)):
             request_content = [request_content]
             is_batch = False
 
-        dl = []
-        for request_dict in request_content:
-            d = succeed(request_dict)
-            d.addCallback(jsonrpc.verifyMethodCall)
-            d.addCallback(self._callMethod)
-            d.addBoth(jsonrpc.prepareMethodResponse, request_dict['id'],
-                      request_dict['jsonrpc'])
-            dl.append(d)
+        if is_batch and self.streamBatches and not self._isPipelined():
+            return self._streamBatch(request_content, timing)
 
-        dl = DeferredList(dl, consumeErrors=True)
-        dl.addBoth(self._cbFinishRequest, is_batch)
+        try:
+            responses = self._dispatchRequest(request_content, timing=timing)
+        except jsonrpc.JSONRPCError as e:
+            self._requestError(e, timing)
+            return None
 
-        return dl
+        if isinstance(responses, Deferred):
+            responses.addCallbacks(self._cbFinishRequest, self._ebRequestError,
+                                   callbackArgs=(is_batch, timing),
+                                   errbackArgs=(timing,))
+            return responses
 
-    def _cbFinishRequest(self, results, is_batch):
+        self._cbFinishRequest(responses, is_batch, timing)
+        return None
+
+    def _streamBatch(self, request_content, timing=None):
+        """
+        Dispatch a batch in the framed mode: every method response is sent
+        as a netstring of its own as soon as it's ready, then an empty
+        netstring marks the end of the response and we close the
+        connection (unless it's persistent). If the batch turns out to be
+        malformed only after some responses have been sent (see
+        incrementalParseSize), the error response is sent as the last one.
+
+        @type request_content: list or jsonrpc.BatchParser
+        @param request_content: Decoded method calls
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+
+        @rtype: Deferred or None
+        @return: Deferred firing when the response has been sent, None if
+            it's been sent already.
+        """
+
+        size = [0]
+
+        def write(response):
+            self._logResponse(response)
+            if timing is not None:
+                start = timing.now()
+            self.sendString(response)
+            if timing is not None:
+                timing.add('write', start)
+            size[0] += len(response)
+
+        def finish(_):
+            self.sendString('')
+            self._observeResponse(size[0])
+            self._finishTiming(timing)
+            self._requestFinished()
+
+        def failed(failure):
+            error = self._errorFromFailure(failure)
+            write(jsonrpc.requestError(error, self.codec))
+            finish(None)
+
+        try:
+            d = self._streamRequest(request_content, write, timing)
+        except Exception:
+            failed(Failure())
+            return None
+
+        if isinstance(d, Deferred):
+            return d.addCallbacks(finish, failed)
+
+        finish(None)
+        return None
+
+    def _cbFinishRequest(self, results, is_batch, timing=None):
         """
         Manages sending the response to the client and finishing the request.
         This gets called after all methods have returned.
 
         @type results: list
-        @param results: List of tuples (success, result) what DeferredList
-            returned.
+        @param results: Serialized method responses
 
         @type is_batch: bool
         @param is_batch: True if the request was a batch, False if it wasn't
-        """
-
-        method_responses = []
-        for (success, result) in results:
-            if result is not None:
-                method_responses.append(result)
 
-        if not is_batch and len(method_responses) == 1:
-            method_responses = method_responses[0]
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+        """
 
-        response = jsonrpc.prepareCallResponse(method_responses)
-        self._sendResponse(response)
+        if timing is not None:
+            start = timing.now()
+        response = jsonrpc.encodeCallResponse(results, is_batch)
+        if timing is not None:
+            timing.add('encode', start)
+        self._sendResponse(response, timing)
 
     def _logResponse(self, response):
         """
@@ -171,18 +476,28 @@ class JSONRPCServer(basic.NetstringReceiver):
         if self.verbose:
             log.msg('Outgoing response: %s' % response)
 
-    def _sendResponse(self, response):
+    def _sendResponse(self, response, timing=None):
         """
-        Send the response to the client and close the connection.
+        Send the response to the client and close the connection (unless
+        it's persistent).
 
         @type response: str|unicode
         @param response: The JSON-encoded response to send
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
         """
 
         if response != '[]':
             # '[]' is result of a notification, or a batch with notifications
             # only
             self._logResponse(response)
+            if timing is not None:
+                start = timing.now()
             self.sendString(response)
+            if timing is not None:
+                timing.add('write', start)
+            self._observeResponse(len(response))
 
-        self.transport.loseConnection()
+        self._finishTiming(timing)
+        self._requestFinished()
@@ -0,0 +1,378 @@
+"""
+Copyright 2012 Tadeas Moravec
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+
+============
+Process pool
+============
+
+Provides ProcessPool, a pool of local worker processes running CPU-bound
+jsonrpc_ methods, so a single server can use every core of the machine.
+
+The workers are plain Python processes talking to the pool via netstrings
+on their stdin and stdout. A call is sent as JSON
+[module, class, method, args, kwargs, raw_params], the worker answers with
+'R' followed by the JSON encoded result, or 'E' followed by a JSON encoded
+error. The result is passed on as jsonrpc.RawJSON, so it's never decoded
+in the server process.
+"""
+
+import multiprocessing
+import os
+import sys
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols import basic
+from twisted.python import log
+
+import jsonrpc
+
+_WORKER_CODE = 'from fastjsonrpc.processpool import runWorker; runWorker()'
+
+
+class WorkerProtocol(basic.NetstringReceiver, ProcessProtocol):
+    """
+    Our side of a worker process. Handles one call at a time.
+    """
+
+    MAX_LENGTH = 2 ** 31
+
+    def __init__(self, pool):
+        """
+        @type pool: ProcessPool
+        @param pool: The pool this worker belongs to
+        """
+
+        self.pool = pool
+        self.calls = 0
+        self.call = None
+        self.ended = Deferred()
+
+    def outReceived(self, data):
+        """
+        Worker's stdout carries the responses.
+        """
+
+        self.dataReceived(data)
+
+    def errReceived(self, data):
+        """
+        Worker's stderr (including whatever the methods print) goes to log.
+        """
+
+        log.msg('Worker %s: %s' % (self.transport.pid, data.rstrip()))
+
+    def sendCall(self, message, d):
+        """
+        @type message: str
+        @param message: Serialized call
+
+        @type d: Deferred
+        @param d: Deferred to fire with the result
+        """
+
+        self.call = d
+        self.sendString(message)
+
+    def stringReceived(self, string):
+        """
+        Fire the call's Deferred with the result.
+
+        @type string: str
+        @param string: The worker's response
+        """
+
+        d, self.call = self.call, None
+        self.calls += 1
+
+        if string[:1] == 'R':
+            result = jsonrpc.RawJSON(string[1:])
+        else:
+            error = jsonrpc.jloads(string[1:], self.pool.codec)
+            result = jsonrpc.JSONRPCError(error['message'], error['code'],
+                                          error.get('data'))
+
+        self.pool._workerFinished(self)
+        if d is not None:
+            if isinstance(result, Exception):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def stop(self):
+        """
+        Ask the worker to exit, by closing its stdin.
+        """
+
+        self.transport.closeStdin()
+
+    def processEnded(self, reason):
+        """
+        The worker exited. If it was in the middle of a call (i.e. it
+        crashed), the call fails with INTERNAL_ERROR.
+
+        @type reason: t.p.f.Failure
+        @param reason: Why the process ended
+        """
+
+        d, self.call = self.call, None
+        self.pool._workerEnded(self)
+
+        if d is not None:
+            log.msg('Worker %s died: %s' % (self.transport.pid,
+                                             reason.value))
+            d.errback(jsonrpc.JSONRPCError('Worker process died',
+                                           jsonrpc.INTERNAL_ERROR))
+
+        self.ended.callback(None)
+
+
+class ProcessPool(object):
+    """
+    A pool of worker processes. Workers are started on demand, up to size of
+    them, and each runs one call at a time. Calls beyond that wait in a
+    queue.
+
+    Methods run in a worker get a bare instance of their class (__init__ is
+    not called), so they must not depend on the state of the server. The
+    class must be importable by the worker.
+    """
+
+    def __init__(self, size=None, maxCallsPerWorker=None, codec=None,
+                 executable=None):
+        """
+        @type size: int
+        @param size: Maximum number of workers. Defaults to number of CPUs.
+
+        @type maxCallsPerWorker: int
+        @param maxCallsPerWorker: Replace a worker by a fresh one after this
+            many calls. If None, workers are never replaced.
+
+        @type codec: jsonrpc.JSONCodec or str
+        @param codec: JSON codec to talk to workers with, see
+            jsonrpc.getCodec. Results are encoded with it too.
+
+        @type executable: str
+        @param executable: Python interpreter to run the workers with.
+            Defaults to the one we run in.
+        """
+
+        self.size = size or multiprocessing.cpu_count()
+        self.maxCallsPerWorker = maxCallsPerWorker
+        self.codec = jsonrpc.getCodec(codec)
+        self.executable = executable or sys.executable
+
+        self.workers = []
+        self.idle = []
+        self.queue = []
+        self._stopping = False
+
+    def _spawnWorker(self):
+        """
+        Start a new worker process. It inherits our sys.path, so it can
+        import everything we can.
+
+        @rtype: WorkerProtocol
+        @return: The new worker
+        """
+
+        env = dict(os.environ)
+        path = [os.path.abspath(p) for p in sys.path]
+        env['PYTHONPATH'] = os.pathsep.join(path)
+        env['FASTJSONRPC_CODEC'] = self.codec.name
+
+        worker = WorkerProtocol(self)
+        reactor.spawnProcess(worker, self.executable,
+                             [self.executable, '-c', _WORKER_CODE], env=env)
+        self.workers.append(worker)
+        return worker
+
+    def callMethod(self, cls, name, args=(), kwargs=None, rawParams=False):
+        """
+        Call a method in one of the workers.
+
+        @type cls: class
+        @param cls: Class the method belongs to
+
+        @type name: str
+        @param name: Name of the method, including the jsonrpc_ prefix
+
+        @type args: list
+        @param args: Positional arguments
+
+        @type kwargs: dict
+        @param kwargs: Keyword arguments
+
+        @type rawParams: bool
+        @param rawParams: If True, args is a single jsonrpc.RawParams
+
+        @rtype: Deferred
+        @return: Deferred firing with the result as jsonrpc.RawJSON
+
+        @raise ValueError: If the arguments cannot be serialized.
+        """
+
+        if rawParams:
+            args = [args[0].json]
+
+        message = jsonrpc.jdumps([cls.__module__, cls.__name__, name,
+                                  list(args), kwargs or {}, rawParams],
+                                 self.codec)
+
+        d = Deferred()
+        if self._stopping:
+            d.errback(jsonrpc.JSONRPCError('Process pool stopped',
+                                           jsonrpc.INTERNAL_ERROR))
+        elif self.idle:
+            self.idle.pop().sendCall(message, d)
+        elif len(self.workers) < self.size:
+            self._spawnWorker().sendCall(message, d)
+        else:
+            self.queue.append((message, d))
+
+        return d
+
+    def _workerFinished(self, worker):
+        """
+        A worker finished a call. Give it another, or retire it if it's done
+        enough of them.
+        """
+
+        if (self.maxCallsPerWorker is not None and
+                worker.calls >= self.maxCallsPerWorker):
+            self.workers.remove(worker)
+            worker.stop()
+            if self.queue:
+                self._spawnWorker().sendCall(*self.queue.pop(0))
+        elif self.queue:
+            worker.sendCall(*self.queue.pop(0))
+        else:
+            self.idle.append(worker)
+
+    def _workerEnded(self, worker):
+        """
+        A worker exited, be it retired, stopped or crashed.
+        """
+
+        if worker in self.workers:
+            self.workers.remove(worker)
+        if worker in self.idle:
+            self.idle.remove(worker)
+
+        if self.queue and not self._stopping:
+            self._spawnWorker().sendCall(*self.queue.pop(0))
+
+    def stop(self):
+        """
+        Stop all workers. Queued calls fail with INTERNAL_ERROR, and so do
+        calls made until the workers have exited. After that the pool starts
+        workers again on demand.
+
+        @rtype: Deferred
+        @return: Deferred firing when all workers have exited
+        """
+
+        self._stopping = True
+
+        queue, self.queue = self.queue, []
+        for _, d in queue:
+            d.errback(jsonrpc.JSONRPCError('Process pool stopped',
+                                           jsonrpc.INTERNAL_ERROR))
+
+        ended = [worker.ended for worker in self.workers]
+        for worker in self.workers:
+            worker.stop()
+
+        d = DeferredList(ended)
+        d.addCallback(self._stopped)
+        return d
+
+    def _stopped(self, result):
+        """
+        All workers have exited, the pool can be used again.
+        """
+
+        self._stopping = False
+        return result
+
+
+def _readNetstring(stream):
+    """
+    Blocking read of one netstring.
+
+    @rtype: str
+    @return: The string, None at the end of the stream
+    """
+
+    length = ''
+    while True:
+        char = stream.read(1)
+        if not char:
+            return None
+        if char == ':':
+            break
+        length += char
+
+    string = stream.read(int(length))
+    if stream.read(1) != ',':
+        raise ValueError('Malformed netstring')
+    return string
+
+
+def runWorker():
+    """
+    Main loop of a worker process. Reads calls from stdin and writes their
+    results to stdout, until stdin is closed.
+    """
+
+    codec = jsonrpc.getCodec(os.environ.get('FASTJSONRPC_CODEC'))
+
+    # Keep stdout for the responses, anything the methods print goes to
+    # stderr and gets logged by the server.
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    instances = {}
+
+    while True:
+        message = _readNetstring(sys.stdin)
+        if message is None:
+            return
+
+        try:
+            module, cls, name, args, kwargs, raw = codec.loads(message)
+            kwargs = dict((str(k), v) for k, v in kwargs.iteritems())
+
+            if (module, cls) not in instances:
+                __import__(module)
+                klass = getattr(sys.modules[module], cls)
+                instances[(module, cls)] = klass.__new__(klass)
+            function = getattr(instances[(module, cls)], name)
+
+            if raw:
+                args = [jsonrpc.RawParams(args[0], codec)]
+
+            result = function(*args, **kwargs)
+            if isinstance(result, jsonrpc.RawJSON):
+                response = 'R' + result.json
+            else:
+                response = 'R' + codec.dumps(result)
+        except Exception as e:
+            response = 'E' + codec.dumps(jsonrpc._getErrorResponse(e))
+
+        output.write('%d:%s,' % (len(response), response))
+        output.flush()
@@ -21,26 +21,79 @@ JSONRPC Server
 Provides JSONRPCServer class, which can be used to expose methods via RPC.
 """
 
+from cStringIO import StringIO
+
+from zope.interface import implements
+from twisted.web import http
+from twisted.web import iweb
 from twisted.web import resource
 from twisted.web import server
-from twisted.internet.defer import maybeDeferred
-from twisted.internet.defer import DeferredList
-from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred
+from twisted.python import log
+from twisted.python.failure import Failure
 
+import compression
 import jsonrpc
+from dispatch import JSONRPCDispatcher
+from limiter import OverloadedError
+
+# A chunk of zeros can decompress to a thousand times its size, keep it
+# small so the checks of maxRequestSize aren't too late.
+DECOMPRESS_CHUNK_SIZE = 2 ** 13
+
+# Limit of a decompressed request body, unless maxRequestSize is set
+MAX_DECOMPRESSED_SIZE = 2 ** 26
 
 
-class JSONRPCServer(resource.Resource):
+class JSONRPCServer(JSONRPCDispatcher, resource.Resource):
     """
     JSON-RPC server. Subclass this, implement your own methods and publish
     this as t.w.r.Resource using t.w.s.Site.
 
     It will expose all methods that start with 'jsonrpc_' (without the
     'jsonrpc_' part).
+
+    The JSON library used for requests and responses is picked by the codec
+    attribute: a name of a codec registered in jsonrpc (e.g. 'simplejson'),
+    a jsonrpc.JSONCodec instance, or None for the default one. Set it in
+    a subclass or on the instance.
+
+    A request bigger than maxRequestSize is answered with 413 Request Entity
+    Too Large. Request bodies compressed with any registered content coding
+    (see compression) are decompressed, the limit applies to both the
+    compressed and the decompressed body. Without maxRequestSize, the
+    decompressed body is still limited by maxDecompressedSize, so a small
+    body can't blow up into gigabytes. Other codings are answered with 415
+    Unsupported Media Type.
+
+    With streamBatches set, the response to a batch is sent with chunked
+    transfer encoding, each method response as soon as it's ready.
+
+    A single call rejected by a concurrency limit (see maxConcurrentCalls
+    and dispatch.limited) is answered with 503 Service Unavailable, calls
+    of a batch with SERVER_OVERLOADED errors.
+
+    Responses are compressed if compression lists the content codings to
+    use (e.g. ['gzip', 'deflate'], see compression.availableEncodings), the
+    preferred ones first. The coding is negotiated with the client via the
+    Accept-Encoding header. Responses shorter than compressionMinSize are
+    sent as they are, compressing them isn't worth the time.
+    compressionLevel is passed to the compression library, None means its
+    default.
+
+    With timePhases and serverTimingHeader set, the time spent in each
+    phase (see metrics.RequestTiming) until the response is written is
+    sent in a Server-Timing header.
     """
 
     isLeaf = 1
 
+    maxDecompressedSize = MAX_DECOMPRESSED_SIZE
+    compression = None
+    compressionMinSize = 1024
+    compressionLevel = None
+    serverTimingHeader = False
+
     def _getRequestContent(self, request):
         """
         Parse the JSON from the request. Return it as a list, even if there was
@@ -52,59 +105,162 @@ class JSONRPCServer(resource.Resource):
         @param request: The request from client
 
         @rtype: list
-        @return: List of dicts, one dict per method call.
-
-        @raise JSONRPCError: If there's error in parsing.
+        @return: List of dicts, one dict per method call. Or
+            a jsonrpc.BatchParser, if the request is a batch bigger than
+            incrementalParseSize. Or a Deferred firing with either, if the
+            request is bigger than threadedDecodeSize.
+
+        @raise JSONRPCError: If there's error in parsing, the request is
+            bigger than maxRequestSize or compressed with a coding we don't
+            support.
         """
 
+        # twisted.web has already received the body (keeping a big one in
+        # a temporary file), we just don't read a too big one.
+        request.content.seek(0, 2)
+        size = request.content.tell()
+        self._observeRequest(size)
+        if self.maxRequestSize is not None and size > self.maxRequestSize:
+            request.setResponseCode(http.REQUEST_ENTITY_TOO_LARGE)
+            raise jsonrpc.requestTooLarge(self.maxRequestSize)
         request.content.seek(0, 0)
-        request_json = request.content.read()
-        request_content = jsonrpc.decodeRequest(request_json)
+
+        stream = request.content
+        content_encoding = request.getHeader('Content-Encoding')
+        if content_encoding and content_encoding.lower() != 'identity':
+            stream, size = self._decompressContent(request, content_encoding)
+
+        request_content = self._decodeRequestStream(stream, size)
 
         return request_content
 
-    def _parseError(self, request):
+    def _decompressContent(self, request, content_encoding):
+        """
+        Decompress a request body sent with Content-Encoding. The limit of
+        maxRequestSize (or maxDecompressedSize, if it's not set) applies to
+        the decompressed body, and is checked as we go, so a small body
+        can't blow up into a huge one.
+
+        @type request: t.w.s.Request
+        @param request: The request from client
+
+        @type content_encoding: str
+        @param content_encoding: Value of the Content-Encoding header
+
+        @rtype: tuple
+        @return: The decompressed body as a file-like object, and its length
+
+        @raise JSONRPCError: If we don't support the coding, the body is
+            corrupt or too big when decompressed.
+        """
+
+        try:
+            encoding = compression.getEncoding(content_encoding.lower())
+        except ValueError:
+            request.setResponseCode(http.UNSUPPORTED_MEDIA_TYPE)
+            raise jsonrpc.JSONRPCError('Unsupported content encoding: %s' %
+                                       content_encoding,
+                                       jsonrpc.INVALID_REQUEST)
+
+        limit = self.maxRequestSize
+        if limit is None:
+            limit = self.maxDecompressedSize
+
+        decompressor = encoding.decompressor()
+        chunks = []
+        size = 0
+        try:
+            while True:
+                compressed = request.content.read(DECOMPRESS_CHUNK_SIZE)
+                if compressed:
+                    data = decompressor.decompress(compressed)
+                else:
+                    data = decompressor.finish()
+
+                size += len(data)
+                if limit is not None and size > limit:
+                    request.setResponseCode(http.REQUEST_ENTITY_TOO_LARGE)
+                    raise jsonrpc.requestTooLarge(limit)
+                chunks.append(data)
+
+                if not compressed:
+                    break
+        except compression.DecompressionError:
+            raise jsonrpc.JSONRPCError('Parse error', jsonrpc.PARSE_ERROR)
+
+        return StringIO(''.join(chunks)), size
+
+    def _parseError(self, request, timing=None):
         """
         Coin a 'parse error' response and finish the request.
 
         @type request: t.w.s.Request
         @param request: Request from client
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
         """
 
-        response = jsonrpc.parseError()
-        self._sendResponse(response, request)
+        response = jsonrpc.parseError(self.codec)
+        self._sendResponse(response, request, timing)
 
-    def _callMethod(self, request_dict):
+    def _requestError(self, error, request, timing=None):
         """
-        Here we actually find and call the method.
+        Answer a request that can't be dispatched (e.g. a malformed one) with
+        an error and finish it.
 
-        @type request_dict: dict
-        @param request_dict: Dict with details about the method
+        @type error: jsonrpc.JSONRPCError
+        @param error: What's wrong with the request
 
-        @rtype: Deferred
-        @return: Deferred, that will eventually fire with the method's result.
+        @type request: t.w.s.Request
+        @param request: Request from client
 
-        @raise JSONRPCError: When method not found.
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
         """
 
-        function = getattr(self, 'jsonrpc_%s' % request_dict['method'], None)
-        if callable(function):
+        if error.errno == jsonrpc.PARSE_ERROR:
+            self._parseError(request, timing)
+            return
 
-            if 'params' in request_dict:
-                if isinstance(request_dict['params'], dict):
-                    d = maybeDeferred(function, **request_dict['params'])
-                else:
-                    d = maybeDeferred(function, *request_dict['params'])
-            else:
-                d = maybeDeferred(function)
+        response = jsonrpc.requestError(error, self.codec)
+        self._sendResponse(response, request, timing)
 
-            return d
+    def _ebRequestError(self, failure, request, timing=None):
+        """
+        Errback answering a request found malformed (or too long) only while
+        it was being decoded in a thread or dispatched, see
+        threadedDecodeSize and incrementalParseSize. Any other failure is
+        logged and answered with INTERNAL_ERROR, so the request is finished
+        either way.
 
-        else:
-            msg = 'Method %s not found' % request_dict['method']
-            raise jsonrpc.JSONRPCError(msg, jsonrpc.METHOD_NOT_FOUND,
-                                       id_=request_dict['id'],
-                                       version=request_dict['jsonrpc'])
+        @type failure: t.p.f.Failure
+        @param failure: Failure wrapping the jsonrpc.JSONRPCError
+
+        @type request: t.w.s.Request
+        @param request: Request from client
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+        """
+
+        self._requestError(self._errorFromFailure(failure), request, timing)
+
+    def _errorFromFailure(self, failure):
+        """
+        @type failure: t.p.f.Failure
+        @param failure: Failure of a request
+
+        @rtype: jsonrpc.JSONRPCError
+        @return: The error to answer the request with. INTERNAL_ERROR for
+            anything but a JSONRPCError, which is logged.
+        """
+
+        if failure.check(jsonrpc.JSONRPCError):
+            return failure.value
+
+        log.err(failure, 'Unexpected failure processing a request')
+        return jsonrpc.JSONRPCError('Internal error', jsonrpc.INTERNAL_ERROR)
 
     def render(self, request):
         """
@@ -116,64 +272,235 @@ class JSONRPCServer(resource.Resource):
         @param request: Request from client
 
         @rtype: some constant :-)
-        @return: NOT_DONE_YET signalizing, that there's Deferred, that will
-            take care about sending the response.
+        @return: NOT_DONE_YET signalizing, that we take care about sending
+            the response. If no method returned a Deferred, it's already been
+            sent.
 
         @TODO verbose mode
         """
 
+        timing = self._startTiming()
+
         try:
             request_content = self._getRequestContent(request)
-        except jsonrpc.JSONRPCError:
-            self._parseError(request)
+        except jsonrpc.JSONRPCError as e:
+            self._requestError(e, request, timing)
             return server.NOT_DONE_YET
 
+        if isinstance(request_content, Deferred):
+            if timing is not None:
+                request_content.addBoth(timing.cbAdd, 'decode', timing.start)
+            request_content.addCallbacks(self._dispatchContent,
+                                         self._ebRequestError,
+                                         callbackArgs=(request, timing),
+                                         errbackArgs=(request, timing))
+        else:
+            if timing is not None:
+                timing.add('decode', timing.start)
+            self._dispatchContent(request_content, request, timing)
+
+        return server.NOT_DONE_YET
+
+    def _dispatchContent(self, request_content, request, timing=None):
+        """
+        Dispatch the decoded request. The response is sent once all methods
+        have returned.
+
+        @type request_content: mixed
+        @param request_content: Decoded request, see _getRequestContent
+
+        @type request: t.w.s.Request
+        @param request: Request from client
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+        """
+
         is_batch = True
-        if not isinstance(request_content, list):
+        if not isinstance(request_content, (list, jsonrpc.BatchParser)):
             request_content = [request_content]
             is_batch = False
 
-        dl = []
-        for request_dict in request_content:
-            d = succeed(request_dict)
-            d.addCallback(jsonrpc.verifyMethodCall)
-            d.addCallback(self._callMethod)
-            d.addBoth(jsonrpc.prepareMethodResponse, request_dict['id'],
-                      request_dict['jsonrpc'])
-            dl.append(d)
+        if is_batch and self.streamBatches:
+            self._streamBatch(request_content, request, timing)
+            return
+
+        try:
+            responses = self._dispatchRequest(request_content, not is_batch,
+                                              timing)
+        except OverloadedError as e:
+            self._overloaded(e, request_content[0], request, timing)
+            return
+        except jsonrpc.JSONRPCError as e:
+            self._requestError(e, request, timing)
+            return
+
+        if isinstance(responses, Deferred):
+            responses.addCallbacks(self._cbFinishRequest, self._ebRequestError,
+                                   callbackArgs=(request, is_batch, timing),
+                                   errbackArgs=(request, timing))
+        else:
+            self._cbFinishRequest(responses, request, is_batch, timing)
+
+    def _streamBatch(self, request_content, request, timing=None):
+        """
+        Dispatch a batch and write the method responses as they're ready,
+        using chunked transfer encoding. Together they make up the usual JSON
+        array, but in the order the calls finish.
 
-        dl = DeferredList(dl, consumeErrors=True)
-        dl.addBoth(self._cbFinishRequest, request, is_batch)
+        If the batch turns out to be malformed only after some responses
+        have been written (see incrementalParseSize), the error response is
+        the last element of the array.
 
-        return server.NOT_DONE_YET
+        The length isn't known beforehand, so the response is compressed
+        regardless of compressionMinSize. The headers are sent with the
+        first response, too early for a Server-Timing header.
+
+        @type request_content: list or jsonrpc.BatchParser
+        @param request_content: Decoded method calls
+
+        @type request: t.w.s.Request
+        @param request: The request that came from a client
 
-    def _cbFinishRequest(self, results, request, is_batch):
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+        """
+
+        written = [False]
+        encoding = self._negotiateEncoding(request)
+        compressor = [None]
+        size = [0]
+
+        def send(data, last=False):
+            if timing is not None:
+                start = timing.now()
+            if compressor[0] is not None:
+                data = compressor[0].compress(data)
+                if last:
+                    data += compressor[0].finish()
+                else:
+                    # flush, so the client can decompress what it's got
+                    data += compressor[0].flush()
+            if timing is not None:
+                start = timing.add('encode', start)
+            size[0] += len(data)
+            request.write(data)
+            if timing is not None:
+                timing.add('write', start)
+
+        def write(response):
+            if written[0]:
+                send(', ' + response)
+                return
+
+            request.setHeader('Content-Type', 'application/json')
+            if encoding is not None:
+                request.setHeader('Content-Encoding', encoding.name)
+                compressor[0] = encoding.compressor(self.compressionLevel)
+            send('[' + response)
+            written[0] = True
+
+        def finish(_):
+            if written[0]:
+                send(']', last=True)
+                self._observeResponse(size[0])
+            # else it was a batch with notifications only, no response
+            request.finish()
+            self._finishTiming(timing)
+
+        def failed(failure):
+            error = self._errorFromFailure(failure)
+            if not written[0]:
+                self._requestError(error, request, timing)
+                return
+            write(jsonrpc.requestError(error, self.codec))
+            finish(None)
+
+        try:
+            d = self._streamRequest(request_content, write, timing)
+        except Exception:
+            failed(Failure())
+            return
+
+        if isinstance(d, Deferred):
+            d.addCallbacks(finish, failed)
+        else:
+            finish(None)
+
+    def _overloaded(self, error, request_dict, request, timing=None):
+        """
+        Answer a single call rejected by a concurrency limit with 503
+        Service Unavailable. The body is the usual error response.
+
+        @type error: limiter.OverloadedError
+        @param error: Why the call was rejected
+
+        @type request_dict: dict
+        @param request_dict: The call
+
+        @type request: t.w.s.Request
+        @param request: The request that came from a client
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+        """
+
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        response = jsonrpc.encodeMethodResponse(error, request_dict.get('id'),
+                                                request_dict.get('jsonrpc'),
+                                                self.codec)
+        self._cbFinishRequest([response], request, False, timing)
+
+    def _cbFinishRequest(self, results, request, is_batch, timing=None):
         """
         Manages sending the response to the client and finishing the request.
         This gets called after all methods have returned.
 
         @type results: list
-        @param results: List of tuples (success, result) what DeferredList
-            returned.
+        @param results: Serialized method responses
 
         @type request: t.w.s.Request
         @param request: The request that came from a client
 
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
+
         @TODO: document is_batch
         """
 
-        method_responses = []
-        for (success, result) in results:
-            if result is not None:
-                method_responses.append(result)
+        if timing is not None:
+            start = timing.now()
+        response = jsonrpc.encodeCallResponse(results, is_batch)
+        if timing is not None:
+            timing.add('encode', start)
+        self._sendResponse(response, request, timing)
+
+    def _negotiateEncoding(self, request, size=None):
+        """
+        Pick the content coding of the response, see compression.
+
+        @type request: t.w.s.Request
+        @param request: The request that came from a client
+
+        @type size: int
+        @param size: Length of the response, None if it's not known
+
+        @rtype: compression.ContentEncoding
+        @return: The coding, None to send the response uncompressed
+        """
+
+        if not self.compression:
+            return None
 
-        if not is_batch and len(method_responses) == 1:
-            method_responses = method_responses[0]
+        # the response depends on the header, caches have to know
+        request.setHeader('Vary', 'Accept-Encoding')
+        if size is not None and size < self.compressionMinSize:
+            return None
 
-        response = jsonrpc.prepareCallResponse(method_responses)
-        self._sendResponse(response, request)
+        return compression.negotiateEncoding(
+            request.getHeader('Accept-Encoding'), self.compression)
 
-    def _sendResponse(self, response, request):
+    def _sendResponse(self, response, request, timing=None):
         """
         Send the response back to client. Expects it to be already serialized
         into JSON.
@@ -183,29 +510,149 @@ class JSONRPCServer(resource.Resource):
 
         @type request: t.w.s.Request
         @param request The request that came from a client
+
+        @type timing: metrics.RequestTiming
+        @param timing: Timing of the request, None if we don't time it
         """
 
         if response != '[]':
             # '[]' is result of batch request with notifications only
             request.setHeader('Content-Type', 'application/json')
+            if timing is not None:
+                start = timing.now()
+            encoding = self._negotiateEncoding(request, len(response))
+            if encoding is not None:
+                response = encoding.compress(response, self.compressionLevel)
+                request.setHeader('Content-Encoding', encoding.name)
             request.setHeader('Content-Length', str(len(response)))
+            self._observeResponse(len(response))
+            if timing is not None:
+                start = timing.add('encode', start)
+                if self.serverTimingHeader:
+                    request.setHeader('Server-Timing', timing.serverTiming())
             request.write(response)
+            if timing is not None:
+                timing.add('write', start)
 
         request.finish()
+        self._finishTiming(timing)
 
 
-def EncodingJSONRPCServer(server):
+class ContentEncoderFactory(object):
+    """
+    Compresses responses of any resource wrapped in
+    t.w.r.EncodingResourceWrapper with it, with a content coding negotiated
+    via the Accept-Encoding header. See EncodingJSONRPCServer.
     """
-    Return wrapped JSON-RPC server that supports HTTP compression (currently
-    gzip).
+
+    implements(iweb._IRequestEncoderFactory)
+
+    def __init__(self, encodings=None, minSize=0, level=None):
+        """
+        @type encodings: list
+        @param encodings: Names of content codings to use, the preferred
+            ones first. Defaults to all available ones.
+
+        @type minSize: int
+        @param minSize: Don't compress responses whose first write is
+            shorter than this.
+
+        @type level: int
+        @param level: Compression level, None for the libraries' defaults
+        """
+
+        if encodings is None:
+            encodings = compression.availableEncodings()
+
+        self.encodings = encodings
+        self.minSize = minSize
+        self.level = level
+
+    def encoderForRequest(self, request):
+        """
+        @type request: t.w.s.Request
+        @param request: The request that came from a client
+
+        @rtype: _ContentEncoder
+        @return: Encoder of the response, None if the client doesn't accept
+            any of our codings
+        """
+
+        # the response depends on the header, caches have to know
+        request.setHeader('Vary', 'Accept-Encoding')
+        encoding = compression.negotiateEncoding(
+            request.getHeader('Accept-Encoding'), self.encodings)
+        if encoding is None:
+            return None
+        return _ContentEncoder(encoding, self.minSize, self.level, request)
+
+
+class _ContentEncoder(object):
+    """
+    Compresses a response on the fly. Whether to compress it at all is
+    decided on its first write, when the headers are about to be sent.
+    """
+
+    implements(iweb._IRequestEncoder)
+
+    def __init__(self, encoding, minSize, level, request):
+        self._encoding = encoding
+        self._minSize = minSize
+        self._level = level
+        self._request = request
+        self._compressor = None
+        self._passThrough = False
+
+    def encode(self, data):
+        if self._passThrough:
+            return data
+
+        if self._compressor is None:
+            headers = self._request.responseHeaders
+            if (len(data) < self._minSize or
+                    headers.hasHeader('content-encoding')):
+                # too short, or already compressed by the resource
+                self._passThrough = True
+                return data
+
+            # we can't know the compressed length beforehand
+            headers.removeHeader('content-length')
+            headers.setRawHeaders('content-encoding', [self._encoding.name])
+            self._compressor = self._encoding.compressor(self._level)
+
+        # flush, so streamed responses reach the client as they're written
+        return self._compressor.compress(data) + self._compressor.flush()
+
+    def finish(self):
+        if self._compressor is None:
+            return ''
+        return self._compressor.finish()
+
+
+def EncodingJSONRPCServer(server, encodings=None, minSize=0, level=None):
+    """
+    Return wrapped JSON-RPC server that supports HTTP compression, with the
+    content coding negotiated via Accept-Encoding. The server itself is left
+    as it is, so it can be mounted uncompressed too. To compress responses
+    of a JSONRPCServer without a wrapper, set its compression attributes.
 
     @type server: t.w.r.Resource
-    @param server: Instance of JSONRPCServer
+    @param server: Instance of JSONRPCServer, or any other resource
+
+    @type encodings: list
+    @param encodings: Names of content codings to use, the preferred ones
+        first. Defaults to all available ones.
+
+    @type minSize: int
+    @param minSize: Don't compress responses shorter than this. The default
+        is to compress all of them.
+
+    @type level: int
+    @param level: Compression level, None for the libraries' defaults
 
     @rtype: t.w.r.EncodingResourceWrapper
     @return: Wrapper that implements HTTP compression
     """
-    from twisted.web.resource import EncodingResourceWrapper
-    from twisted.web.server import GzipEncoderFactory
 
-    return EncodingResourceWrapper(server, [GzipEncoderFactory()])
+    return resource.EncodingResourceWrapper(
+        server, [ContentEncoderFactory(encodings, minSize, level)])
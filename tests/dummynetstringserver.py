@@ -3,6 +3,7 @@ import sys
 sys.path.insert(0, os.path.abspath('..'))
 
 from fastjsonrpc.netstringserver import JSONRPCServer
+from fastjsonrpc.jsonrpc import RawJSON
 from twisted.enterprise import adbapi
 
 MYSQL_SERVER = 'localhost'
@@ -24,6 +25,9 @@ class DummyProtocol(JSONRPCServer):
     def jsonrpc_add(self, a, b):
         return a + b
 
+    def jsonrpc_rawJSON(self):
+        return RawJSON('{"cached": [1, 2]}')
+
     def jsonrpc_mysql_first_user(self):
         def capitalize(sql_result):
             if sql_result:
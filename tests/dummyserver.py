@@ -7,6 +7,7 @@ from zope.interface import implements
 from twisted.cred.portal import IRealm
 from twisted.web.resource import IResource
 from fastjsonrpc.server import JSONRPCServer
+from fastjsonrpc.jsonrpc import RawJSON
 
 DBFILE = 'sqlite.db'
 
@@ -33,6 +34,9 @@ class DummyServer(JSONRPCServer):
     def jsonrpc_returnNone(self):
         return None
 
+    def jsonrpc_rawJSON(self):
+        return RawJSON('{"cached": [1, 2]}')
+
 
 class AuthDummyServer(object):
     implements(IRealm)
@@ -0,0 +1,63 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath('..'))
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from fastjsonrpc.cache import ResultCache
+
+
+class TestResultCache(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ResultCache(ttl=10, maxSize=2, clock=self.clock)
+
+    def test_miss(self):
+        self.assertEquals(self.cache.get('a'), None)
+        self.assertEquals(self.cache.misses, 1)
+
+    def test_hit(self):
+        self.cache.set('a', '1')
+        self.assertEquals(self.cache.get('a'), '1')
+        self.assertEquals(self.cache.hits, 1)
+
+    def test_expire(self):
+        self.cache.set('a', '1')
+        self.clock.advance(10)
+        self.assertEquals(self.cache.get('a'), None)
+        self.assertEquals(self.cache.expirations, 1)
+        self.assertEquals(len(self.cache), 0)
+
+    def test_noTTL(self):
+        cache = ResultCache(clock=self.clock)
+        cache.set('a', '1')
+        self.clock.advance(10 ** 6)
+        self.assertEquals(cache.get('a'), '1')
+
+    def test_evictLeastRecentlyUsed(self):
+        self.cache.set('a', '1')
+        self.cache.set('b', '2')
+        self.cache.get('a')
+        self.cache.set('c', '3')
+
+        self.assertEquals(self.cache.get('b'), None)
+        self.assertEquals(self.cache.get('a'), '1')
+        self.assertEquals(self.cache.get('c'), '3')
+        self.assertEquals(self.cache.evictions, 1)
+
+    def test_overwrite(self):
+        self.cache.set('a', '1')
+        self.cache.set('a', '2')
+        self.assertEquals(self.cache.get('a'), '2')
+        self.assertEquals(len(self.cache), 1)
+
+    def test_stats(self):
+        self.cache.set('a', '1')
+        self.cache.get('a')
+        self.cache.get('b')
+        self.cache.clear()
+        expected = {'hits': 1, 'misses': 1, 'evictions': 0, 'expirations': 0,
+                    'size': 0}
+        self.assertEquals(self.cache.stats(), expected)
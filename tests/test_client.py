@@ -2,6 +2,8 @@ import os
 import sys
 sys.path.insert(0, os.path.abspath('..'))
 
+import zlib
+
 from twisted.trial.unittest import TestCase, SkipTest
 from twisted.internet.defer import Deferred
 from twisted.web.server import Site
@@ -19,8 +21,8 @@ from twisted.web.guard import HTTPAuthSessionWrapper, BasicCredentialFactory
 from fastjsonrpc.client import ReceiverProtocol
 from fastjsonrpc.client import StringProducer
 from fastjsonrpc.client import ProxyFactory
-from fastjsonrpc.client import Proxy
-from fastjsonrpc import jsonrpc
+from fastjsonrpc.client import Proxy, DecodingResponse
+from fastjsonrpc import compression, jsonrpc
 
 from dummyserver import DummyServer, AuthDummyServer
 
@@ -221,6 +223,43 @@ class TestProxy(TestCase):
         e.addCallback(finished)
         return e
 
+    def test_callRemoteCompressed(self):
+        data = 'some random string' * 100
+
+        addr = 'http://localhost:%s' % self.portNumber
+        proxy = Proxy(addr, jsonrpc.VERSION_2, requestEncoding='gzip')
+        d = proxy.callRemote('echo', data)
+
+        def finished(result):
+            self.assertEquals(result, data)
+
+        d.addCallback(finished)
+        return d
+
+    def test_requestMinSize(self):
+        requests = []
+
+        class RecordingAgent(object):
+            def request(self, method, uri, headers, body):
+                requests.append((headers, body.body))
+                return Deferred()
+
+        proxy = Proxy('', jsonrpc.VERSION_2, requestEncoding='deflate',
+                      requestMinSize=100)
+        proxy.agent = RecordingAgent()
+        proxy.callRemote('echo', 'short')
+        proxy.callRemote('echo', 'long' * 100)
+
+        headers, body = requests[0]
+        self.assertFalse(headers.hasHeader('content-encoding'))
+        self.assertEquals(jsonrpc.jloads(body)['params'], ['short'])
+
+        headers, body = requests[1]
+        self.assertEquals(headers.getRawHeaders('content-encoding'),
+                          ['deflate'])
+        self.assertEquals(jsonrpc.jloads(zlib.decompress(body))['params'],
+                          ['long' * 100])
+
     def test_keywordsV1(self):
         data = 'some random string'
 
@@ -423,6 +462,37 @@ class TestProxyFactory(TestCase):
         self.assertTrue(isinstance(proxy.agent._agent, Agent))
         self.assertTrue('gzip' in proxy.agent._decoders)
         self.assertEqual(proxy.agent._decoders['gzip'], GzipDecoder)
+        self.assertTrue('deflate' in proxy.agent._decoders)
+
+    def test_init_HTTPCompressionEncodings(self):
+
+        factory = ProxyFactory(compressedHTTP=['deflate'])
+        proxy = factory.getProxy('')
+
+        self.assertEqual(proxy.agent._supported, 'deflate')
+
+
+class TestDecodingResponse(TestCase):
+
+    class FakeResponse(object):
+        def __init__(self, chunks):
+            self.chunks = chunks
+
+        def deliverBody(self, protocol):
+            for chunk in self.chunks:
+                protocol.dataReceived(chunk)
+            protocol.connectionLost(None)
+
+    def test_deflate(self):
+        compressed = zlib.compress('{"result": 1}')
+        response = self.FakeResponse([compressed[:5], compressed[5:]])
+        response = DecodingResponse(response,
+                                    compression.getEncoding('deflate'))
+
+        finished = Deferred()
+        response.deliverBody(ReceiverProtocol(finished))
+        finished.addCallback(self.assertEquals, '{"result": 1}')
+        return finished
 
 
 class WebClientContextFactory(ssl.ClientContextFactory):
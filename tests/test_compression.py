@@ -0,0 +1,90 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath('..'))
+
+import zlib
+
+from twisted.trial.unittest import TestCase
+
+from fastjsonrpc import compression
+
+
+class TestEncodings(TestCase):
+
+    def test_available(self):
+        names = compression.availableEncodings()
+        self.assertIn('gzip', names)
+        self.assertIn('deflate', names)
+        self.assertTrue(names.index('gzip') < names.index('deflate'))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, compression.getEncoding, 'foo')
+
+    def test_gzip(self):
+        encoding = compression.getEncoding('gzip')
+        data = '{"result": "%s"}' % ('x' * 1000)
+        compressed = encoding.compress(data)
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEquals(zlib.decompress(compressed, 16 + zlib.MAX_WBITS),
+                          data)
+        self.assertEquals(encoding.decompress(compressed), data)
+
+    def test_deflate(self):
+        encoding = compression.getEncoding('deflate')
+        data = 'x' * 1000
+        self.assertEquals(zlib.decompress(encoding.compress(data, 1)), data)
+
+    def test_level(self):
+        encoding = compression.getEncoding('gzip')
+        data = ''.join(str(i) for i in range(10000))
+        self.assertTrue(len(encoding.compress(data, 9)) <
+                        len(encoding.compress(data, 0)))
+
+    def test_corrupt(self):
+        encoding = compression.getEncoding('deflate')
+        self.assertRaises(compression.DecompressionError,
+                          encoding.decompress, 'not compressed')
+
+    def test_flush(self):
+        encoding = compression.getEncoding('gzip')
+        compressor = encoding.compressor(None)
+        decompressor = encoding.decompressor()
+
+        chunk = compressor.compress('[1') + compressor.flush()
+        self.assertEquals(decompressor.decompress(chunk), '[1')
+        chunk = compressor.compress(', 2]') + compressor.finish()
+        self.assertEquals(decompressor.decompress(chunk) +
+                          decompressor.finish(), ', 2]')
+
+
+class TestNegotiate(TestCase):
+
+    def _negotiate(self, acceptEncoding, names=('gzip', 'deflate')):
+        encoding = compression.negotiateEncoding(acceptEncoding, names)
+        return encoding and encoding.name
+
+    def test_none(self):
+        self.assertEquals(self._negotiate(None), None)
+        self.assertEquals(self._negotiate(''), None)
+
+    def test_ourPreference(self):
+        self.assertEquals(self._negotiate('deflate, gzip'), 'gzip')
+
+    def test_quality(self):
+        self.assertEquals(self._negotiate('gzip;q=0.5, deflate;q=0.8'),
+                          'deflate')
+
+    def test_refused(self):
+        self.assertEquals(self._negotiate('gzip;q=0'), None)
+        self.assertEquals(self._negotiate('identity'), None)
+
+    def test_wildcard(self):
+        self.assertEquals(self._negotiate('*'), 'gzip')
+        self.assertEquals(self._negotiate('*, gzip;q=0'), 'deflate')
+
+    def test_unregistered(self):
+        self.assertEquals(self._negotiate('foo, deflate', ['foo', 'deflate']),
+                          'deflate')
+
+    def test_caseAndSpaces(self):
+        self.assertEquals(self._negotiate(' GZIP ; Q=1 '), 'gzip')
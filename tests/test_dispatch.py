@@ -0,0 +1,922 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath('..'))
+import json
+import threading
+
+from StringIO import StringIO
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from fastjsonrpc import dispatch, jsonrpc
+from fastjsonrpc.dispatch import JSONRPCDispatcher, getMethodTable, rawParams
+from fastjsonrpc.dispatch import inThread, getThreadPool, setThreadPoolSize
+from fastjsonrpc.dispatch import stopPools, cached, coalesced, limited
+from fastjsonrpc.limiter import ConcurrencyLimiter, OverloadedError
+
+
+class RawDispatcher(JSONRPCDispatcher):
+
+    @rawParams
+    def jsonrpc_store(self, params):
+        return params
+
+    def jsonrpc_echo(self, data):
+        return data
+
+
+class TestRawParams(TestCase):
+
+    def setUp(self):
+        self.dispatcher = RawDispatcher()
+
+    def _call(self, request):
+        request_dict = jsonrpc.verifyMethodCall(request)
+        return maybeDeferred(self.dispatcher._callMethod, request_dict)
+
+    def test_undecoded(self):
+        request = '{"method": "store", "params": {"doc": [1, 2]}, "id": 1}'
+        request = self.dispatcher._decodeRequest(request)
+        self.assertEquals(request['params'].json, '{"doc": [1, 2]}')
+
+        d = self._call(request)
+        d.addCallback(lambda params: self.assertEquals(params.decode(),
+                                                       {'doc': [1, 2]}))
+        return d
+
+    def test_otherMethodDecoded(self):
+        request = '{"method": "echo", "params": ["store"], "id": 1}'
+        request = self.dispatcher._decodeRequest(request)
+        self.assertEquals(request['params'], ['store'])
+
+        d = self._call(request)
+        d.addCallback(self.assertEquals, 'store')
+        return d
+
+    def test_batchWrapped(self):
+        request = '[{"method": "store", "params": [1], "id": 1}]'
+        request = self.dispatcher._decodeRequest(request)
+
+        d = self._call(request[0])
+
+        def called(params):
+            self.assertTrue(isinstance(params, jsonrpc.RawParams))
+            self.assertEquals(params.json, '[1]')
+
+        d.addCallback(called)
+        return d
+
+    def test_noParams(self):
+        d = self._call(self.dispatcher._decodeRequest('{"method": "store"}'))
+        d.addCallback(lambda params: self.assertEquals(params.decode(), []))
+        return d
+
+    def test_malformed(self):
+        self.assertRaises(jsonrpc.JSONRPCError,
+                          self.dispatcher._decodeRequest,
+                          '{"method": "store", "params": [1, }')
+
+
+class SignatureDispatcher(JSONRPCDispatcher):
+
+    def jsonrpc_defaults(self, a, b=2):
+        return [a, b]
+
+    def jsonrpc_varargs(self, a, *args):
+        return [a] + list(args)
+
+    def jsonrpc_keywords(self, a, **kwargs):
+        return kwargs
+
+    def jsonrpc_typeError(self):
+        return 1 + 'a'
+
+    @staticmethod
+    def jsonrpc_static(a):
+        return a
+
+    @classmethod
+    def jsonrpc_klass(cls, a):
+        return a
+
+
+class TestMethodTable(TestCase):
+
+    def setUp(self):
+        self.dispatcher = SignatureDispatcher()
+
+    def _call(self, method, params=None):
+        request = {'method': method, 'id': 1}
+        if params is not None:
+            request['params'] = params
+        return maybeDeferred(self.dispatcher._callMethod,
+                             jsonrpc.verifyMethodCall(request))
+
+    def _assertInvalidParams(self, method, params, message):
+        d = self.assertFailure(self._call(method, params),
+                               jsonrpc.JSONRPCError)
+
+        def failed(e):
+            self.assertEquals(e.errno, jsonrpc.INVALID_PARAMS)
+            self.assertEquals(e.strerror, message)
+
+        d.addCallback(failed)
+        return d
+
+    def test_builtOnce(self):
+        table = getMethodTable(SignatureDispatcher)
+        self.assertTrue(table is getMethodTable(SignatureDispatcher))
+        self.assertEquals(sorted(table), ['defaults', 'keywords', 'klass',
+                                          'static', 'typeError', 'varargs'])
+
+    def test_defaults(self):
+        d = self._call('defaults', [1])
+        d.addCallback(self.assertEquals, [1, 2])
+        return d
+
+    def test_defaultsKeywords(self):
+        d = self._call('defaults', {'b': 3, 'a': 1})
+        d.addCallback(self.assertEquals, [1, 3])
+        return d
+
+    def test_tooMany(self):
+        return self._assertInvalidParams(
+            'defaults', [1, 2, 3],
+            'jsonrpc_defaults() takes at most 3 arguments (4 given)')
+
+    def test_missingKeyword(self):
+        return self._assertInvalidParams(
+            'defaults', {'b': 1},
+            'jsonrpc_defaults() takes at least 2 arguments (2 given)')
+
+    def test_varargs(self):
+        d = self._call('varargs', [1, 2, 3])
+        d.addCallback(self.assertEquals, [1, 2, 3])
+        return d
+
+    def test_anyKeywords(self):
+        d = self._call('keywords', {'a': 1, 'other': 2})
+        d.addCallback(self.assertEquals, {'other': 2})
+        return d
+
+    def test_staticAndClassMethod(self):
+        d = self._call('static', ['s'])
+        d.addCallback(self.assertEquals, 's')
+        d.addCallback(lambda _: self._call('klass', ['c']))
+        d.addCallback(self.assertEquals, 'c')
+        return d
+
+    def test_typeErrorInside(self):
+        d = self._call('typeError')
+        d = self.assertFailure(d, TypeError)
+
+        def failed(e):
+            response = jsonrpc.prepareMethodResponse(e, 1)
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.INTERNAL_ERROR)
+
+        d.addCallback(failed)
+        return d
+
+    def test_instanceMethod(self):
+        self.dispatcher.jsonrpc_dynamic = lambda a: a * 2
+        d = self._call('dynamic', [2])
+        d.addCallback(self.assertEquals, 4)
+        return d
+
+    def test_instanceOverridesClass(self):
+        self.dispatcher.jsonrpc_defaults = lambda a, b=2: 'instance'
+        d = self._call('defaults', [1])
+        d.addCallback(self.assertEquals, 'instance')
+        return d
+
+    def test_instanceMethodInspectedOnce(self):
+        self.dispatcher.jsonrpc_dynamic = lambda a: a * 2
+        request = {'method': 'dynamic', 'id': 1, 'params': [2]}
+        first = self.dispatcher._getMethod(request)
+        self.assertIdentical(self.dispatcher._getMethod(request), first)
+
+        self.dispatcher.jsonrpc_dynamic = lambda a: a * 3
+        self.assertNotIdentical(self.dispatcher._getMethod(request), first)
+
+    def test_instanceMethodCached(self):
+        calls = []
+
+        @cached()
+        def dynamic(a):
+            calls.append(a)
+            return a
+
+        self.dispatcher.jsonrpc_dynamic = dynamic
+        d = self._call('dynamic', [2])
+        d.addCallback(lambda _: self._call('dynamic', [2]))
+        d.addCallback(lambda _: self.assertEquals(calls, [2]))
+        return d
+
+    def test_notFound(self):
+        return self.assertFailure(self._call('nosuchmethod'),
+                                  jsonrpc.JSONRPCError)
+
+
+class AsyncDispatcher(JSONRPCDispatcher):
+
+    def __init__(self):
+        self.pending = []
+
+    def jsonrpc_sync(self, data):
+        return data
+
+    def jsonrpc_async(self, data):
+        d = Deferred()
+        self.pending.append((d, data))
+        return d
+
+    def jsonrpc_fail(self):
+        raise ValueError('failed')
+
+
+class TestDispatchRequest(TestCase):
+
+    def setUp(self):
+        self.dispatcher = AsyncDispatcher()
+
+    def test_syncInline(self):
+        request = [{'method': 'sync', 'params': ['a'], 'id': 1},
+                   {'method': 'sync', 'params': ['b']}]
+        responses = self.dispatcher._dispatchRequest(request)
+        self.assertEquals(responses,
+                          ['{"error": null, "id": 1, "result": "a"}', None])
+
+    def test_exceptionInline(self):
+        responses = self.dispatcher._dispatchRequest([{'method': 'fail',
+                                                       'id': 1}])
+        error = jsonrpc.jloads(responses[0])['error']
+        self.assertEquals(error['message'], 'failed')
+
+    def test_invalidCall(self):
+        responses = self.dispatcher._dispatchRequest([1, {'id': 2}])
+        error = jsonrpc.jloads(responses[1])['error']
+        self.assertEquals(responses[0], None)
+        self.assertEquals(error['code'], jsonrpc.INVALID_REQUEST)
+
+    def test_mixedOrder(self):
+        request = [{'method': 'async', 'params': ['a'], 'id': 1},
+                   {'method': 'sync', 'params': ['b'], 'id': 2},
+                   {'method': 'async', 'params': ['c'], 'id': 3}]
+        d = self.dispatcher._dispatchRequest(request)
+        self.assertTrue(isinstance(d, Deferred))
+
+        for pending, data in reversed(self.dispatcher.pending):
+            pending.callback(data)
+
+        def finished(responses):
+            results = [jsonrpc.jloads(response)['result']
+                       for response in responses]
+            self.assertEquals(results, ['a', 'b', 'c'])
+
+        d.addCallback(finished)
+        return d
+
+
+class ThreadDispatcher(JSONRPCDispatcher):
+
+    @inThread
+    def jsonrpc_default(self):
+        return threading.current_thread().name
+
+    @inThread('other')
+    def jsonrpc_other(self, a, b=1):
+        return [threading.current_thread().name, a, b]
+
+    @inThread
+    def jsonrpc_fail(self):
+        raise ValueError('failed in thread')
+
+    @inThread
+    def jsonrpc_unserializable(self):
+        return object()
+
+    def jsonrpc_items(self, n):
+        return ['x'] * n
+
+
+class TestInThread(TestCase):
+
+    def setUp(self):
+        self.dispatcher = ThreadDispatcher()
+
+    def tearDown(self):
+        stopPools()
+
+    def _call(self, method, params=None):
+        request = {'method': method, 'id': 1}
+        if params is not None:
+            request['params'] = params
+        return self.dispatcher._dispatchCall(request)
+
+    def test_defaultPool(self):
+        d = self._call('default')
+        self.assertTrue(isinstance(d, Deferred))
+
+        def finished(response):
+            result = jsonrpc.jloads(response)['result']
+            self.assertTrue('fastjsonrpc-default' in result)
+
+        d.addCallback(finished)
+        return d
+
+    def test_namedPool(self):
+        setThreadPoolSize('other', 3)
+        d = self._call('other', {'a': 5})
+
+        def finished(response):
+            result = jsonrpc.jloads(response)['result']
+            self.assertTrue('fastjsonrpc-other' in result[0])
+            self.assertEquals(result[1:], [5, 1])
+            self.assertEquals(getThreadPool('other').max, 3)
+
+        d.addCallback(finished)
+        return d
+
+    def test_exception(self):
+        d = self._call('fail')
+
+        def finished(response):
+            error = jsonrpc.jloads(response)['error']
+            self.assertEquals(error['message'], 'failed in thread')
+
+        d.addCallback(finished)
+        return d
+
+    def test_encodedInThread(self):
+        d = self.dispatcher._callMethod({'method': 'other', 'params': [2],
+                                         'id': 1})
+
+        def finished(result):
+            self.assertTrue(isinstance(result, jsonrpc.RawJSON))
+            self.assertEquals(jsonrpc.jloads(result.json)[1:], [2, 1])
+
+        d.addCallback(finished)
+        return d
+
+    def test_unserializable(self):
+        d = self._call('unserializable')
+
+        def finished(response):
+            error = jsonrpc.jloads(response)['error']
+            self.assertEquals(error['code'], jsonrpc.INTERNAL_ERROR)
+
+        d.addCallback(finished)
+        return d
+
+    def test_threadedDecode(self):
+        self.dispatcher.threadedDecodeSize = 5
+        d = self.dispatcher._decodeRequestString('{"method": "default"}')
+        self.assertTrue(isinstance(d, Deferred))
+        d.addCallback(self.assertEquals, {'method': 'default'})
+        return d
+
+    def test_threadedDecodeMalformed(self):
+        self.dispatcher.threadedDecodeSize = 5
+        d = self.dispatcher._decodeRequestString('{"method": "def')
+        return self.assertFailure(d, jsonrpc.JSONRPCError)
+
+    def test_threadedDecodeSmall(self):
+        self.dispatcher.threadedDecodeSize = 100
+        decoded = self.dispatcher._decodeRequestString('{"a": 1}')
+        self.assertEquals(decoded, {'a': 1})
+
+    def test_threadedDecodeTooDeep(self):
+        self.dispatcher.threadedDecodeSize = 5
+        d = self.dispatcher._decodeRequestString('[' * 100000 + ']' * 100000)
+        d = self.assertFailure(d, jsonrpc.JSONRPCError)
+        d.addCallback(lambda e: self.assertEquals(e.errno,
+                                                  jsonrpc.PARSE_ERROR))
+        return d
+
+    def test_threadedDecodeBuildsTable(self):
+        class LateDispatcher(ThreadDispatcher):
+            pass
+
+        dispatcher = LateDispatcher()
+        dispatcher.threadedDecodeSize = 5
+        d = dispatcher._decodeRequestString('{"method": "default"}')
+        self.assertTrue(LateDispatcher in dispatch._methodTables)
+        return d
+
+    def test_threadedEncode(self):
+        self.dispatcher.threadedEncodeSize = 100
+        d = self._call('items', [100])
+        self.assertTrue(isinstance(d, Deferred))
+
+        def finished(response):
+            self.assertEquals(jsonrpc.jloads(response)['result'],
+                              ['x'] * 100)
+
+        d.addCallback(finished)
+        return d
+
+    def test_threadedEncodeSmall(self):
+        self.dispatcher.threadedEncodeSize = 100
+        response = self._call('items', [2])
+        self.assertEquals(jsonrpc.jloads(response)['result'], ['x', 'x'])
+
+    def test_invalidParamsNotInThread(self):
+        response = self._call('other', [])
+        error = jsonrpc.jloads(response)['error']
+        self.assertEquals(error['code'], jsonrpc.INVALID_PARAMS)
+
+
+class CachedDispatcher(JSONRPCDispatcher):
+
+    calls = 0
+
+    @cached(ttl=10, maxSize=10)
+    def jsonrpc_lookup(self, key, other=None):
+        CachedDispatcher.calls += 1
+        return {'key': key, 'other': other}
+
+    @cached()
+    def jsonrpc_deferred(self, key):
+        CachedDispatcher.calls += 1
+        return succeed([key])
+
+    @cached()
+    def jsonrpc_fail(self):
+        CachedDispatcher.calls += 1
+        raise ValueError('not cached')
+
+    @cached()
+    @rawParams
+    def jsonrpc_rawLookup(self, params):
+        CachedDispatcher.calls += 1
+        return params.decode()
+
+
+class TestCached(TestCase):
+
+    def setUp(self):
+        CachedDispatcher.calls = 0
+        CachedDispatcher().clearCache()
+        self.clock = Clock()
+        getMethodTable(CachedDispatcher)['lookup'].cache.clock = self.clock
+
+    def _call(self, method, params=None, dispatcher=None):
+        request = {'method': method, 'id': 1}
+        if params is not None:
+            request['params'] = params
+        dispatcher = dispatcher or CachedDispatcher()
+        return dispatcher._dispatchCall(request)
+
+    def test_hit(self):
+        before = CachedDispatcher().cacheStats()['lookup']
+        first = self._call('lookup', ['a'])
+        second = self._call('lookup', ['a'], CachedDispatcher())
+        self.assertEquals(first, second)
+        self.assertEquals(CachedDispatcher.calls, 1)
+
+        after = CachedDispatcher().cacheStats()['lookup']
+        self.assertEquals(after['hits'] - before['hits'], 1)
+        self.assertEquals(after['misses'] - before['misses'], 1)
+
+    def test_canonicalKeywords(self):
+        self._call('lookup', {'key': 'a', 'other': 'b'})
+        self._call('lookup', {'other': 'b', 'key': 'a'})
+        self.assertEquals(CachedDispatcher.calls, 1)
+
+    def test_differentParams(self):
+        self._call('lookup', ['a'])
+        self._call('lookup', ['b'])
+        self.assertEquals(CachedDispatcher.calls, 2)
+
+    def test_rawParams(self):
+        dispatcher = CachedDispatcher()
+        for request in ['{"method": "rawLookup", "params": {"a": 1, ' +
+                        '"b": [2]}, "id": 1}',
+                        '{"id": 1, "params": {"b":[2],"a":1}, ' +
+                        '"method": "rawLookup"}',
+                        '[{"method": "rawLookup", "params": {"a": 1, ' +
+                        '"b": [2]}, "id": 1}]']:
+            request = dispatcher._decodeRequest(request)
+            if isinstance(request, list):
+                request = request[0]
+            dispatcher._dispatchCall(request)
+        self.assertEquals(CachedDispatcher.calls, 1)
+
+    def test_expire(self):
+        self._call('lookup', ['a'])
+        self.clock.advance(11)
+        self._call('lookup', ['a'])
+        self.assertEquals(CachedDispatcher.calls, 2)
+
+    def test_deferred(self):
+        d = self._call('deferred', ['a'])
+
+        def finished(response):
+            self.assertEquals(response, self._call('deferred', ['a']))
+            self.assertEquals(CachedDispatcher.calls, 1)
+
+        d.addCallback(finished)
+        return d
+
+    def test_errorsNotCached(self):
+        self._call('fail')
+        self._call('fail')
+        self.assertEquals(CachedDispatcher.calls, 2)
+
+    def test_clearCache(self):
+        self._call('lookup', ['a'])
+        CachedDispatcher().clearCache('lookup')
+        self._call('lookup', ['a'])
+        self.assertEquals(CachedDispatcher.calls, 2)
+
+
+class CoalescedDispatcher(JSONRPCDispatcher):
+
+    calls = []
+
+    @coalesced
+    def jsonrpc_slow(self, key):
+        d = Deferred()
+        CoalescedDispatcher.calls.append(d)
+        return d
+
+    def jsonrpc_notCoalesced(self, key):
+        d = Deferred()
+        CoalescedDispatcher.calls.append(d)
+        return d
+
+    @cached()
+    def jsonrpc_cachedSlow(self, key):
+        d = Deferred()
+        CoalescedDispatcher.calls.append(d)
+        return d
+
+
+class TestCoalesced(TestCase):
+
+    def setUp(self):
+        CoalescedDispatcher.calls = []
+        for method in getMethodTable(CoalescedDispatcher).values():
+            method.inFlight.clear()
+
+    def _call(self, method, params, id_=1):
+        request = {'method': method, 'params': params, 'id': id_}
+        return CoalescedDispatcher()._dispatchCall(request)
+
+    def test_coalesce(self):
+        first = self._call('slow', ['a'], 1)
+        second = self._call('slow', ['a'], 2)
+        self.assertEquals(len(CoalescedDispatcher.calls), 1)
+
+        CoalescedDispatcher.calls[0].callback('result')
+        self.assertEquals(self.successResultOf(first),
+                          '{"error": null, "id": 1, "result": "result"}')
+        self.assertEquals(self.successResultOf(second),
+                          '{"error": null, "id": 2, "result": "result"}')
+
+    def test_differentParams(self):
+        self._call('slow', ['a'])
+        self._call('slow', ['b'])
+        self.assertEquals(len(CoalescedDispatcher.calls), 2)
+
+    def test_afterFinished(self):
+        self._call('slow', ['a'])
+        CoalescedDispatcher.calls[0].callback('result')
+        self._call('slow', ['a'])
+        self.assertEquals(len(CoalescedDispatcher.calls), 2)
+
+    def test_failure(self):
+        first = self._call('slow', ['a'], 1)
+        second = self._call('slow', ['a'], 2)
+
+        error = jsonrpc.JSONRPCError('failed', jsonrpc.INTERNAL_ERROR)
+        CoalescedDispatcher.calls[0].errback(error)
+        for response in (first, second):
+            response = jsonrpc.jloads(self.successResultOf(response))
+            self.assertEquals(response['error']['message'], 'failed')
+
+    def test_notCoalesced(self):
+        self._call('notCoalesced', ['a'])
+        self._call('notCoalesced', ['a'])
+        self.assertEquals(len(CoalescedDispatcher.calls), 2)
+
+    def test_cached(self):
+        first = self._call('cachedSlow', ['a'], 1)
+        second = self._call('cachedSlow', ['a'], 2)
+        self.assertEquals(len(CoalescedDispatcher.calls), 1)
+
+        CoalescedDispatcher.calls[0].callback([1])
+        self.assertEquals(self.successResultOf(second),
+                          '{"error": null, "id": 2, "result": [1]}')
+        self.successResultOf(first)
+
+    def test_batch(self):
+        batch = [{'method': 'slow', 'params': ['a'], 'id': i}
+                 for i in range(3)]
+        d = CoalescedDispatcher()._dispatchRequest(batch)
+        self.assertEquals(len(CoalescedDispatcher.calls), 1)
+
+        CoalescedDispatcher.calls[0].callback('result')
+        self.assertEquals(len(self.successResultOf(d)), 3)
+
+
+class LimitedDispatcher(JSONRPCDispatcher):
+
+    maxConcurrentCalls = 3
+    maxQueuedCalls = 1
+
+    calls = []
+
+    @limited(1, 1)
+    def jsonrpc_scarce(self):
+        d = Deferred()
+        LimitedDispatcher.calls.append(d)
+        return d
+
+    def jsonrpc_slow(self):
+        d = Deferred()
+        LimitedDispatcher.calls.append(d)
+        return d
+
+    def jsonrpc_fast(self):
+        return 'fast'
+
+
+class TestLimited(TestCase):
+
+    def setUp(self):
+        LimitedDispatcher.calls = []
+        for method in getMethodTable(LimitedDispatcher).values():
+            if method.limiter is not None:
+                method.limiter = ConcurrencyLimiter(1, 1)
+        dispatch._globalLimiters.pop(LimitedDispatcher, None)
+        self.dispatcher = LimitedDispatcher()
+
+    def _call(self, method, id_=1):
+        return self.dispatcher._dispatchCall({'method': method, 'id': id_})
+
+    def _finishAll(self):
+        while LimitedDispatcher.calls:
+            LimitedDispatcher.calls.pop(0).callback('done')
+
+    def test_methodLimit(self):
+        first = self._call('scarce')
+        second = self._call('scarce')
+        self.assertEquals(len(LimitedDispatcher.calls), 1)
+
+        LimitedDispatcher.calls.pop(0).callback('done')
+        self.successResultOf(first)
+        self.assertEquals(len(LimitedDispatcher.calls), 1)
+
+        self._finishAll()
+        self.assertEquals(self.successResultOf(second),
+                          '{"error": null, "id": 1, "result": "done"}')
+
+    def test_methodRejected(self):
+        self._call('scarce')
+        self._call('scarce')
+        response = jsonrpc.jloads(self._call('scarce'))
+        self.assertEquals(response['error']['code'],
+                          jsonrpc.SERVER_OVERLOADED)
+
+        stats = self.dispatcher.limiterStats()['methods']['scarce']
+        self.assertEquals((stats['inFlight'], stats['queued']), (1, 1))
+        self.assertEquals(stats['rejected'], 1)
+        self._finishAll()
+
+    def test_globalLimit(self):
+        for _ in range(4):
+            self._call('slow')
+        self.assertEquals(len(LimitedDispatcher.calls), 3)
+        self.assertRaises(OverloadedError, self.dispatcher._dispatchCall,
+                          {'method': 'fast', 'id': 1}, True)
+
+        self._finishAll()
+        stats = self.dispatcher.limiterStats()['global']
+        self.assertEquals((stats['inFlight'], stats['queued']), (0, 0))
+        self.assertEquals(stats['admitted'], 4)
+
+    def test_syncReleased(self):
+        for _ in range(10):
+            self._call('fast')
+        self.assertEquals(
+            self.dispatcher.limiterStats()['global']['inFlight'], 0)
+
+    def test_failureReleased(self):
+        d = self._call('scarce')
+        LimitedDispatcher.calls.pop(0).errback(ValueError('failed'))
+        self.successResultOf(d)
+        self._call('scarce')
+        self.assertEquals(len(LimitedDispatcher.calls), 1)
+        self._finishAll()
+
+    def test_noLimits(self):
+        self.assertEquals(CachedDispatcher().limiterStats(),
+                          {'global': None, 'methods': {}})
+
+
+class QueueDispatcher(JSONRPCDispatcher):
+
+    calls = []
+
+    @limited(1, None)
+    def jsonrpc_call(self, value):
+        if value is None:
+            d = Deferred()
+            QueueDispatcher.calls.append(d)
+            return d
+        return value
+
+
+class TestLongQueue(TestCase):
+
+    def setUp(self):
+        QueueDispatcher.calls = []
+        method = getMethodTable(QueueDispatcher)['call']
+        method.limiter = ConcurrencyLimiter(1, None)
+
+    def test_plainCallsQueued(self):
+        dispatcher = QueueDispatcher()
+        first = dispatcher._dispatchCall({'method': 'call',
+                                          'params': [None], 'id': 0})
+        queued = [dispatcher._dispatchCall({'method': 'call',
+                                            'params': [i], 'id': i})
+                  for i in range(1, 500)]
+
+        QueueDispatcher.calls.pop().callback('done')
+        self.successResultOf(first)
+        for i, d in enumerate(queued, 1):
+            self.assertEquals(jsonrpc.jloads(self.successResultOf(d)),
+                              {'error': None, 'id': i, 'result': i})
+
+
+class WindowDispatcher(JSONRPCDispatcher):
+
+    batchWindow = 2
+
+    def __init__(self):
+        self.calls = []
+
+    def jsonrpc_slow(self, value):
+        d = Deferred()
+        self.calls.append((d, value))
+        return d
+
+    def jsonrpc_fast(self, value):
+        return value
+
+    def jsonrpc_immediate(self, value):
+        return succeed(value)
+
+
+class TestBatchWindow(TestCase):
+
+    def setUp(self):
+        self.dispatcher = WindowDispatcher()
+
+    def _batch(self, method, count):
+        return [{'method': method, 'params': [i], 'id': i}
+                for i in range(count)]
+
+    def test_window(self):
+        d = self.dispatcher._dispatchRequest(self._batch('slow', 5))
+        self.assertEquals(len(self.dispatcher.calls), 2)
+
+        # finish them out of order
+        while self.dispatcher.calls:
+            call, value = self.dispatcher.calls.pop()
+            call.callback(value)
+            self.assertTrue(len(self.dispatcher.calls) <= 2)
+
+        responses = [jsonrpc.jloads(response)['result']
+                     for response in self.successResultOf(d)]
+        self.assertEquals(responses, range(5))
+
+    def test_synchronous(self):
+        responses = self.dispatcher._dispatchRequest(self._batch('fast', 5))
+        self.assertEquals(len(responses), 5)
+
+    def test_alreadyFired(self):
+        responses = self.dispatcher._dispatchRequest(
+            self._batch('immediate', 500))
+        self.assertEquals(jsonrpc.jloads(responses[-1])['result'], 499)
+
+    def test_shortBatch(self):
+        d = self.dispatcher._dispatchRequest(self._batch('slow', 2))
+        self.assertEquals(len(self.dispatcher.calls), 2)
+        for call, value in self.dispatcher.calls:
+            call.callback(value)
+        self.assertEquals(len(self.successResultOf(d)), 2)
+
+    def test_stream(self):
+        written = []
+        d = self.dispatcher._streamRequest(self._batch('slow', 3),
+                                           written.append)
+        self.assertEquals(len(self.dispatcher.calls), 2)
+
+        call, value = self.dispatcher.calls.pop(1)
+        call.callback(value)
+        self.assertEquals(len(written), 1)
+        self.assertEquals(jsonrpc.jloads(written[0])['id'], 1)
+
+        while self.dispatcher.calls:
+            call, value = self.dispatcher.calls.pop()
+            call.callback(value)
+        self.successResultOf(d)
+        self.assertEquals(len(written), 3)
+
+    def test_streamSynchronous(self):
+        written = []
+        d = self.dispatcher._streamRequest(self._batch('fast', 3),
+                                           written.append)
+        self.assertEquals(d, None)
+        self.assertEquals(len(written), 3)
+
+    def test_incremental(self):
+        batch = jsonrpc.BatchParser(StringIO(json.dumps(
+            self._batch('slow', 5))))
+        d = self.dispatcher._dispatchRequest(batch)
+        self.assertEquals(len(self.dispatcher.calls), 2)
+
+        while self.dispatcher.calls:
+            call, value = self.dispatcher.calls.pop()
+            call.callback(value)
+
+        responses = [jsonrpc.jloads(response)['result']
+                     for response in self.successResultOf(d)]
+        self.assertEquals(responses, range(5))
+
+    def test_incrementalMalformed(self):
+        request = json.dumps(self._batch('slow', 3))[:-1]
+        d = self.dispatcher._dispatchRequest(
+            jsonrpc.BatchParser(StringIO(request)))
+
+        while self.dispatcher.calls:
+            call, value = self.dispatcher.calls.pop()
+            call.callback(value)
+
+        e = self.failureResultOf(d, jsonrpc.JSONRPCError)
+        self.assertEquals(e.value.errno, jsonrpc.PARSE_ERROR)
+
+    def test_incrementalTooDeep(self):
+        request = json.dumps(self._batch('slow', 1))[:-1]
+        request += ', %s]' % ('[' * 100000 + ']' * 100000)
+        d = self.dispatcher._dispatchRequest(
+            jsonrpc.BatchParser(StringIO(request)))
+
+        call, value = self.dispatcher.calls.pop()
+        call.callback(value)
+        e = self.failureResultOf(d, jsonrpc.JSONRPCError)
+        self.assertEquals(e.value.errno, jsonrpc.PARSE_ERROR)
+
+    def test_unexpectedError(self):
+        def calls():
+            yield {'method': 'slow', 'params': [1], 'id': 1}
+            raise KeyError('unexpected')
+
+        d = self.dispatcher._streamRequest(calls(), lambda response: None)
+        call, value = self.dispatcher.calls.pop()
+        call.callback(value)
+        self.failureResultOf(d, KeyError)
+
+    def test_incrementalNoWindow(self):
+        self.dispatcher.batchWindow = None
+        request = '[{"method": "fast", "params": [1], "id": 1}, 1'
+        self.assertRaises(jsonrpc.JSONRPCError,
+                          self.dispatcher._dispatchRequest,
+                          jsonrpc.BatchParser(StringIO(request)))
+
+    def test_decodeRequestStream(self):
+        self.dispatcher.incrementalParseSize = 5
+        request = '[1, 2, 3]'
+        decoded = self.dispatcher._decodeRequestStream(StringIO(request),
+                                                       len(request))
+        self.assertTrue(isinstance(decoded, jsonrpc.BatchParser))
+        self.assertEquals(list(decoded), [1, 2, 3])
+
+        request = '{"method": "fast"}'
+        decoded = self.dispatcher._decodeRequestStream(StringIO(request),
+                                                       len(request))
+        self.assertEquals(decoded, {'method': 'fast'})
+
+        request = '[1]'
+        decoded = self.dispatcher._decodeRequestStream(StringIO(request),
+                                                       len(request))
+        self.assertEquals(decoded, [1])
+
+    def test_tooDeep(self):
+        self.dispatcher.maxNestingDepth = 2
+        e = self.assertRaises(jsonrpc.JSONRPCError,
+                              self.dispatcher._decodeRequest, '[[[1]]]')
+        self.assertEquals(e.errno, jsonrpc.INVALID_REQUEST)
+        self.assertEquals(self.dispatcher._decodeRequest('[[1]]'), [[1]])
+
+    def test_tooLong(self):
+        self.dispatcher.maxBatchLength = 2
+        e = self.assertRaises(jsonrpc.JSONRPCError,
+                              self.dispatcher._decodeRequest, '[1, 2, 3]')
+        self.assertEquals(e.errno, jsonrpc.INVALID_REQUEST)
+        self.assertEquals(self.dispatcher._decodeRequest('[1, 2]'), [1, 2])
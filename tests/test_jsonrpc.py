@@ -4,11 +4,61 @@ sys.path.insert(0, os.path.abspath('..'))
 
 import re
 
+from StringIO import StringIO
+
 from fastjsonrpc import jsonrpc
 from fastjsonrpc.jsonrpc import JSONRPCError
 from twisted.trial.unittest import TestCase
 
 
+class TestCodecs(TestCase):
+
+    def test_defaultCodec(self):
+        codec = jsonrpc.getCodec()
+        self.assertTrue(isinstance(codec, jsonrpc.JSONCodec))
+        self.assertTrue(codec.name in jsonrpc.availableCodecs())
+
+    def test_getCodecByName(self):
+        self.assertEquals(jsonrpc.getCodec('json').name, 'json')
+
+    def test_getCodecInstance(self):
+        codec = jsonrpc.JSONCodec('dummy', repr, eval)
+        self.assertTrue(jsonrpc.getCodec(codec) is codec)
+
+    def test_getCodecUnknown(self):
+        self.assertRaises(ValueError, jsonrpc.getCodec, 'nosuchcodec')
+
+    def test_registerCodec(self):
+        codec = jsonrpc.JSONCodec('upper', lambda obj: '"%s"' % obj.upper(),
+                                  lambda s: s[1:-1])
+        jsonrpc.registerCodec(codec)
+        self.assertEquals(jsonrpc.jdumps('abc', 'upper'), '"ABC"')
+        self.assertEquals(jsonrpc.jloads('"abc"', 'upper'), 'abc')
+        self.assertTrue(jsonrpc.getCodec() is not codec)
+
+    def test_errorsTranslated(self):
+        class DummyError(Exception):
+            pass
+
+        def fail(_):
+            raise DummyError('failed')
+
+        codec = jsonrpc.JSONCodec('failing', fail, fail, (DummyError,))
+        self.assertRaises(ValueError, codec.dumps, 'abc')
+        self.assertRaises(ValueError, codec.loads, 'abc')
+
+    def test_allCodecsRoundtrip(self):
+        data = {'list': [1, 2.5, None, True], 'string': 'abc'}
+        for name in jsonrpc.availableCodecs():
+            codec = jsonrpc.getCodec(name)
+            self.assertEquals(codec.loads(codec.dumps(data)), data)
+
+    def test_decodeRequestCodec(self):
+        codec = jsonrpc.JSONCodec('dummy', repr, lambda s: {'method': s})
+        self.assertEquals(jsonrpc.decodeRequest('aa', codec),
+                          {'method': 'aa'})
+
+
 class TestEncodeRequest(TestCase):
 
     def test_noArgs(self):
@@ -87,6 +137,11 @@ class TestEncodeRequest(TestCase):
 
 class TestDecodeRequest(TestCase):
 
+    def test_tooDeep(self):
+        e = self.assertRaises(jsonrpc.JSONRPCError, jsonrpc.decodeRequest,
+                              '[' * 100000 + ']' * 100000)
+        self.assertEquals(e.errno, jsonrpc.PARSE_ERROR)
+
     def test_empty(self):
         self.assertRaises(Exception, jsonrpc.decodeRequest, '')
 
@@ -143,6 +198,155 @@ class TestDecodeRequest(TestCase):
         self.assertEquals(result, expected)
 
 
+class TestSplitObject(TestCase):
+
+    def test_members(self):
+        request = '{"method": "aa", "params": [1, {"b": [2]}], "id": 1}'
+        expected = {'method': '"aa"', 'params': '[1, {"b": [2]}]', 'id': '1'}
+        self.assertEquals(jsonrpc.splitObject(request), expected)
+
+    def test_whitespace(self):
+        request = ' \n{ "id" :\tnull ,"params":{} }\r\n'
+        expected = {'id': 'null', 'params': '{}'}
+        self.assertEquals(jsonrpc.splitObject(request), expected)
+
+    def test_bracketsInStrings(self):
+        request = '{"params": ["]}", "\\"[{"], "id": "}"}'
+        expected = {'params': '["]}", "\\"[{"]', 'id': '"}"'}
+        self.assertEquals(jsonrpc.splitObject(request), expected)
+
+    def test_longStrings(self):
+        text = '"%s"' % ('[x] ' * 1000)
+        escaped = '"%s"' % ('\\"{\\\\' * 100)
+        params = '[%s, {"a": %s}, %s]' % (text, escaped, text)
+        request = '{"params": %s, "id": %s}' % (params, escaped)
+        expected = {'params': params, 'id': escaped}
+        self.assertEquals(jsonrpc.splitObject(request), expected)
+        self.assertEquals(len(jsonrpc.jloads(params)[0]), 4000)
+
+    def test_empty(self):
+        self.assertEquals(jsonrpc.splitObject('{}'), {})
+
+    def test_notObject(self):
+        self.assertRaises(ValueError, jsonrpc.splitObject, '[{"id": 1}]')
+
+    def test_malformed(self):
+        for request in ['{"method": "aa"', '{"method" "aa"}', '{"params": [}',
+                        '{"id": 1} {}', '', '{"id": 1 "a": 2}']:
+            self.assertRaises(ValueError, jsonrpc.splitObject, request)
+
+
+class TestDecodeRawRequest(TestCase):
+
+    def test_rawParams(self):
+        request = '{"method": "aa", "params": [1, 2], "id": 1}'
+        result = jsonrpc.decodeRawRequest(request)
+        self.assertEquals(result['method'], 'aa')
+        self.assertEquals(result['id'], 1)
+        self.assertTrue(isinstance(result['params'], jsonrpc.RawParams))
+        self.assertEquals(result['params'].json, '[1, 2]')
+        self.assertEquals(result['params'].decode(), [1, 2])
+
+    def test_paramsNotSequence(self):
+        request = {'method': 'aa', 'params': 123}
+        result = jsonrpc.decodeRawRequest('{"method": "aa", "params": 123}')
+        self.assertEquals(result, request)
+        self.assertRaises(JSONRPCError, jsonrpc.verifyMethodCall, result)
+
+    def test_verify(self):
+        request = jsonrpc.decodeRawRequest('{"method": "aa", "params": {}}')
+        self.assertEquals(request, jsonrpc.verifyMethodCall(request))
+
+
+class TestBatchParser(TestCase):
+
+    def _parse(self, request, chunkSize=3, maxLength=None):
+        parser = jsonrpc.BatchParser(StringIO(request), maxLength=maxLength,
+                                     chunkSize=chunkSize)
+        return list(parser)
+
+    def test_batch(self):
+        request = ' [{"method": "a", "params": ["]", "\\"", 1.5e3]}, ' + \
+                  '12345, [{"x": [true]}], null ] '
+        self.assertEquals(self._parse(request), jsonrpc.jloads(request))
+        self.assertEquals(self._parse(request, 1000),
+                          jsonrpc.jloads(request))
+
+    def test_empty(self):
+        self.assertEquals(self._parse('[ ]'), [])
+
+    def test_isBatch(self):
+        self.assertTrue(jsonrpc.BatchParser(StringIO('  [1]')).isBatch())
+        self.assertFalse(jsonrpc.BatchParser(StringIO('{}')).isBatch())
+
+    def test_incremental(self):
+        calls = iter(jsonrpc.BatchParser(StringIO('[1, 2, 3'), chunkSize=1))
+        self.assertEquals(next(calls), 1)
+        self.assertEquals(next(calls), 2)
+        self.assertEquals(next(calls), 3)
+        e = self.assertRaises(jsonrpc.JSONRPCError, next, calls)
+        self.assertEquals(e.errno, jsonrpc.PARSE_ERROR)
+
+    def test_malformed(self):
+        for request in ('[1 2]', '[1,]', '[{"a": tru}]', '[1] 2', '[',
+                        '["abc'):
+            e = self.assertRaises(jsonrpc.JSONRPCError, self._parse, request)
+            self.assertEquals(e.errno, jsonrpc.PARSE_ERROR)
+
+    def test_maxDepth(self):
+        parser = jsonrpc.BatchParser(StringIO('[[1], [[2]]]'), chunkSize=3,
+                                     maxDepth=2)
+        calls = iter(parser)
+        self.assertEquals(next(calls), [1])
+        e = self.assertRaises(jsonrpc.JSONRPCError, next, calls)
+        self.assertEquals(e.errno, jsonrpc.INVALID_REQUEST)
+
+    def test_tooDeep(self):
+        request = '[1, %s]' % ('[' * 100000 + ']' * 100000)
+        e = self.assertRaises(jsonrpc.JSONRPCError, self._parse, request,
+                              1000)
+        self.assertEquals(e.errno, jsonrpc.PARSE_ERROR)
+
+    def test_maxLength(self):
+        self.assertEquals(self._parse('[1, 2]', maxLength=2), [1, 2])
+        e = self.assertRaises(jsonrpc.JSONRPCError, self._parse, '[1, 2, 3]',
+                              maxLength=2)
+        self.assertEquals(e.errno, jsonrpc.INVALID_REQUEST)
+
+
+class TestCheckNestingDepth(TestCase):
+
+    def test_ok(self):
+        jsonrpc.checkNestingDepth('[{"a": [1]}, [2]]', 3)
+        jsonrpc.checkNestingDepth('1', 0)
+
+    def test_tooDeep(self):
+        e = self.assertRaises(JSONRPCError, jsonrpc.checkNestingDepth,
+                              '[{"a": [1]}]', 2)
+        self.assertEquals(e.errno, jsonrpc.INVALID_REQUEST)
+
+    def test_strings(self):
+        jsonrpc.checkNestingDepth('["[[[", "\\"[[["]', 1)
+
+    def test_range(self):
+        string = '[[1], [[2]]]'
+        jsonrpc.checkNestingDepth(string, 1, 1, 4)
+        self.assertRaises(JSONRPCError, jsonrpc.checkNestingDepth, string,
+                          1, 6, 11)
+
+
+class TestRawParams(TestCase):
+
+    def test_fromDecoded(self):
+        params = jsonrpc.RawParams(decoded={'a': 1})
+        self.assertEquals(params.json, '{"a": 1}')
+        self.assertEquals(params.decode(), {'a': 1})
+
+    def test_invalid(self):
+        params = jsonrpc.RawParams('[1, ')
+        self.assertRaises(JSONRPCError, params.decode)
+
+
 class TestVerifyMethodCall(TestCase):
 
     def test_onlyMethod(self):
@@ -235,13 +439,21 @@ class TestPrepareMethodResponse(TestCase):
         self.assertEquals(result, expected)
 
     def test_invalidParams(self):
-        response = TypeError('Invalid params')
+        response = JSONRPCError('Invalid params', jsonrpc.INVALID_PARAMS)
         result = jsonrpc.prepareMethodResponse(response, 123)
         expected = {"result": None, "id": 123,
                     "error": {"message": "Invalid params",
                     "code": -32602}}
         self.assertEquals(result, expected)
 
+    def test_typeError(self):
+        response = TypeError('unsupported operand')
+        result = jsonrpc.prepareMethodResponse(response, 123)
+        expected = {"result": None, "id": 123,
+                    "error": {"message": "unsupported operand",
+                    "code": -32603}}
+        self.assertEquals(result, expected)
+
     def test_methodNotFount(self):
         response = JSONRPCError('Method aa not found',
                                 jsonrpc.METHOD_NOT_FOUND)
@@ -252,8 +464,120 @@ class TestPrepareMethodResponse(TestCase):
         self.assertEquals(result, expected)
 
 
+class TestEncodeMethodResponse(TestCase):
+
+    def test_noResponseNoVersion(self):
+        result = jsonrpc.encodeMethodResponse(None, 123)
+        expected = '{"error": null, "id": 123, "result": null}'
+        self.assertEquals(result, expected)
+
+    def test_noResponseV2(self):
+        result = jsonrpc.encodeMethodResponse(None, 123, 2)
+        expected = '{"jsonrpc": "2.0", "id": 123, "result": null}'
+        self.assertEquals(result, expected)
+
+    def test_responseList(self):
+        result = jsonrpc.encodeMethodResponse([1, "a"], '1b3', 2.0)
+        expected = '{"jsonrpc": "2.0", "id": "1b3", "result": [1, "a"]}'
+        self.assertEquals(result, expected)
+
+    def test_noId(self):
+        self.assertEquals(jsonrpc.encodeMethodResponse('result', None), None)
+
+    def test_sameAsPrepared(self):
+        for result in ['result', 12321, None, {'a': [1, 2]},
+                       ValueError('The method raised an exception!')]:
+            for version in [jsonrpc.VERSION_1, jsonrpc.VERSION_2]:
+                encoded = jsonrpc.encodeMethodResponse(result, 123, version)
+                prepared = jsonrpc.prepareMethodResponse(result, 123, version)
+                self.assertEquals(jsonrpc.jloads(encoded), prepared)
+
+    def test_responseExceptionV1(self):
+        response = JSONRPCError('Method aa not found',
+                                jsonrpc.METHOD_NOT_FOUND)
+        result = jsonrpc.encodeMethodResponse(response, 123)
+        expected = '{"result": null, "id": 123, "error": ' + \
+                   '{"message": "Method aa not found", "code": -32601}}'
+        self.assertEquals(result, expected)
+
+    def test_responseExceptionV2(self):
+        response = JSONRPCError('Method aa not found',
+                                jsonrpc.METHOD_NOT_FOUND)
+        result = jsonrpc.encodeMethodResponse(response, 123, 2.0)
+        expected = '{"jsonrpc": "2.0", "id": 123, "error": ' + \
+                   '{"message": "Method aa not found", "code": -32601}}'
+        self.assertEquals(result, expected)
+
+    def test_rawJSON(self):
+        raw = jsonrpc.RawJSON('{"a": [1, 2]}')
+        result = jsonrpc.encodeMethodResponse(raw, 123, 2.0)
+        expected = '{"jsonrpc": "2.0", "id": 123, "result": {"a": [1, 2]}}'
+        self.assertEquals(result, expected)
+
+    def test_rawJSONUnicode(self):
+        raw = jsonrpc.RawJSON(u'"\u017e"')
+        self.assertEquals(raw.json, '"\xc5\xbe"')
+
+    def test_rawJSONPrepared(self):
+        raw = jsonrpc.RawJSON('{"a": [1, 2]}')
+        result = jsonrpc.prepareMethodResponse(raw, 123)
+        self.assertEquals(result['result'], {'a': [1, 2]})
+
+    def test_unserializableResult(self):
+        result = jsonrpc.encodeMethodResponse(object(), 123)
+        error = jsonrpc.jloads(result)['error']
+        self.assertEquals(error['code'], jsonrpc.INTERNAL_ERROR)
+
+
+class TestEncodeCallResponse(TestCase):
+
+    def test_single(self):
+        response = '{"error": null, "id": 1, "result": 1}'
+        result = jsonrpc.encodeCallResponse([response], False)
+        self.assertEquals(result, response)
+
+    def test_batch(self):
+        responses = ['{"result": 1}', None, '{"result": 2}']
+        result = jsonrpc.encodeCallResponse(responses)
+        self.assertEquals(result, '[{"result": 1}, {"result": 2}]')
+
+    def test_notificationsOnly(self):
+        self.assertEquals(jsonrpc.encodeCallResponse([None], False), '[]')
+        self.assertEquals(jsonrpc.encodeCallResponse([None, None]), '[]')
+
+
+class TestRequestError(TestCase):
+
+    def test_requestError(self):
+        error = jsonrpc.JSONRPCError('Too long', jsonrpc.INVALID_REQUEST)
+        expected = '{"jsonrpc": "2.0", "id": null, "error": ' + \
+                   '{"message": "Too long", "code": -32600}}'
+        self.assertEquals(jsonrpc.requestError(error), expected)
+
+
 class TestDecodeResponse(TestCase):
 
+    def test_idMatches(self):
+        response = '{"error": null, "id": 5, "result": "abcd"}'
+        self.assertEquals(jsonrpc.decodeResponse(response, id_=5), 'abcd')
+
+    def test_idMismatch(self):
+        response = '{"error": null, "id": 6, "result": "abcd"}'
+        self.assertRaises(ValueError, jsonrpc.decodeResponse, response,
+                          id_=5)
+
+    def test_idMissing(self):
+        response = '{"result": "abcd"}'
+        self.assertRaises(ValueError, jsonrpc.decodeResponse, response,
+                          id_=5)
+
+    def test_nullIdError(self):
+        response = '{"jsonrpc": "2.0", "id": null, "error": ' + \
+                   '{"message": "Parse error", "code": -32700}}'
+        e = self.assertRaises(jsonrpc.JSONRPCError, jsonrpc.decodeResponse,
+                              response, id_=5)
+        self.assertEquals(e.errno, jsonrpc.PARSE_ERROR)
+
     def test_noResponse(self):
         self.assertRaises(Exception, jsonrpc.decodeResponse, '')
 
@@ -319,3 +643,82 @@ class TestDecodeResponse(TestCase):
     def test_emptyResult(self):
         response = '{"result": null}'
         self.assertEquals(None, jsonrpc.decodeResponse(response))
+
+
+class TestIdAllocator(TestCase):
+
+    def test_monotonic(self):
+        ids = jsonrpc.IdAllocator()
+        self.assertEquals([ids.allocate() for _ in range(3)], [1, 2, 3])
+        self.assertEquals(ids.outstanding, set([1, 2, 3]))
+
+    def test_wrapAround(self):
+        ids = jsonrpc.IdAllocator(jsonrpc.ID_MAX)
+        self.assertEquals(ids.allocate(), jsonrpc.ID_MAX)
+        self.assertEquals(ids.allocate(), jsonrpc.ID_MIN)
+
+    def test_skipsOutstanding(self):
+        ids = jsonrpc.IdAllocator(jsonrpc.ID_MAX)
+        ids.allocate()
+        ids.release(ids.allocate())
+
+        # wrapped around to ID_MAX, still outstanding
+        ids._next = jsonrpc.ID_MAX
+        self.assertEquals(ids.allocate(), jsonrpc.ID_MIN)
+
+    def test_release(self):
+        ids = jsonrpc.IdAllocator()
+        ids.release(ids.allocate())
+        self.assertEquals(ids.outstanding, set())
+
+
+class TestInFlightCalls(TestCase):
+
+    def test_route(self):
+        calls = jsonrpc.InFlightCalls()
+        first = calls.add('a')
+        second = calls.add('b')
+        self.assertEquals(len(calls), 2)
+        self.assertTrue(first in calls)
+
+        self.assertEquals(calls.pop(second), 'b')
+        self.assertEquals(calls.pop(first), 'a')
+        self.assertEquals(calls.ids.outstanding, set())
+
+    def test_unknown(self):
+        calls = jsonrpc.InFlightCalls()
+        calls.add('a')
+        self.assertEquals(calls.pop(5), None)
+        self.assertEquals(calls.pop([1]), None)
+        self.assertEquals(len(calls), 1)
+
+    def test_sharedIds(self):
+        ids = jsonrpc.IdAllocator()
+        first = jsonrpc.InFlightCalls(ids)
+        second = jsonrpc.InFlightCalls(ids)
+        self.assertNotEquals(first.add('a'), second.add('b'))
+
+    def test_popAll(self):
+        calls = jsonrpc.InFlightCalls()
+        calls.add('a')
+        calls.add('b')
+        self.assertEquals(sorted(calls.popAll()), ['a', 'b'])
+        self.assertEquals(len(calls), 0)
+        self.assertEquals(calls.ids.outstanding, set())
+
+
+class TestExceedsSize(TestCase):
+
+    def test_small(self):
+        value = {'a': [1, 'bc', None], 'd': {'e': True}}
+        self.assertFalse(jsonrpc.exceedsSize(value,
+                                             len(jsonrpc.jdumps(value))))
+
+    def test_big(self):
+        self.assertTrue(jsonrpc.exceedsSize(['x' * 10] * 10, 100))
+        self.assertTrue(jsonrpc.exceedsSize('x' * 101, 100))
+        self.assertTrue(jsonrpc.exceedsSize({'a': range(100)}, 100))
+
+    def test_rawJSON(self):
+        self.assertTrue(jsonrpc.exceedsSize([jsonrpc.RawJSON('1' * 101)],
+                                            100))
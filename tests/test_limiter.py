@@ -0,0 +1,88 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath('..'))
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from fastjsonrpc import jsonrpc
+from fastjsonrpc.limiter import ConcurrencyLimiter, OverloadedError
+
+
+class TestConcurrencyLimiter(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.limiter = ConcurrencyLimiter(2, 1, clock=self.clock)
+
+    def test_acquire(self):
+        self.assertTrue(self.limiter.tryAcquire())
+        self.assertTrue(self.limiter.tryAcquire())
+        self.assertFalse(self.limiter.tryAcquire())
+        self.assertEquals(self.limiter.inFlight, 2)
+
+    def test_wait(self):
+        self.limiter.tryAcquire()
+        self.limiter.tryAcquire()
+        d = self.limiter.wait()
+        self.assertNoResult(d)
+        self.assertEquals(len(self.limiter), 1)
+
+        self.clock.advance(3)
+        self.limiter.release()
+        self.successResultOf(d)
+        self.assertEquals(self.limiter.inFlight, 2)
+        self.assertEquals(len(self.limiter), 0)
+
+        stats = self.limiter.stats()
+        self.assertEquals(stats['waited'], 1)
+        self.assertEquals(stats['waitTime'], 3)
+        self.assertEquals(stats['maxWaitTime'], 3)
+
+    def test_queuedFirst(self):
+        self.limiter.tryAcquire()
+        self.limiter.tryAcquire()
+        self.limiter.wait()
+        self.limiter.release()
+        self.limiter.release()
+        self.assertEquals(self.limiter.inFlight, 1)
+
+    def test_noJumpingTheQueue(self):
+        self.limiter.tryAcquire()
+        self.limiter.tryAcquire()
+        self.limiter.wait()
+        self.assertFalse(self.limiter.tryAcquire())
+
+    def test_reject(self):
+        self.limiter.tryAcquire()
+        self.limiter.tryAcquire()
+        self.limiter.wait()
+
+        e = self.assertRaises(OverloadedError, self.limiter.wait)
+        self.assertEquals(e.errno, jsonrpc.SERVER_OVERLOADED)
+        self.assertEquals(self.limiter.stats()['rejected'], 1)
+
+    def test_unboundedQueue(self):
+        limiter = ConcurrencyLimiter(1, None)
+        limiter.tryAcquire()
+        for _ in range(100):
+            limiter.wait()
+        self.assertEquals(len(limiter), 100)
+
+    def test_release(self):
+        self.limiter.tryAcquire()
+        self.limiter.release()
+        self.assertEquals(self.limiter.inFlight, 0)
+        self.assertEquals(self.limiter.stats()['admitted'], 1)
+
+    def test_releaseWithinCallback(self):
+        limiter = ConcurrencyLimiter(1, None)
+        limiter.tryAcquire()
+        waiting = [limiter.wait() for _ in range(500)]
+        for d in waiting:
+            d.addCallback(lambda _: limiter.release())
+        limiter.release()
+        for d in waiting:
+            self.successResultOf(d)
+        self.assertEquals((limiter.inFlight, len(limiter)), (0, 0))
+        self.assertEquals(limiter.stats()['admitted'], 501)
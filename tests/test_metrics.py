@@ -0,0 +1,190 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath('..'))
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.test.test_web import DummyRequest
+
+from fastjsonrpc import jsonrpc
+from fastjsonrpc.dispatch import JSONRPCDispatcher
+from fastjsonrpc.metrics import Histogram, MetricsResource, ServerMetrics
+from fastjsonrpc.metrics import PHASES, RequestTiming
+
+
+class TestHistogram(TestCase):
+
+    def test_observe(self):
+        histogram = Histogram([1, 10])
+        for value in [0.5, 1, 5, 100]:
+            histogram.observe(value)
+
+        self.assertEquals(histogram.cumulative(),
+                          [(1, 2), (10, 3), (float('inf'), 4)])
+        self.assertEquals(histogram.sum, 106.5)
+        self.assertEquals(histogram.count, 4)
+
+
+class TestServerMetrics(TestCase):
+
+    def test_observeCall(self):
+        metrics = ServerMetrics()
+        metrics.observeCall('add', 0.002)
+        metrics.observeCall('add', 0.02, jsonrpc.INVALID_PARAMS)
+
+        stats = metrics.stats()['methods']['add']
+        self.assertEquals(stats['calls'], 2)
+        self.assertEquals(stats['errors'], {jsonrpc.INVALID_PARAMS: 1})
+        self.assertEquals(stats['latency']['count'], 2)
+
+    def test_reset(self):
+        metrics = ServerMetrics()
+        metrics.observeCall('add', 0.002)
+        metrics.observeRequest(100)
+        metrics.reset()
+
+        stats = metrics.stats()
+        self.assertEquals(stats['methods'], {})
+        self.assertEquals(stats['requestSize']['count'], 0)
+
+    def test_exposition(self):
+        metrics = ServerMetrics(latencyBuckets=[0.1], sizeBuckets=[100])
+        metrics.observeCall('add', 0.05)
+        metrics.observeCall('add', 0.5, jsonrpc.INTERNAL_ERROR)
+        metrics.observeRequest(50)
+        metrics.observeResponse(500)
+
+        lines = metrics.exposition('rpc').splitlines()
+        self.assertIn('# TYPE rpc_calls_total counter', lines)
+        self.assertIn('rpc_calls_total{method="add"} 2', lines)
+        self.assertIn('rpc_errors_total{method="add",code="-32603"} 1',
+                      lines)
+        self.assertIn('# TYPE rpc_call_duration_seconds histogram', lines)
+        self.assertIn('rpc_call_duration_seconds_bucket' +
+                      '{method="add",le="0.1"} 1', lines)
+        self.assertIn('rpc_call_duration_seconds_bucket' +
+                      '{method="add",le="+Inf"} 2', lines)
+        self.assertIn('rpc_call_duration_seconds_count{method="add"} 2',
+                      lines)
+        self.assertIn('rpc_request_size_bytes_bucket{le="100"} 1', lines)
+        self.assertIn('rpc_response_size_bytes_bucket{le="100"} 0', lines)
+        self.assertIn('rpc_response_size_bytes_sum 500', lines)
+
+    def test_escape(self):
+        metrics = ServerMetrics()
+        metrics.observeCall('a"b\\c', 0.1)
+        self.assertIn('rpc_calls_total{method="a\\"b\\\\c"} 1',
+                      metrics.exposition('rpc').splitlines())
+
+
+class TestRequestTiming(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.timing = RequestTiming(self.clock)
+
+    def test_phases(self):
+        self.assertEquals(sorted(self.timing.phases), sorted(PHASES))
+
+        self.clock.advance(0.5)
+        start = self.timing.add('decode', self.timing.start)
+        self.clock.advance(0.25)
+        self.timing.add('dispatch', start)
+        self.timing.add('dispatch', start)
+
+        self.assertEquals(self.timing.phases['decode'], 0.5)
+        self.assertEquals(self.timing.phases['dispatch'], 0.5)
+        self.assertEquals(self.timing.total, None)
+
+        self.timing.finish()
+        self.assertEquals(self.timing.total, 0.75)
+
+    def test_cbAdd(self):
+        start = self.timing.now()
+        self.clock.advance(1)
+        self.assertEquals(self.timing.cbAdd('result', 'encode', start),
+                          'result')
+        self.assertEquals(self.timing.phases['encode'], 1)
+
+    def test_serverTiming(self):
+        self.clock.advance(0.002)
+        self.timing.add('decode', self.timing.start)
+        self.clock.advance(0.001)
+
+        self.assertEquals(self.timing.serverTiming(),
+                          'decode;dur=2.000, total;dur=3.000')
+
+
+class MetricsDispatcher(JSONRPCDispatcher):
+    collectMetrics = True
+
+    def jsonrpc_echo(self, value):
+        return value
+
+    def jsonrpc_fail(self):
+        raise jsonrpc.JSONRPCError('failed', 123)
+
+    def jsonrpc_later(self):
+        self.pending = Deferred()
+        return self.pending
+
+
+class TestDispatcherMetrics(TestCase):
+
+    def setUp(self):
+        self.dispatcher = MetricsDispatcher()
+        self.metrics = self.dispatcher.getMetrics()
+        self.metrics.reset()
+        self.addCleanup(setattr, self.metrics, 'clock', self.metrics.clock)
+        self.metrics.clock = Clock()
+
+    def test_disabled(self):
+        self.assertEquals(JSONRPCDispatcher().getMetrics(), None)
+
+    def test_shared(self):
+        self.assertIdentical(MetricsDispatcher().getMetrics(), self.metrics)
+
+    def test_calls(self):
+        self.dispatcher._dispatchCall({'method': 'echo', 'params': [1],
+                                       'id': 1})
+        self.dispatcher._dispatchCall({'method': 'fail', 'id': 2})
+        self.dispatcher._dispatchCall({'method': 'nosuchmethod', 'id': 3})
+
+        stats = self.metrics.stats()['methods']
+        self.assertEquals(stats['echo']['calls'], 1)
+        self.assertEquals(stats['echo']['errors'], {})
+        self.assertEquals(stats['fail']['errors'], {123: 1})
+        self.assertEquals(stats[ServerMetrics.UNKNOWN_METHOD]['errors'],
+                          {jsonrpc.METHOD_NOT_FOUND: 1})
+
+    def test_latency(self):
+        response = self.dispatcher._dispatchCall({'method': 'later',
+                                                  'id': 1})
+        self.metrics.clock.advance(1.5)
+        self.dispatcher.pending.callback('done')
+
+        self.assertEquals(self.successResultOf(response),
+                          '{"error": null, "id": 1, "result": "done"}')
+        stats = self.metrics.stats()['methods']
+        self.assertEquals(stats['later']['latency']['sum'], 1.5)
+
+
+class TestMetricsResource(TestCase):
+
+    def test_render(self):
+        dispatcher = MetricsDispatcher()
+        dispatcher.getMetrics().reset()
+        dispatcher._dispatchCall({'method': 'echo', 'params': [1], 'id': 1})
+
+        request = DummyRequest([''])
+        body = MetricsResource(dispatcher).render_GET(request)
+        self.assertIn('jsonrpc_calls_total{method="echo"} 1',
+                      body.splitlines())
+        self.assertTrue(request.outgoingHeaders['content-type']
+                        .startswith('text/plain'))
+
+    def test_disabled(self):
+        request = DummyRequest([''])
+        body = MetricsResource(JSONRPCDispatcher()).render_GET(request)
+        self.assertEquals(body, '')
@@ -3,10 +3,17 @@ import sys
 sys.path.insert(0, os.path.abspath('..'))
 
 from twisted.trial import unittest
+from twisted.test import proto_helpers
 from twisted.internet.protocol import Factory
 from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError
 
-from fastjsonrpc.netstringclient import Proxy
+from fastjsonrpc.netstringclient import Proxy, MultiplexingProxy
+from fastjsonrpc.netstringclient import MultiplexingProtocol
+from fastjsonrpc.netstringclient import ConnectionPool
 from fastjsonrpc import jsonrpc
 from dummynetstringserver import DummyProtocol
 
@@ -92,6 +99,22 @@ class TestProxy(unittest.TestCase):
         d.addCallback(finished)
         return d
 
+    def test_connectionRefused(self):
+        port = reactor.listenTCP(0, Factory())
+        url = 'localhost:%s' % port._realPortNumber
+        d = port.stopListening()
+
+        def stopped(_):
+            proxy = Proxy(url)
+            e = self.assertFailure(proxy.callRemote('echo', 'a'),
+                                   ConnectionRefusedError)
+            e.addCallback(lambda _: self.assertEquals(proxy._ids.outstanding,
+                                                      set()))
+            return e
+
+        d.addCallback(stopped)
+        return d
+
     def test_keywordsUnexpected(self):
         data = 'some random string'
 
@@ -107,3 +130,315 @@ class TestProxy(unittest.TestCase):
 
         e.addCallback(finished)
         return d
+
+
+class PipelinedProtocol(DummyProtocol):
+    persistent = True
+    pipelineDepth = 10
+
+
+class TestMultiplexingProxy(unittest.TestCase):
+
+    def setUp(self):
+        factory = Factory()
+        factory.protocol = PipelinedProtocol
+        self.port = reactor.listenTCP(0, factory)
+        self.addr = 'localhost:%s' % self.port._realPortNumber
+        self.proxy = MultiplexingProxy(self.addr)
+
+    def tearDown(self):
+        d = self.proxy.disconnect()
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+    def test_init(self):
+        proxy = MultiplexingProxy('example.com:8111', jsonrpc.VERSION_2,
+                                  maxConnections=3)
+        self.assertEquals(proxy.hostname, 'example.com')
+        self.assertEquals(proxy.port, 8111)
+        self.assertEquals(proxy.version, jsonrpc.VERSION_2)
+        self.assertEquals(proxy.maxConnections, 3)
+        self.assertEquals(proxy.connections, [])
+
+    def test_oneConnection(self):
+        ds = [self.proxy.callRemote('echo', i) for i in range(5)]
+
+        def finished(results):
+            self.assertEquals([result for _, result in results], range(5))
+            self.assertEquals(len(self.proxy.connections), 1)
+
+        d = DeferredList(ds, fireOnOneErrback=True)
+        d.addCallback(finished)
+        return d
+
+    def test_error(self):
+        d = self.proxy.callRemote('nosuchmethod')
+        e = self.assertFailure(d, jsonrpc.JSONRPCError)
+
+        def finished(result):
+            self.assertEquals(result.errno, jsonrpc.METHOD_NOT_FOUND)
+
+        e.addCallback(finished)
+        return e
+
+    def test_maxConnections(self):
+        self.proxy.maxConnections = 2
+        ds = [self.proxy.callRemote('echo', 'a')]
+        self.assertEquals(len(self.proxy.connecting), 1)
+        ds.append(self.proxy.callRemote('echo', 'b'))
+        self.assertEquals(len(self.proxy.connecting), 2)
+        ds.append(self.proxy.callRemote('echo', 'c'))
+        self.assertEquals(len(self.proxy.connecting), 2)
+
+        def finished(results):
+            self.assertEquals([result for _, result in results],
+                              ['a', 'b', 'c'])
+            self.assertEquals(len(self.proxy.connections), 2)
+
+        d = DeferredList(ds, fireOnOneErrback=True)
+        d.addCallback(finished)
+        return d
+
+    def test_reconnect(self):
+        d = self.proxy.callRemote('echo', 'a')
+        d.addCallback(lambda _: self.proxy.disconnect())
+
+        def disconnected(_):
+            self.assertEquals(self.proxy.connections, [])
+            return self.proxy.callRemote('echo', 'b')
+
+        d.addCallback(disconnected)
+        d.addCallback(self.assertEquals, 'b')
+        return d
+
+
+class TestMultiplexingProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = MultiplexingProxy('localhost:8111')
+        self.proto = MultiplexingProtocol(self.proxy)
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+        self.proxy.connections.append(self.proto)
+
+    def _response(self, id_, result):
+        string = '{"error": null, "id": %d, "result": "%s"}' % (id_, result)
+        self.proto.dataReceived('%d:%s,' % (len(string), string))
+
+    def test_outOfOrder(self):
+        first = Deferred()
+        second = Deferred()
+        self.assertEquals(self.proto.sendCall('echo', ['a'], first), 1)
+        self.assertEquals(self.proto.sendCall('echo', ['b'], second), 2)
+
+        requests = [jsonrpc.encodeRequest('echo', [param], id_=id_)
+                    for id_, param in [(1, 'a'), (2, 'b')]]
+        self.assertEquals(self.tr.value(), ''.join(
+            '%d:%s,' % (len(request), request) for request in requests))
+
+        self._response(2, 'b')
+        self.assertEquals(second.result, 'b')
+        self.assertFalse(first.called)
+        self._response(1, 'a')
+        self.assertEquals(first.result, 'a')
+        self.assertEquals(len(self.proto.calls), 0)
+        self.assertEquals(self.proxy._ids.outstanding, set())
+
+    def test_unknownId(self):
+        d = Deferred()
+        self.proto.sendCall('echo', ['a'], d)
+        self._response(5, 'a')
+        self.assertFalse(d.called)
+
+    def test_connectionLost(self):
+        d = Deferred()
+        self.proto.sendCall('echo', ['a'], d)
+        self.proto.connectionLost(Failure(ConnectionDone()))
+
+        self.assertEquals(self.proxy.connections, [])
+        self.assertEquals(self.proxy._ids.outstanding, set())
+        self.assertTrue(self.proto.closed.called)
+        return self.assertFailure(d, ConnectionDone)
+
+
+class FakeEndpoint(object):
+
+    def __init__(self):
+        self.protocols = []
+
+    def connect(self, factory):
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(proto_helpers.StringTransport())
+        self.protocols.append(protocol)
+        return succeed(protocol)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = ConnectionPool(self.clock)
+        self.endpoint = FakeEndpoint()
+        self.key = ('localhost', 8111)
+
+    def _get(self):
+        result = []
+        self.pool.getConnection(self.key, self.endpoint).addCallback(
+            result.append)
+        return result
+
+    def test_reuse(self):
+        first, = self._get()
+        self.pool.returnConnection(first)
+        second, = self._get()
+        self.assertIdentical(first, second)
+        self.assertEquals(len(self.endpoint.protocols), 1)
+
+    def test_maxPersistentPerHost(self):
+        self.pool.maxPersistentPerHost = 1
+        first, = self._get()
+        second, = self._get()
+        self.pool.returnConnection(first)
+        self.pool.returnConnection(second)
+        self.assertFalse(first.transport.disconnecting)
+        self.assertTrue(second.transport.disconnecting)
+
+    def test_idleEviction(self):
+        first, = self._get()
+        self.pool.returnConnection(first)
+        self.clock.advance(self.pool.cachedConnectionTimeout)
+        self.assertTrue(first.transport.disconnecting)
+
+        second, = self._get()
+        self.assertNotIdentical(first, second)
+
+    def test_healthCheck(self):
+        first, = self._get()
+        self.pool.returnConnection(first)
+        first.transport.disconnecting = True
+
+        second, = self._get()
+        self.assertNotIdentical(first, second)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_lostWhileIdle(self):
+        first, = self._get()
+        self.pool.returnConnection(first)
+        first.connectionLost(Failure(ConnectionDone()))
+
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        second, = self._get()
+        self.assertNotIdentical(first, second)
+
+    def test_unexpectedResponse(self):
+        first, = self._get()
+        self.pool.returnConnection(first)
+        first.dataReceived('2:{},')
+        self.assertTrue(first.transport.disconnecting)
+
+    def test_maxConnectionsPerHost(self):
+        self.pool.maxConnectionsPerHost = 1
+        first, = self._get()
+        waiting = self._get()
+        self.assertEquals(waiting, [])
+
+        self.pool.returnConnection(first)
+        self.assertEquals(waiting, [first])
+        self.assertEquals(len(self.endpoint.protocols), 1)
+
+    def test_waitingAfterLost(self):
+        self.pool.maxConnectionsPerHost = 1
+        first, = self._get()
+        waiting = self._get()
+
+        first.connectionLost(Failure(ConnectionDone()))
+        self.assertEquals(len(waiting), 1)
+        self.assertNotIdentical(waiting[0], first)
+
+    def test_lostDuringCall(self):
+        first, = self._get()
+        d = first.sendCall('{}')
+        self.assertEquals(first.transport.value(), '2:{},')
+
+        first.connectionLost(Failure(ConnectionDone()))
+        self.assertEquals(self.pool._busy[self.key], 0)
+        return self.assertFailure(d, ConnectionDone)
+
+
+class CountingFactory(Factory):
+    protocol = PipelinedProtocol
+
+    def __init__(self):
+        self.connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return Factory.buildProtocol(self, addr)
+
+
+class TestPooledProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = CountingFactory()
+        self.port = reactor.listenTCP(0, self.factory)
+        self.addr = 'localhost:%s' % self.port._realPortNumber
+        self.pool = ConnectionPool()
+        self.proxy = Proxy(self.addr, pool=self.pool)
+
+    def tearDown(self):
+        d = self.pool.closeCachedConnections()
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+    def test_reuse(self):
+        d = self.proxy.callRemote('echo', 'a')
+        d.addCallback(self.assertEquals, 'a')
+        d.addCallback(lambda _: self.proxy.callRemote('echo', 'b'))
+        d.addCallback(self.assertEquals, 'b')
+
+        def finished(_):
+            self.assertEquals(self.factory.connections, 1)
+
+        d.addCallback(finished)
+        return d
+
+    def test_error(self):
+        d = self.proxy.callRemote('nosuchmethod')
+        return self.assertFailure(d, jsonrpc.JSONRPCError)
+
+    def test_idsReleased(self):
+        d = self.proxy.callRemote('echo', 'a')
+
+        def finished(_):
+            self.assertEquals(self.proxy._ids.outstanding, set())
+
+        d.addCallback(finished)
+        return d
+
+
+class TestPooledProxyMismatch(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool(Clock())
+        self.proxy = Proxy('localhost:8111', pool=self.pool)
+        self.endpoint = FakeEndpoint()
+        self.pool.getConnection = lambda key, _: \
+            ConnectionPool.getConnection(self.pool, key, self.endpoint)
+
+    def _respond(self, string):
+        protocol, = self.endpoint.protocols
+        protocol.dataReceived('%d:%s,' % (len(string), string))
+        return protocol
+
+    def test_match(self):
+        d = self.proxy.callRemote('echo', 'a')
+        protocol = self._respond('{"error": null, "id": 1, "result": "a"}')
+        self.assertEquals(d.result, 'a')
+        self.assertEquals(protocol.state, 'idle')
+
+    def test_mismatch(self):
+        d = self.proxy.callRemote('echo', 'a')
+        protocol = self._respond('{"error": null, "id": 7, "result": "a"}')
+        self.assertTrue(protocol.transport.disconnecting)
+        self.assertEquals(self.proxy._ids.outstanding, set())
+        return self.assertFailure(d, ValueError)
@@ -8,7 +8,12 @@ from dummynetstringserver import DummyProtocol
 
 from twisted.trial import unittest
 from twisted.test import proto_helpers
+from twisted.internet.defer import Deferred, fail
 from twisted.internet.protocol import Factory
+from twisted.internet.task import Clock
+
+from fastjsonrpc.dispatch import stopPools
+from fastjsonrpc.netstringserver import JSONRPCServer
 
 
 class NetstringDecoder(object):
@@ -62,3 +67,315 @@ class TestServer(unittest.TestCase):
         expected = '{"result": null, "id": "ABCD", "error": {' + \
                    '"message": "Method ECHO not found", "code": -32601}}'
         self._testResult(request, expected)
+
+    def test_rawJSON(self):
+        request = '{"method": "rawJSON", "id": 1, "jsonrpc": "2.0"}'
+        expected = '{"jsonrpc": "2.0", "id": 1, "result": {"cached": [1, 2]}}'
+        self._testResult(request, expected)
+
+    def test_batchTooLong(self):
+        self.proto.maxBatchLength = 1
+        request = '[{"method": "echo", "id": 1, "params": ["a"]}, ' + \
+                  '{"method": "echo", "id": 2, "params": ["b"]}]'
+        expected = '{"jsonrpc": "2.0", "id": null, "error": ' + \
+                   '{"message": "Batch too long, at most 1 calls ' + \
+                   'allowed", "code": -32600}}'
+        self._testResult(request, expected)
+
+    def test_streamBatches(self):
+        self.proto.streamBatches = True
+        request = '[{"method": "echo", "id": 1, "params": ["a"]}, ' + \
+                  '{"method": "echo", "params": ["b"]}, ' + \
+                  '{"method": "echo", "id": 3, "params": ["c"]}]'
+        self.proto.dataReceived('%d:%s,' % (len(request), request))
+
+        first = '{"error": null, "id": 1, "result": "a"}'
+        second = '{"error": null, "id": 3, "result": "c"}'
+        expected = '%d:%s,%d:%s,0:,' % (len(first), first, len(second),
+                                        second)
+        self.assertEquals(self.tr.value(), expected)
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_incrementalStreamed(self):
+        self.proto.incrementalParseSize = 0
+        self.proto.streamBatches = True
+        request = '[{"method": "echo", "id": 1, "params": ["a"]}, 1'
+        self.proto.dataReceived('%d:%s,' % (len(request), request))
+
+        first = '{"error": null, "id": 1, "result": "a"}'
+        error = '{"jsonrpc": "2.0", "id": null, "error": ' + \
+                '{"message": "Parse error", "code": -32700}}'
+        expected = '%d:%s,%d:%s,0:,' % (len(first), first, len(error), error)
+        self.assertEquals(self.tr.value(), expected)
+
+    def test_threadedDecode(self):
+        self.proto.threadedDecodeSize = 0
+        self.addCleanup(stopPools)
+
+        request = '{"method": "echo", "id": 1, "params": ["a"]}'
+        d = self.proto.stringReceived(request)
+
+        def finished(_):
+            expected = '{"error": null, "id": 1, "result": "a"}'
+            decoder = NetstringDecoder(self.tr.value())
+            self.assertEquals(decoder.string, expected)
+
+        d.addCallback(finished)
+        return d
+
+    def test_tooLarge(self):
+        self.proto.maxRequestSize = 10
+        self.proto.dataReceived('1000:{"method"')
+
+        expected = '{"jsonrpc": "2.0", "id": null, "error": ' + \
+                   '{"message": "Request too large, at most 10 bytes ' + \
+                   'allowed", "code": -32600}}'
+        decoder = NetstringDecoder(self.tr.value())
+        self.assertEquals(decoder.string, expected)
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_malformedNetstring(self):
+        self.proto.dataReceived('abc:')
+        self.assertEquals(self.tr.value(), '')
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_unexpectedFailureStreamed(self):
+        self.proto.streamBatches = True
+        self.proto._streamRequest = lambda *args: fail(KeyError())
+        request = '[{"method": "echo", "id": 1, "params": ["a"]}]'
+        self.proto.dataReceived('%d:%s,' % (len(request), request))
+
+        error = '{"jsonrpc": "2.0", "id": null, "error": ' + \
+                '{"message": "Internal error", "code": -32603}}'
+        self.assertEquals(self.tr.value(), '%d:%s,0:,' % (len(error), error))
+        self.assertTrue(self.tr.disconnecting)
+        self.assertEquals(len(self.flushLoggedErrors(KeyError)), 1)
+
+    def test_unexpectedErrorStreamed(self):
+        def broken(*args):
+            raise KeyError()
+
+        self.proto.streamBatches = True
+        self.proto._streamRequest = broken
+        request = '[{"method": "echo", "id": 1, "params": ["a"]}]'
+        self.proto.dataReceived('%d:%s,' % (len(request), request))
+
+        error = '{"jsonrpc": "2.0", "id": null, "error": ' + \
+                '{"message": "Internal error", "code": -32603}}'
+        self.assertEquals(self.tr.value(), '%d:%s,0:,' % (len(error), error))
+        self.assertEquals(len(self.flushLoggedErrors(KeyError)), 1)
+
+    def test_metrics(self):
+        self.proto.collectMetrics = True
+        metrics = self.proto.getMetrics()
+        metrics.reset()
+
+        request = '{"method": "echo", "id": 1, "params": ["a"]}'
+        result = self._callMethod(request)
+
+        stats = metrics.stats()
+        self.assertEquals(stats['methods']['echo']['calls'], 1)
+        self.assertEquals(stats['requestSize']['sum'], len(request))
+        self.assertEquals(stats['responseSize']['sum'], len(result))
+
+    def test_timePhases(self):
+        timings = []
+        self.proto.timePhases = True
+        self.proto.requestTimed = timings.append
+
+        self._callMethod('{"method": "echo", "id": 1, "params": ["a"]}')
+
+        self.assertEquals(len(timings), 1)
+        self.assertEquals(timings[0].calls, 1)
+        self.assertNotEquals(timings[0].total, None)
+
+
+class PersistentServer(JSONRPCServer):
+    persistent = True
+    idleTimeout = 10
+
+    def __init__(self):
+        JSONRPCServer.__init__(self)
+        self.calls = []
+
+    def jsonrpc_echo(self, data):
+        return data
+
+    def jsonrpc_slow(self, data):
+        d = Deferred()
+        self.calls.append((d, data))
+        return d
+
+
+def _netstring(string):
+    return '%d:%s,' % (len(string), string)
+
+
+class TestPersistent(unittest.TestCase):
+    timeout = 1
+
+    def setUp(self):
+        self.clock = Clock()
+        self.proto = PersistentServer()
+        self.proto.callLater = self.clock.callLater
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+    def _request(self, method, id_, param):
+        return _netstring('{"method": "%s", "id": %d, "params": ["%s"]}' %
+                          (method, id_, param))
+
+    def _response(self, id_, result):
+        return _netstring('{"error": null, "id": %d, "result": "%s"}' %
+                          (id_, result))
+
+    def test_manyRequests(self):
+        self.proto.dataReceived(self._request('echo', 1, 'a') +
+                                self._request('echo', 2, 'b'))
+        self.proto.dataReceived(self._request('echo', 3, 'c'))
+
+        self.assertEquals(self.tr.value(), self._response(1, 'a') +
+                          self._response(2, 'b') + self._response(3, 'c'))
+        self.assertFalse(self.tr.disconnecting)
+
+    def test_inOrder(self):
+        self.proto.dataReceived(self._request('slow', 1, 'a') +
+                                self._request('echo', 2, 'b'))
+
+        self.assertEquals(self.tr.value(), '')
+        self.assertEquals(self.tr.producerState, 'paused')
+
+        d, data = self.proto.calls.pop()
+        d.callback(data)
+
+        self.assertEquals(self.tr.value(), self._response(1, 'a') +
+                          self._response(2, 'b'))
+        self.assertEquals(self.tr.producerState, 'producing')
+
+    def test_maxRequestsPerConnection(self):
+        self.proto.maxRequestsPerConnection = 2
+        self.proto.dataReceived(self._request('echo', 1, 'a') +
+                                self._request('echo', 2, 'b') +
+                                self._request('echo', 3, 'c'))
+
+        self.assertEquals(self.tr.value(), self._response(1, 'a') +
+                          self._response(2, 'b'))
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_idleTimeout(self):
+        self.proto.dataReceived(self._request('slow', 1, 'a'))
+        self.clock.advance(20)
+        self.assertFalse(self.tr.disconnecting)
+
+        d, data = self.proto.calls.pop()
+        d.callback(data)
+        self.clock.advance(9)
+        self.assertFalse(self.tr.disconnecting)
+        self.clock.advance(1)
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_idleBeforeFirstRequest(self):
+        self.clock.advance(10)
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_streamBatches(self):
+        self.proto.streamBatches = True
+        request = '[{"method": "echo", "id": 1, "params": ["a"]}]'
+        self.proto.dataReceived(_netstring(request) +
+                                self._request('echo', 2, 'b'))
+
+        self.assertEquals(self.tr.value(), self._response(1, 'a') + '0:,' +
+                          self._response(2, 'b'))
+        self.assertFalse(self.tr.disconnecting)
+
+    def _internalError(self):
+        return _netstring('{"jsonrpc": "2.0", "id": null, "error": '
+                          '{"message": "Internal error", "code": -32603}}')
+
+    def test_unexpectedFailure(self):
+        decode = self.proto._decodeRequestString
+        self.proto._decodeRequestString = lambda string: fail(KeyError())
+        self.proto.dataReceived(self._request('echo', 1, 'a'))
+        self.proto._decodeRequestString = decode
+        self.proto.dataReceived(self._request('echo', 2, 'b'))
+
+        self.assertEquals(self.tr.value(), self._internalError() +
+                          self._response(2, 'b'))
+        self.assertEquals(self.proto._inProgress, 0)
+        self.assertEquals(len(self.flushLoggedErrors(KeyError)), 1)
+
+        self.clock.advance(10)
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_connectionLost(self):
+        self.proto.dataReceived(self._request('slow', 1, 'a'))
+        self.proto.connectionLost(None)
+
+        d, data = self.proto.calls.pop()
+        d.callback(data)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+class TestPipelined(TestPersistent):
+
+    def setUp(self):
+        TestPersistent.setUp(self)
+        self.proto.pipelineDepth = 2
+
+    def test_inOrder(self):
+        self.proto.dataReceived(self._request('slow', 1, 'a') +
+                                self._request('echo', 2, 'b'))
+
+        # the second request didn't wait for the first one
+        self.assertEquals(self.tr.value(), self._response(2, 'b'))
+
+        d, data = self.proto.calls.pop()
+        d.callback(data)
+        self.assertEquals(self.tr.value(), self._response(2, 'b') +
+                          self._response(1, 'a'))
+
+    def test_pipelineDepth(self):
+        self.proto.dataReceived(self._request('slow', 1, 'a') +
+                                self._request('slow', 2, 'b') +
+                                self._request('echo', 3, 'c'))
+
+        self.assertEquals(len(self.proto.calls), 2)
+        self.assertEquals(self.tr.value(), '')
+        self.assertEquals(self.tr.producerState, 'paused')
+
+        d, data = self.proto.calls.pop()
+        d.callback(data)
+        self.assertEquals(self.tr.value(), self._response(2, 'b') +
+                          self._response(3, 'c'))
+        self.assertEquals(self.tr.producerState, 'producing')
+
+        d, data = self.proto.calls.pop()
+        d.callback(data)
+        self.assertEquals(self.tr.value(), self._response(2, 'b') +
+                          self._response(3, 'c') + self._response(1, 'a'))
+
+    def test_maxRequestsPerConnectionInProgress(self):
+        self.proto.maxRequestsPerConnection = 2
+        self.proto.dataReceived(self._request('slow', 1, 'a') +
+                                self._request('echo', 2, 'b') +
+                                self._request('echo', 3, 'c'))
+
+        self.assertEquals(self.tr.value(), self._response(2, 'b'))
+        self.assertFalse(self.tr.disconnecting)
+
+        d, data = self.proto.calls.pop()
+        d.callback(data)
+        self.assertEquals(self.tr.value(), self._response(2, 'b') +
+                          self._response(1, 'a'))
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_streamBatches(self):
+        self.proto.streamBatches = True
+        request = '[{"method": "echo", "id": 1, "params": ["a"]}]'
+        self.proto.dataReceived(_netstring(request) +
+                                self._request('echo', 2, 'b'))
+
+        # answered as a whole, no framed mode
+        response = '[{"error": null, "id": 1, "result": "a"}]'
+        self.assertEquals(self.tr.value(), _netstring(response) +
+                          self._response(2, 'b'))
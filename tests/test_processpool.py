@@ -0,0 +1,173 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath('..'))
+
+from twisted.trial.unittest import TestCase
+
+from fastjsonrpc import jsonrpc
+from fastjsonrpc.dispatch import JSONRPCDispatcher, inProcess, rawParams
+from fastjsonrpc.dispatch import setProcessPool, getProcessPool, stopPools
+from fastjsonrpc.processpool import ProcessPool
+
+
+class ProcessDispatcher(JSONRPCDispatcher):
+
+    def __init__(self):
+        self.state = 'not in workers'
+
+    def jsonrpc_pid(self):
+        return os.getpid()
+
+    def jsonrpc_add(self, a, b=0):
+        return a + b
+
+    def jsonrpc_fail(self):
+        raise jsonrpc.JSONRPCError('failed', 123, 'data')
+
+    def jsonrpc_crash(self):
+        os._exit(1)
+
+    def jsonrpc_state(self):
+        return getattr(self, 'state', None)
+
+    def jsonrpc_raw(self):
+        return jsonrpc.RawJSON('{"raw": true}')
+
+    @inProcess
+    def jsonrpc_square(self, x):
+        return [os.getpid(), x * x]
+
+    @inProcess
+    @rawParams
+    def jsonrpc_length(self, params):
+        return len(params.json)
+
+
+class TestProcessPool(TestCase):
+
+    timeout = 10
+
+    def setUp(self):
+        self.pool = ProcessPool(size=2, maxCallsPerWorker=2)
+
+    def tearDown(self):
+        return self.pool.stop()
+
+    def _call(self, name, *args, **kwargs):
+        return self.pool.callMethod(ProcessDispatcher, 'jsonrpc_' + name,
+                                    args, kwargs)
+
+    def test_result(self):
+        d = self._call('add', 1, b=2)
+        d.addCallback(self.assertEquals, jsonrpc.RawJSON('3'))
+        return d
+
+    def test_rawJSONResult(self):
+        d = self._call('raw')
+        d.addCallback(self.assertEquals, jsonrpc.RawJSON('{"raw": true}'))
+        return d
+
+    def test_exception(self):
+        d = self.assertFailure(self._call('fail'), jsonrpc.JSONRPCError)
+
+        def failed(e):
+            self.assertEquals(e.strerror, 'failed')
+            self.assertEquals(e.errno, 123)
+            self.assertEquals(e.data, 'data')
+
+        d.addCallback(failed)
+        return d
+
+    def test_bareInstance(self):
+        d = self._call('state')
+        d.addCallback(self.assertEquals, jsonrpc.RawJSON('null'))
+        return d
+
+    def test_crash(self):
+        d = self.assertFailure(self._call('crash'), jsonrpc.JSONRPCError)
+
+        def failed(e):
+            self.assertEquals(e.errno, jsonrpc.INTERNAL_ERROR)
+            return self._call('add', 1, 1)
+
+        d.addCallback(failed)
+        d.addCallback(self.assertEquals, jsonrpc.RawJSON('2'))
+        return d
+
+    def test_recycle(self):
+        pids = []
+
+        def called(result):
+            pids.append(jsonrpc.jloads(result.json))
+            if len(pids) < 3:
+                return self._call('pid').addCallback(called)
+
+        d = self._call('pid').addCallback(called)
+
+        def finished(_):
+            self.assertEquals(pids[0], pids[1])
+            self.assertNotEquals(pids[1], pids[2])
+
+        d.addCallback(finished)
+        return d
+
+    def test_queue(self):
+        ds = [self._call('add', i) for i in range(5)]
+        self.assertEquals(len(self.pool.workers), 2)
+        self.assertEquals(len(self.pool.queue), 3)
+
+        d = ds[-1]
+        d.addCallback(self.assertEquals, jsonrpc.RawJSON('4'))
+        return d
+
+
+class TestInProcess(TestCase):
+
+    timeout = 10
+
+    def setUp(self):
+        setProcessPool('default', ProcessPool(size=1))
+        self.dispatcher = ProcessDispatcher()
+
+    def tearDown(self):
+        return stopPools()
+
+    def test_dispatch(self):
+        d = self.dispatcher._dispatchCall({'method': 'square', 'params': [3],
+                                           'id': 1})
+
+        def finished(response):
+            pid, square = jsonrpc.jloads(response)['result']
+            self.assertNotEquals(pid, os.getpid())
+            self.assertEquals(square, 9)
+
+        d.addCallback(finished)
+        return d
+
+    def test_rawParams(self):
+        request = '{"method": "length", "params": [1, 2], "id": 1}'
+        request = self.dispatcher._decodeRequest(request)
+        d = self.dispatcher._dispatchCall(request)
+        d.addCallback(self.assertEquals,
+                      '{"error": null, "id": 1, "result": 6}')
+        return d
+
+    def test_configurationKept(self):
+        pool = getProcessPool()
+        d = self.dispatcher._dispatchCall({'method': 'square', 'params': [3],
+                                           'id': 1})
+        d.addCallback(lambda _: stopPools())
+
+        def stopped(_):
+            self.assertIdentical(getProcessPool(), pool)
+            self.assertEquals(pool.size, 1)
+            return self.dispatcher._dispatchCall(
+                {'method': 'square', 'params': [4], 'id': 2})
+
+        def finished(response):
+            self.assertEquals(jsonrpc.jloads(response)['result'][1], 16)
+            self.assertEquals(len(pool.workers), 1)
+
+        d.addCallback(stopped)
+        d.addCallback(finished)
+        return d
@@ -2,6 +2,7 @@ import os
 import sys
 sys.path.insert(0, os.path.abspath('..'))
 import json
+import zlib
 
 from StringIO import StringIO
 from twisted.internet import reactor, defer
@@ -11,11 +12,15 @@ from twisted.trial.unittest import TestCase
 from twisted.web.client import Agent, ContentDecoderAgent, GzipDecoder
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
+from twisted.web.resource import EncodingResourceWrapper
 from twisted.web.server import NOT_DONE_YET, Site
 from twisted.web.test.test_web import DummyRequest
 from zope.interface import implements
 
 from fastjsonrpc.server import JSONRPCServer, EncodingJSONRPCServer
+from fastjsonrpc.server import ContentEncoderFactory
+from fastjsonrpc import jsonrpc
+from fastjsonrpc.dispatch import stopPools
 from dummyserver import DummyServer, DBFILE
 
 
@@ -136,6 +141,27 @@ class TestRender(TestCase):
         d.addCallback(rendered)
         return d
 
+    def test_finishedInline(self):
+        request = DummyRequest([''])
+        request.content = StringIO('{"method": "echo", "id": 1, ' +
+                                   '"params": ["ab"]}')
+        self.srv.render(request)
+        self.assertTrue(request.finished)
+        expected = '{"error": null, "id": 1, "result": "ab"}'
+        self.assertEquals(request.written[0], expected)
+
+    def test_rawJSON(self):
+        request = DummyRequest([''])
+        request.content = StringIO('{"method": "rawJSON", "id": 1}')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            expected = '{"error": null, "id": 1, "result": {"cached": [1, 2]}}'
+            self.assertEquals(request.written[0], expected)
+
+        d.addCallback(rendered)
+        return d
+
     def test_caseSensitiveMethodV1(self):
         request = DummyRequest([''])
         request.content = StringIO('{"method": "ECHO", "id": "ABCD", ' +
@@ -462,6 +488,787 @@ class TestRender(TestCase):
         return d
 
 
+class TestUnserializable(TestCase):
+    timeout = 1
+
+    def test_unserializableInBatch(self):
+        class RPCServer(JSONRPCServer):
+            def jsonrpc_bad(self):
+                return object()
+
+            def jsonrpc_good(self):
+                return 'good'
+
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "bad", "id": 1}, ' +
+                                   '{"method": "good", "id": 2}]')
+        d = _render(RPCServer(), request)
+
+        def rendered(_):
+            responses = json.loads(request.written[0])
+            self.assertEquals(responses[0]['error']['code'],
+                              jsonrpc.INTERNAL_ERROR)
+            self.assertEquals(responses[1]['result'], 'good')
+
+        d.addCallback(rendered)
+        return d
+
+
+class TestOverloaded(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        class RPCServer(JSONRPCServer):
+            maxConcurrentCalls = 1
+
+            def jsonrpc_slow(self):
+                return defer.Deferred()
+
+            def jsonrpc_fast(self):
+                return 'fast'
+
+        self.srv = RPCServer()
+        self.srv._dispatchCall({'method': 'slow', 'id': 1})
+
+    def test_single(self):
+        request = DummyRequest([''])
+        request.content = StringIO('{"method": "fast", "id": 2}')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(request.responseCode, 503)
+            response = json.loads(request.written[0])
+            self.assertEquals(response['id'], 2)
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.SERVER_OVERLOADED)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_batch(self):
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "fast", "id": 2}]')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertNotEquals(request.responseCode, 503)
+            response = json.loads(request.written[0])
+            self.assertEquals(response[0]['error']['code'],
+                              jsonrpc.SERVER_OVERLOADED)
+
+        d.addCallback(rendered)
+        return d
+
+
+class TestRequestLimits(TestCase):
+    timeout = 1
+
+    def test_tooLarge(self):
+        srv = DummyServer()
+        srv.maxRequestSize = 20
+
+        request = DummyRequest([''])
+        request.content = StringIO('{"method": "echo", "id": 1, ' +
+                                   '"params": ["a"]}')
+        d = _render(srv, request)
+
+        def rendered(_):
+            self.assertEquals(request.responseCode, 413)
+            expected = '{"jsonrpc": "2.0", "id": null, "error": ' + \
+                       '{"message": "Request too large, at most 20 ' + \
+                       'bytes allowed", "code": -32600}}'
+            self.assertEquals(request.written[0], expected)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_tooDeep(self):
+        srv = DummyServer()
+        srv.maxNestingDepth = 2
+
+        request = DummyRequest([''])
+        request.content = StringIO('{"method": "echo", "id": 1, ' +
+                                   '"params": [[1]]}')
+        d = _render(srv, request)
+
+        def rendered(_):
+            response = json.loads(request.written[0])
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.INVALID_REQUEST)
+
+        d.addCallback(rendered)
+        return d
+
+
+class TestBatchLimits(TestCase):
+    timeout = 1
+
+    def test_batchTooLong(self):
+        srv = DummyServer()
+        srv.maxBatchLength = 1
+
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "echo", "id": 1, ' +
+                                   '"params": ["a"]}, {"method": "echo", ' +
+                                   '"id": 2, "params": ["b"]}]')
+        d = _render(srv, request)
+
+        def rendered(_):
+            response = json.loads(request.written[0])
+            self.assertEquals(response['id'], None)
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.INVALID_REQUEST)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_incremental(self):
+        srv = DummyServer()
+        srv.incrementalParseSize = 0
+
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "echo", "id": 1, ' +
+                                   '"params": ["a"]}, {"method": "echo", ' +
+                                   '"id": 2, "params": ["b"]}]')
+        d = _render(srv, request)
+
+        def rendered(_):
+            response = json.loads(request.written[0])
+            self.assertEquals([r['result'] for r in response], ['a', 'b'])
+
+        d.addCallback(rendered)
+        return d
+
+    def test_incrementalMalformed(self):
+        srv = DummyServer()
+        srv.incrementalParseSize = 0
+
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "echo", "id": 1, ' +
+                                   '"params": ["a"]}, {"method": "ec')
+        d = _render(srv, request)
+
+        def rendered(_):
+            response = json.loads(request.written[0])
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.PARSE_ERROR)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_incrementalTooDeep(self):
+        srv = DummyServer()
+        srv.incrementalParseSize = 0
+
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "echo", "id": 1, ' +
+                                   '"params": ["a"]}, ' + '[' * 100000 +
+                                   ']' * 100000 + ']')
+        d = _render(srv, request)
+
+        def rendered(_):
+            response = json.loads(request.written[0])
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.PARSE_ERROR)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_threadedDecode(self):
+        srv = DummyServer()
+        srv.threadedDecodeSize = 0
+        self.addCleanup(stopPools)
+
+        request = DummyRequest([''])
+        request.content = StringIO('{"method": "echo", "id": 1, ' +
+                                   '"params": ["a"]}')
+        d = _render(srv, request)
+
+        def rendered(_):
+            self.assertEquals(request.written[0],
+                              '{"error": null, "id": 1, "result": "a"}')
+
+        d.addCallback(rendered)
+        return d
+
+    def test_threadedDecodeMalformed(self):
+        srv = DummyServer()
+        srv.threadedDecodeSize = 0
+        self.addCleanup(stopPools)
+
+        request = DummyRequest([''])
+        request.content = StringIO('{"method": "echo", "id": 1, ')
+        d = _render(srv, request)
+
+        def rendered(_):
+            response = json.loads(request.written[0])
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.PARSE_ERROR)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_threadedDecodeTooDeep(self):
+        srv = DummyServer()
+        srv.threadedDecodeSize = 0
+        self.addCleanup(stopPools)
+
+        request = DummyRequest([''])
+        request.content = StringIO('[' * 100000 + ']' * 100000)
+        d = _render(srv, request)
+
+        def rendered(_):
+            response = json.loads(request.written[0])
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.PARSE_ERROR)
+            self.assertEquals(request.finished, 1)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_threadedDecodeUnexpected(self):
+        srv = DummyServer()
+        srv.threadedDecodeSize = 0
+        self.addCleanup(stopPools)
+
+        def broken(stream):
+            raise KeyError('broken')
+
+        srv._readRequest = broken
+        request = DummyRequest([''])
+        request.content = StringIO('{"method": "echo", "id": 1}')
+        d = _render(srv, request)
+
+        def rendered(_):
+            response = json.loads(request.written[0])
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.INTERNAL_ERROR)
+            self.assertEquals(request.finished, 1)
+            self.assertEquals(len(self.flushLoggedErrors(KeyError)), 1)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_batchWindow(self):
+        srv = DummyServer()
+        srv.batchWindow = 2
+
+        calls = ['{"method": "echo", "id": %d, "params": [%d]}' % (i, i)
+                 for i in range(5)]
+        request = DummyRequest([''])
+        request.content = StringIO('[' + ', '.join(calls) + ']')
+        d = _render(srv, request)
+
+        def rendered(_):
+            response = json.loads(request.written[0])
+            self.assertEquals([r['result'] for r in response], range(5))
+
+        d.addCallback(rendered)
+        return d
+
+
+class TestStreamBatches(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        class RPCServer(JSONRPCServer):
+            streamBatches = True
+
+            def __init__(self):
+                JSONRPCServer.__init__(self)
+                self.calls = []
+
+            def jsonrpc_slow(self, value):
+                d = defer.Deferred()
+                self.calls.append((d, value))
+                return d
+
+            def jsonrpc_fast(self, value):
+                return value
+
+        self.srv = RPCServer()
+
+    def test_stream(self):
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "slow", "id": 1, ' +
+                                   '"params": [1]}, {"method": "fast", ' +
+                                   '"id": 2, "params": [2]}]')
+        d = _render(self.srv, request)
+
+        self.assertEquals(request.written,
+                          ['[{"error": null, "id": 2, "result": 2}'])
+
+        call, value = self.srv.calls.pop()
+        call.callback(value)
+
+        def rendered(_):
+            response = json.loads(''.join(request.written))
+            self.assertEquals([r['id'] for r in response], [2, 1])
+
+        d.addCallback(rendered)
+        return d
+
+    def test_notificationsOnly(self):
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "fast", "params": [1]}]')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(request.written, [])
+
+        d.addCallback(rendered)
+        return d
+
+    def test_single(self):
+        request = DummyRequest([''])
+        request.content = StringIO('{"method": "fast", "id": 1, ' +
+                                   '"params": [1]}')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(request.written,
+                              ['{"error": null, "id": 1, "result": 1}'])
+
+        d.addCallback(rendered)
+        return d
+
+    def test_unexpectedFailure(self):
+        def broken(request_content, write, timing=None):
+            write('{"error": null, "id": 1, "result": 1}')
+            return defer.fail(KeyError('broken'))
+
+        self.srv._streamRequest = broken
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "fast", "id": 1, ' +
+                                   '"params": [1]}]')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            response = json.loads(''.join(request.written))
+            self.assertEquals(response[1]['error']['code'],
+                              jsonrpc.INTERNAL_ERROR)
+            self.assertEquals(request.finished, 1)
+            self.assertEquals(len(self.flushLoggedErrors(KeyError)), 1)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_unexpectedError(self):
+        def broken(request_content, write, timing=None):
+            raise KeyError('broken')
+
+        self.srv._streamRequest = broken
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "fast", "id": 1, ' +
+                                   '"params": [1]}]')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            response = json.loads(request.written[0])
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.INTERNAL_ERROR)
+            self.assertEquals(request.finished, 1)
+            self.assertEquals(len(self.flushLoggedErrors(KeyError)), 1)
+
+        d.addCallback(rendered)
+        return d
+
+
+class TestCompression(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        class RPCServer(JSONRPCServer):
+            compression = ['gzip', 'deflate']
+            compressionMinSize = 100
+
+            def jsonrpc_echo(self, value):
+                return value
+
+        self.srv = RPCServer()
+
+    def _request(self, value, acceptEncoding=None):
+        request = DummyRequest([''])
+        request.content = StringIO(json.dumps({'method': 'echo', 'id': 1,
+                                               'params': [value]}))
+        if acceptEncoding is not None:
+            request.headers['accept-encoding'] = acceptEncoding
+        return request
+
+    def _header(self, request, name):
+        return request.outgoingHeaders.get(name)
+
+    def test_compressed(self):
+        request = self._request('x' * 200, 'gzip')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(self._header(request, 'content-encoding'),
+                              'gzip')
+            self.assertEquals(self._header(request, 'vary'),
+                              'Accept-Encoding')
+            body = ''.join(request.written)
+            self.assertEquals(self._header(request, 'content-length'),
+                              str(len(body)))
+            response = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            self.assertEquals(json.loads(response)['result'], 'x' * 200)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_negotiated(self):
+        request = self._request('x' * 200, 'gzip;q=0.5, deflate')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(self._header(request, 'content-encoding'),
+                              'deflate')
+            response = zlib.decompress(''.join(request.written))
+            self.assertEquals(json.loads(response)['result'], 'x' * 200)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_small(self):
+        request = self._request('x', 'gzip')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(self._header(request, 'content-encoding'),
+                              None)
+            self.assertEquals(self._header(request, 'vary'),
+                              'Accept-Encoding')
+            self.assertEquals(request.written,
+                              ['{"error": null, "id": 1, "result": "x"}'])
+
+        d.addCallback(rendered)
+        return d
+
+    def test_notAccepted(self):
+        request = self._request('x' * 200, 'br, gzip;q=0')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(self._header(request, 'content-encoding'),
+                              None)
+            response = json.loads(''.join(request.written))
+            self.assertEquals(response['result'], 'x' * 200)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_disabled(self):
+        self.srv.compression = None
+        request = self._request('x' * 200, 'gzip')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(self._header(request, 'content-encoding'),
+                              None)
+            self.assertEquals(self._header(request, 'vary'), None)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_streamed(self):
+        self.srv.streamBatches = True
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "echo", "id": 1, ' +
+                                   '"params": [1]}, {"method": "echo", ' +
+                                   '"id": 2, "params": [2]}]')
+        request.headers['accept-encoding'] = 'gzip'
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(self._header(request, 'content-encoding'),
+                              'gzip')
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            # every chunk can be decompressed as soon as it arrives
+            first = decompressor.decompress(request.written[0])
+            self.assertEquals(first,
+                              '[{"error": null, "id": 1, "result": 1}')
+            rest = decompressor.decompress(''.join(request.written[1:]))
+            self.assertEquals(json.loads(first + rest)[1]['result'], 2)
+
+        d.addCallback(rendered)
+        return d
+
+
+class TestCompressedRequests(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        class RPCServer(JSONRPCServer):
+            maxRequestSize = 1000
+
+            def jsonrpc_echo(self, value):
+                return value
+
+        self.srv = RPCServer()
+
+    def _request(self, body, contentEncoding):
+        request = DummyRequest([''])
+        request.content = StringIO(body)
+        request.headers['content-encoding'] = contentEncoding
+        return request
+
+    def test_gzip(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress('{"method": "echo", "id": 1, ' +
+                                   '"params": ["abc"]}') + compressor.flush()
+        request = self._request(body, 'gzip')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(request.written,
+                              ['{"error": null, "id": 1, "result": "abc"}'])
+
+        d.addCallback(rendered)
+        return d
+
+    def test_identity(self):
+        request = self._request('{"method": "echo", "id": 1, ' +
+                                '"params": [1]}', 'identity')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(request.written,
+                              ['{"error": null, "id": 1, "result": 1}'])
+
+        d.addCallback(rendered)
+        return d
+
+    def test_unsupported(self):
+        request = self._request('{}', 'foo')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(request.responseCode, 415)
+            response = json.loads(request.written[0])
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.INVALID_REQUEST)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_corrupt(self):
+        request = self._request('not compressed', 'deflate')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            response = json.loads(request.written[0])
+            self.assertEquals(response['error']['code'], jsonrpc.PARSE_ERROR)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_tooLargeDecompressed(self):
+        params = json.dumps(['x' * 10000])
+        body = zlib.compress('{"method": "echo", "id": 1, "params": ' +
+                             params + '}')
+        self.assertTrue(len(body) < self.srv.maxRequestSize)
+
+        request = self._request(body, 'deflate')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(request.responseCode, 413)
+            response = json.loads(request.written[0])
+            self.assertEquals(response['error']['code'],
+                              jsonrpc.INVALID_REQUEST)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_maxDecompressedSize(self):
+        self.srv.maxRequestSize = None
+        self.srv.maxDecompressedSize = 1000
+        body = zlib.compress('[' + '0, ' * 100000 + '0]')
+
+        request = self._request(body, 'deflate')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(request.responseCode, 413)
+            response = json.loads(request.written[0])
+            self.assertEquals(response['error']['message'],
+                              'Request too large, at most 1000 bytes '
+                              'allowed')
+
+        d.addCallback(rendered)
+        return d
+
+
+class TestMetrics(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        class RPCServer(JSONRPCServer):
+            collectMetrics = True
+
+            def jsonrpc_echo(self, value):
+                return value
+
+        self.srv = RPCServer()
+
+    def test_sizes(self):
+        body = '{"method": "echo", "id": 1, "params": ["abc"]}'
+        request = DummyRequest([''])
+        request.content = StringIO(body)
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            stats = self.srv.getMetrics().stats()
+            self.assertEquals(stats['methods']['echo']['calls'], 1)
+            self.assertEquals(stats['requestSize']['sum'], len(body))
+            self.assertEquals(stats['responseSize']['sum'],
+                              len(''.join(request.written)))
+
+        d.addCallback(rendered)
+        return d
+
+    def test_streamed(self):
+        self.srv.streamBatches = True
+        request = DummyRequest([''])
+        request.content = StringIO('[{"method": "echo", "id": 1, ' +
+                                   '"params": [1]}, {"method": "echo", ' +
+                                   '"id": 2, "params": [2]}]')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            stats = self.srv.getMetrics().stats()
+            self.assertEquals(stats['methods']['echo']['calls'], 2)
+            self.assertEquals(stats['responseSize']['count'], 1)
+            self.assertEquals(stats['responseSize']['sum'],
+                              len(''.join(request.written)))
+
+        d.addCallback(rendered)
+        return d
+
+
+class TestPhaseTiming(TestCase):
+    timeout = 1
+
+    def setUp(self):
+        timings = self.timings = []
+
+        class RPCServer(JSONRPCServer):
+            timePhases = True
+
+            def jsonrpc_echo(self, value):
+                return value
+
+            def requestTimed(self, timing):
+                timings.append(timing)
+
+        self.srv = RPCServer()
+
+    def _request(self, body):
+        request = DummyRequest([''])
+        request.content = StringIO(body)
+        return request
+
+    def test_timed(self):
+        request = self._request('[{"method": "echo", "id": 1, ' +
+                                '"params": [1]}, {"method": "echo", ' +
+                                '"id": 2, "params": [2]}]')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(len(self.timings), 1)
+            timing = self.timings[0]
+            self.assertEquals(timing.calls, 2)
+            self.assertNotEquals(timing.total, None)
+            for phase in timing.phases.itervalues():
+                self.assertTrue(0 <= phase <= timing.total)
+            self.assertFalse('server-timing' in request.outgoingHeaders)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_serverTimingHeader(self):
+        self.srv.serverTimingHeader = True
+        request = self._request('{"method": "echo", "id": 1, ' +
+                                '"params": [1]}')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            header = request.outgoingHeaders['server-timing']
+            self.assertTrue('total;dur=' in header)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_requestError(self):
+        request = self._request('{"method": ')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(len(self.timings), 1)
+            self.assertEquals(self.timings[0].calls, 0)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_streamed(self):
+        self.srv.streamBatches = True
+        request = self._request('[{"method": "echo", "id": 1, ' +
+                                '"params": [1]}]')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(len(self.timings), 1)
+            self.assertEquals(self.timings[0].calls, 1)
+
+        d.addCallback(rendered)
+        return d
+
+    def test_disabled(self):
+        self.srv.timePhases = False
+        request = self._request('{"method": "echo", "id": 1, ' +
+                                '"params": [1]}')
+        d = _render(self.srv, request)
+
+        def rendered(_):
+            self.assertEquals(self.timings, [])
+
+        d.addCallback(rendered)
+        return d
+
+
+class TestCodec(TestCase):
+    timeout = 1
+
+    def test_codecAttribute(self):
+        loaded = []
+        dumped = []
+
+        def loads(s):
+            loaded.append(s)
+            return json.loads(s)
+
+        def dumps(obj):
+            dumped.append(obj)
+            return json.dumps(obj)
+
+        srv = DummyServer()
+        srv.codec = jsonrpc.JSONCodec('custom', dumps, loads)
+
+        request = DummyRequest([''])
+        request.content = StringIO('{"method": "echo", "id": 1, ' +
+                                   '"params": ["ab"]}')
+        d = _render(srv, request)
+
+        def rendered(_):
+            self.assertEquals(len(loaded), 1)
+            self.assertTrue('ab' in dumped)
+            expected = '{"error": null, "id": 1, "result": "ab"}'
+            self.assertEquals(request.written[0], expected)
+
+        d.addCallback(rendered)
+        return d
+
+
 class TestEncodingJSONRPCServer(TestCase):
 
     timeout = 1
@@ -533,3 +1340,69 @@ class TestEncodingJSONRPCServer(TestCase):
         self.assertEqual(data, RESPONSE)
 
         port.stopListening()
+
+
+class EncodedRequest(object):
+
+    def __init__(self, acceptEncoding=None):
+        self.requestHeaders = Headers()
+        if acceptEncoding is not None:
+            self.requestHeaders.setRawHeaders('accept-encoding',
+                                              [acceptEncoding])
+        self.responseHeaders = Headers()
+
+    def getHeader(self, name):
+        values = self.requestHeaders.getRawHeaders(name)
+        return values[-1] if values else None
+
+    def setHeader(self, name, value):
+        self.responseHeaders.setRawHeaders(name, [value])
+
+
+class TestContentEncoderFactory(TestCase):
+
+    def test_wrapper(self):
+        server = DummyServer()
+        wrapped = EncodingJSONRPCServer(server)
+        self.assertTrue(isinstance(wrapped, EncodingResourceWrapper))
+        self.assertEquals(server.compression, None)
+
+    def test_compress(self):
+        request = EncodedRequest('deflate')
+        request.setHeader('Content-Length', '4')
+        encoder = ContentEncoderFactory(['deflate']).encoderForRequest(
+            request)
+
+        data = encoder.encode('{"a"') + encoder.encode(': 1}')
+        data += encoder.finish()
+
+        self.assertEquals(zlib.decompress(data), '{"a": 1}')
+        headers = request.responseHeaders
+        self.assertEquals(headers.getRawHeaders('content-encoding'),
+                          ['deflate'])
+        self.assertEquals(headers.getRawHeaders('vary'), ['Accept-Encoding'])
+        self.assertFalse(headers.hasHeader('content-length'))
+
+    def test_notAccepted(self):
+        request = EncodedRequest('br')
+        factory = ContentEncoderFactory(['gzip'])
+        self.assertEquals(factory.encoderForRequest(request), None)
+
+    def test_minSize(self):
+        request = EncodedRequest('gzip')
+        encoder = ContentEncoderFactory(minSize=100).encoderForRequest(
+            request)
+
+        self.assertEquals(encoder.encode('short'), 'short')
+        self.assertEquals(encoder.encode('x' * 100), 'x' * 100)
+        self.assertEquals(encoder.finish(), '')
+        self.assertFalse(request.responseHeaders.hasHeader(
+            'content-encoding'))
+
+    def test_alreadyEncoded(self):
+        request = EncodedRequest('gzip')
+        encoder = ContentEncoderFactory().encoderForRequest(request)
+        request.setHeader('Content-Encoding', 'gzip')
+
+        self.assertEquals(encoder.encode('compressed'), 'compressed')
+        self.assertEquals(encoder.finish(), '')